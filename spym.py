@@ -1,10 +1,14 @@
 #!/usr/bin/python
 
-import os, sys
+import os, sys, pdb
 import spym
 
 from optparse import OptionParser
 
+def pdbDebugHandler(vm):
+    sys.stderr.write(vm.currentLine)
+    pdb.set_trace()
+
 
 if __name__ == '__main__':
 
@@ -63,6 +67,28 @@ if __name__ == '__main__':
             dest = 'mapped_io',
             help = "Disabled memory mapped I/O devices.")
 
+    parser.add_option("-n",
+            "--hybrid-syscalls",
+            action = 'store_true',
+            dest = 'hybrid_syscalls',
+            default = False,
+            help = "Service syscalls natively even when memory mapped "
+                   "I/O devices are enabled.")
+
+    parser.add_option("-r",
+            "--runtime-lib",
+            action = 'store_true',
+            dest = 'runtime_lib',
+            default = False,
+            help = "Load the runtime library (memcpy, memset, strlen...)")
+
+    parser.add_option("-s",
+            "--sandbox",
+            action = 'store',
+            dest = 'sandbox',
+            default = None,
+            help = "Allow the file syscalls to access the given directory.")
+
     parser.add_option("-d",
             "--delay-slots",
             action = 'store_true',
@@ -97,16 +123,57 @@ if __name__ == '__main__':
             dest = 'enable_cache',
             help = "Disable the standard MIPS R2000 Cache")
 
+    parser.add_option("--max-instructions",
+            action = 'store',
+            dest = 'max_instructions',
+            type = 'int',
+            default = None,
+            help = "Stop execution after running this many instructions.")
+
+    parser.add_option("--max-seconds",
+            action = 'store',
+            dest = 'max_seconds',
+            type = 'float',
+            default = None,
+            help = "Stop execution after this many seconds.")
+
+    parser.add_option("--max-memory",
+            action = 'store',
+            dest = 'max_memory',
+            type = 'int',
+            default = None,
+            help = "Stop execution when the VM allocates more than this "
+                   "many bytes of memory.")
+
+    parser.add_option("--profile",
+            action = 'store_true',
+            dest = 'profile',
+            default = False,
+            help = "Count the executed instructions and print a report of "
+                   "the hottest lines, loops and opcodes.")
+
+    parser.add_option("--profile-top",
+            action = 'store',
+            dest = 'profile_top',
+            type = 'int',
+            default = 10,
+            help = "Number of entries in each section of the profile.")
+
     (opts, args) = parser.parse_args(sys.argv[1:])
 
     vm = spym.VirtualMachine(
             enableDevices = opts.mapped_io,
+            hybridSyscalls = opts.hybrid_syscalls,
+            loadRuntimeLibrary = opts.runtime_lib,
+            fileSandbox = opts.sandbox,
             enableExceptions = opts.exceptions,
             enablePseudoInsts = opts.enable_pseudoinsts,
             verboseSteps = opts.verbose,
             debugPoints = opts.breakpoints,
+            debugHandler = pdbDebugHandler,
             enableDelaySlot = opts.delay_slots,
-            enableCache = opts.enable_cache)
+            enableCache = opts.enable_cache,
+            profile = opts.profile)
 
     if not args:
         assembly = sys.stdin.read()
@@ -115,5 +182,23 @@ if __name__ == '__main__':
         for asm in args:
             vm.load(asm, False)
 
-    vm.run()
+    result = vm.run(
+            max_instructions = opts.max_instructions,
+            max_seconds = opts.max_seconds,
+            max_memory_bytes = opts.max_memory)
+
+    limit_messages = {
+        spym.VirtualMachine.RUN_INSTRUCTION_LIMIT : "instruction limit",
+        spym.VirtualMachine.RUN_TIME_LIMIT : "time limit",
+        spym.VirtualMachine.RUN_MEMORY_LIMIT : "memory limit",
+    }
+
+    if result in limit_messages:
+        sys.stderr.write("\nExecution stopped: %s reached after %d "
+            "instructions.\n" % (limit_messages[result], vm.instructionCount))
+
+    if opts.profile:
+        sys.stderr.write("\n" + vm.profiler.report(opts.profile_top))
+
+    sys.exit(result)
 
@@ -70,8 +70,8 @@ class InstructionEncoder(object):
             imm = (imm << 2)
             label_repl = r'0x%(imm)08X [%(label)s]'
         
-        syntax = syntax.replace('label',    label_repl  )
         syntax = syntax.replace('imm',      r'%(imm)d'  )
+        syntax = syntax.replace('label',    label_repl  )
         syntax = syntax.replace('$d',       r'$%(d)d'   )
         syntax = syntax.replace('$s',       r'$%(s)d'   )
         syntax = syntax.replace('$t',       r'$%(t)d'   )
@@ -110,6 +110,7 @@ class InstructionEncoder(object):
 
         mem_inst = MemoryInstruction(binary_encoding)
         mem_inst._vm_asm = ins_closure
+        mem_inst.name = ins_name
         mem_inst.text = text_encoding
         mem_inst._delay = do_delay
         
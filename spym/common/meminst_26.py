@@ -1,6 +1,7 @@
 class MemoryInstruction(long):
   def __init__(self, number):
     self._vm_asm = None
+    self.name = ''
     self.text = ''
     self.orig_text = ''
     self._delay = False
\ No newline at end of file
@@ -33,17 +33,17 @@ def u8(i):
     return i & 0xFF
 
 def s32(i):
-    return (i + (1 << 31)) % (1 << 32) - (1 << 31)
+    return ((i & 0xFFFFFFFF) ^ 0x80000000) - 0x80000000
 
 def s16(i):
-    return (i + (1 << 15)) % (1 << 16) - (1 << 15)  
+    return ((i & 0xFFFF) ^ 0x8000) - 0x8000
     
 def s8(i):
-    return (i + (1 << 7)) % (1 << 8) - (1 << 7)
+    return ((i & 0xFF) ^ 0x80) - 0x80
     
 def extsgn(i, size):
-    size = (size * 8) - 1
-    return (i + (1 << size)) % (1 << (size + 1)) - (1 << size)
+    sign_bit = 1 << (size * 8 - 1)
+    return ((i & ((sign_bit << 1) - 1)) ^ sign_bit) - sign_bit
     
 def getFromWord(word_register, offset, size = 4):   
     offset = offset * 8
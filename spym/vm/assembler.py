@@ -31,6 +31,8 @@ class AssemblyParser(object):
     """Core for the assembly parsing routines."""
     
     TOKENIZER_REGEX = r"(?<![\(])[\s,]+(?!\s*?[\(\)])"
+    LABEL_REGEX = r"^([^\s\d]\w*)\s*:(.*)$"
+    QUOTED_ARG_REGEX = r'^("[^"]*")\s*,?\s*(.*)$'
         
     class ParsingFailed(Exception):
         pass
@@ -53,6 +55,7 @@ class AssemblyParser(object):
         self.global_variables = {}
 
         self.parsedFiles = 0
+        self.sourceDirectory = ''
         
     def __checkLabel(self, label):
         if label in self.labels:
@@ -69,10 +72,13 @@ class AssemblyParser(object):
             self.parseBuffer(asm)
             
     def parseFile(self, filename):
+        self.sourceDirectory = os.path.dirname(filename)
+        
         with open(filename, 'r') as asm_file:
             self.__parse(filename, asm_file)
             
     def parseBuffer(self, buff):
+        self.sourceDirectory = ''
         self.__parse("_asm_buffer%02d" %
                 self.parsedFiles, buff.split('\n'))
         
@@ -81,6 +87,10 @@ class AssemblyParser(object):
         local_instructions = []
         self.cur_address = 0x0
         
+        # labels pointing at the current address, which must follow it
+        # if the next directive moves it (e.g. to align data)
+        pending_labels = []
+        
         for (line_no, line) in enumerate(asm_contents):
             line_no = line_no + 1
             label, identifier, args = self.__parseLine(line)
@@ -90,6 +100,7 @@ class AssemblyParser(object):
                 if label:
                     self.__checkLabel(label)
                     self.local_labels[label] = self.cur_address
+                    pending_labels.append(label)
             
                 if identifier:
                     if identifier[0] == '.':
@@ -99,11 +110,15 @@ class AssemblyParser(object):
                             self.preprocessor(
                                 identifier, args, self.cur_address)
                         
-                        for (l, a) in self.local_labels.items():
-                            if a == old_line_start:
-                                self.local_labels[l] = new_line_start
+                        for l in pending_labels:
+                            self.local_labels[l] = new_line_start
+                            
+                        if self.cur_address != old_line_start:
+                            pending_labels = []
 
                     else:
+                        pending_labels = []
+                        
                         inst_code = self.instruction_assembler(
                                 identifier, args)
 
@@ -128,6 +143,7 @@ class AssemblyParser(object):
                 raise self.ParsingFailed("\nLINE %d:\t%s\n  %s" % (
                     line_no, line.strip(), parsing_exception))
                         
+        self.preprocessor.closeSegment(self.cur_address)
         self.parsedFiles += 1
         
         for inst_address in local_instructions:
@@ -175,10 +191,10 @@ class AssemblyParser(object):
 
             return (None, None, None)
         
-        if ':' in line:
-            line_label, line = line.split(':', 1)
-            line_label = line_label.strip()
-            line = line.strip()
+        label_re = re.match(self.LABEL_REGEX, line)
+        if label_re:
+            line_label = label_re.group(1)
+            line = label_re.group(2).strip()
 
         line_tokens = line.split(None, 1)
         
@@ -188,6 +204,15 @@ class AssemblyParser(object):
             if len(line_tokens) > 1:
                 if line_id == '.ascii' or line_id == '.asciiz':
                     line_args = [line_tokens[1].strip(), ]
+                    
+                elif (line_id == '.incbin' and 
+                    re.match(self.QUOTED_ARG_REGEX, line_tokens[1])):
+                    quoted_re = re.match(self.QUOTED_ARG_REGEX, line_tokens[1])
+                    line_args = [quoted_re.group(1), ]
+                    
+                    if quoted_re.group(2):
+                        line_args += re.split(
+                            self.TOKENIZER_REGEX, quoted_re.group(2))
                 else:
                     line_args = re.split(
                         self.TOKENIZER_REGEX, line_tokens[1])
@@ -0,0 +1,128 @@
+# Copyright (c) 2009 Vicent Marti
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+import asyncio
+
+class InputPending(Exception):
+    """
+    Raised by a console stream when a read cannot be completed without
+    waiting for more input.
+    """
+    pass
+
+def isAsyncStream(stream, method):
+    return asyncio.iscoroutinefunction(getattr(stream, method, None))
+
+class AsyncStreamReader(object):
+    """
+    Adapts an asyncio StreamReader to the file-like interface used by the 
+    Virtual Machine. Reads are served from an internal buffer; when no full 
+    line is available, InputPending is raised and the caller is expected to
+    await fill() before trying again.
+    """
+    ENCODING = 'latin-1'
+    
+    def __init__(self, reader):
+        self.reader = reader
+        self.buffer = ''
+        self.eof = False
+        
+    def readline(self, limit = -1):
+        newline = self.buffer.find('\n')
+        
+        if newline == -1:
+            if not self.eof and (limit < 0 or len(self.buffer) < limit):
+                raise InputPending()
+                
+            end = len(self.buffer)
+        else:
+            end = newline + 1
+            
+        if limit >= 0:
+            end = min(end, limit)
+            
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+        
+    async def fill(self):
+        data = await self.reader.readline()
+        
+        if not data:
+            self.eof = True
+        elif isinstance(data, bytes):
+            self.buffer += data.decode(self.ENCODING)
+        else:
+            self.buffer += data
+            
+class AsyncStreamWriter(object):
+    """
+    Adapts an asyncio StreamWriter to the file-like interface used by the 
+    Virtual Machine. Writes are queued on the transport right away; drain()
+    should be awaited between execution slices.
+    """
+    ENCODING = 'latin-1'
+    
+    def __init__(self, writer):
+        self.writer = writer
+        
+    def write(self, text):
+        self.writer.write(text.encode(self.ENCODING))
+        
+    def flush(self):
+        pass
+        
+    async def drain(self):
+        await self.writer.drain()
+
+class BufferedConsoleWriter(object):
+    """
+    Write buffer placed between the Virtual Machine and its output stream.
+    Data is handed to the underlying stream when the buffer reaches 
+    'bufferSize' characters, when a newline is written (if 'lineBuffered'
+    is set), or when flush() is called explicitly.
+    """
+    def __init__(self, stream, bufferSize = 4096, lineBuffered = True):
+        self.stream = stream
+        self.bufferSize = bufferSize
+        self.lineBuffered = lineBuffered
+        
+        self.buffer = []
+        self.buffered = 0
+        
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        
+        if (self.buffered >= self.bufferSize or 
+            (self.lineBuffered and '\n' in text)):
+            self.flush()
+            
+    def flush(self):
+        if not self.buffer:
+            return
+            
+        self.stream.write(''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+        self.stream.flush()
@@ -22,19 +22,38 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 
-import os.path, time, sys, pdb
+import os.path, time, sys, random, asyncio
 
 from spym.vm.exceptions import *
-from spym.common.utils import _debug, buildLineOfCode, bin
+from spym.vm.console import InputPending, isAsyncStream, \
+    AsyncStreamReader, AsyncStreamWriter, BufferedConsoleWriter
+from spym.vm.heap import HeapAllocator
+from spym.vm.profiler import ExecutionProfiler
+from spym.common.utils import _debug, buildLineOfCode, bin, s32, s16
 
-from spym.vm.devices import TerminalScreen, TerminalKeyboard, CPUClock_TIMER
+from spym.vm.devices import TerminalScreen, TerminalKeyboard, CPUClock_TIMER, \
+    DMAController
 
 
 class VirtualMachine(object):
+    """
+    MIPS R2000 Virtual Machine.
+    
+    Thread safety: a VirtualMachine instance shares no mutable state with 
+    other instances. Configuration dictionaries are copied on construction, 
+    each instance owns its random number generator (used by the caches), 
+    and breakpoints never enter a global debugger unless a 'debugHandler' 
+    is supplied. Different instances may therefore run concurrently on 
+    different threads, as long as each one is given its own 
+    standardInput/standardOutput streams (the process-wide sys.stdin and 
+    sys.stdout are used otherwise). A single instance is not thread-safe: 
+    all the calls on it must come from one thread at a time.
+    """
     
     SCREEN = 'screen'
     KEYBOARD = 'keyboard'
     CLOCK = 'clock'
+    DMA = 'dma'
     L1_CACHE = 'l1cache'
     L2_CACHE = 'l2cache'
     
@@ -72,77 +91,224 @@ class VirtualMachine(object):
         'screen' : TerminalScreen,
         'keyboard' : TerminalKeyboard,
         'clock' : CPUClock_TIMER,
+        'dma' : DMAController,
+    }
+    
+    # result codes returned by run() and resume()
+    RUN_FINISHED = 0
+    RUN_BREAKPOINT = 1
+    RUN_INSTRUCTION_LIMIT = 2
+    RUN_TIME_LIMIT = 3
+    RUN_MEMORY_LIMIT = 4
+    RUN_INPUT_WAIT = 5
+
+    # flags for the 'open' syscall (same as MARS)
+    FILE_READ = 0
+    FILE_WRITE = 1
+    FILE_APPEND = 9
+    FILE_MODES = {
+        FILE_READ : 'rb',
+        FILE_WRITE : 'wb',
+        FILE_APPEND : 'ab',
+    }
+    
+    FILE_READ_CHUNK = 1 << 20
+
+    # syscall codes for the native memory functions (spym extensions)
+    SYSCALL_MEMCPY = 100
+    SYSCALL_MEMMOVE = 101
+    SYSCALL_MEMSET = 102
+    SYSCALL_STRLEN = 103
+    SYSCALL_STRCMP = 104
+    SYSCALL_MALLOC = 105
+    SYSCALL_FREE = 106
+
+    # number of instructions between checks of the wall-clock and
+    # memory limits
+    LIMIT_CHECK_INTERVAL = 4096
+    
+    # instructions allowed in the body of a polling loop, with the
+    # register fields each one reads and the field it writes
+    POLLING_LOOP_INSTRUCTIONS = {
+        'lb' : (('s',), 't'), 'lbu' : (('s',), 't'), 
+        'lh' : (('s',), 't'), 'lhu' : (('s',), 't'), 
+        'lw' : (('s',), 't'),
+        
+        'add' : (('s', 't'), 'd'), 'addu' : (('s', 't'), 'd'),
+        'sub' : (('s', 't'), 'd'), 'subu' : (('s', 't'), 'd'),
+        'and' : (('s', 't'), 'd'), 'or' : (('s', 't'), 'd'),
+        'xor' : (('s', 't'), 'd'), 'nor' : (('s', 't'), 'd'),
+        'slt' : (('s', 't'), 'd'), 'sltu' : (('s', 't'), 'd'),
+        'sllv' : (('s', 't'), 'd'), 'srlv' : (('s', 't'), 'd'),
+        'srav' : (('s', 't'), 'd'),
+        'sll' : (('t',), 'd'), 'srl' : (('t',), 'd'), 'sra' : (('t',), 'd'),
+        
+        'addi' : (('s',), 't'), 'addiu' : (('s',), 't'),
+        'andi' : (('s',), 't'), 'ori' : (('s',), 't'),
+        'xori' : (('s',), 't'), 'slti' : (('s',), 't'),
+        'sltiu' : (('s',), 't'), 'lui' : ((), 't'),
+        'nop' : ((), None),
+    }
+    
+    POLLING_LOOP_LOADS = ('lb', 'lbu', 'lh', 'lhu', 'lw')
+    
+    POLLING_LOOP_BRANCHES = {
+        'beq' : ('s', 't'), 'bne' : ('s', 't'), 
+        'bgez' : ('s',), 'bgtz' : ('s',), 'blez' : ('s',), 'bltz' : ('s',),
     }
     
+    # longest loop (in instructions) considered for fast-forwarding
+    POLLING_LOOP_SIZE = 8
+    
     class RuntimeVMException(Exception): pass
     class ConfigVMException(Exception): pass
     
+    # raised by bulk syscalls which would go over the memory limit
+    class MemoryLimitReached(Exception): pass
+    
     def __init__(self,
                     memoryBlockSize = 32,
                     verboseSteps = False,
                     debugPoints = None,
+                    debugHandler = None,
+                    randomSeed = None,
                     
                     standardInput = None,
                     standardOutput = None,
+                    outputBufferSize = 4096,
+                    outputLineBuffered = True,
                     
                     enableDelaySlot = True,
                     enablePseudoInsts = True,
                     virtualSyscalls = True,
+                    hybridSyscalls = False,
 
                     enableExceptions = True,
                     exceptionsFile = None,
 
+                    loadRuntimeLibrary = False,
+                    fileSandbox = None,
+
                     enableCache = True,
-                    cacheConfiguration = DEFAULT_CACHE_CFG,
+                    cacheConfiguration = None,
+                    bulkCacheAccounting = False,
                     
                     enableDevices = True,
-                    memoryMappedDevices = DEFAULT_DEVICES_CFG):
+                    memoryMappedDevices = None,
+                    fastForwardPolling = True,
+                    profile = False):
 
         self.memoryBlockSize = memoryBlockSize
         self.verboseSteps = verboseSteps
         self.debugPoints = debugPoints or []
+        self.debugHandler = debugHandler
+        self.debugResumeAddress = None
+        self.random = random.Random(randomSeed)
 
-        self.deviceInformation = memoryMappedDevices
-        self.cacheInformation = cacheConfiguration
+        if memoryMappedDevices is None:
+            memoryMappedDevices = self.DEFAULT_DEVICES_CFG
+            
+        if cacheConfiguration is None:
+            cacheConfiguration = self.DEFAULT_CACHE_CFG
+
+        # the configurations are copied so instances can't share them; the
+        # parameters themselves (e.g. host streams) are not duplicated
+        self.deviceInformation = dict(
+            (name, (device[0], dict(device[1])) 
+                if isinstance(device, tuple) else device)
+            for (name, device) in memoryMappedDevices.items())
+        self.cacheInformation = dict(
+            (name, dict(cache)) 
+            for (name, cache) in cacheConfiguration.items())
 
         self.enableDelaySlot = enableDelaySlot
         self.enablePseudoInsts = enablePseudoInsts
         self.virtualSyscalls = virtualSyscalls
+        self.hybridSyscalls = hybridSyscalls
         
         self.enableExceptions = enableExceptions
+        self.loadRuntimeLibrary = loadRuntimeLibrary
+        self.fileSandbox = fileSandbox
+        self.openFiles = {}
         self.enableCache = enableCache
+        self.bulkCacheAccounting = bulkCacheAccounting
         self.enableDevices = enableDevices
+        self.fastForwardPolling = fastForwardPolling
+        self.profile = profile
+        self.profiler = None
 
         self.breakpointed = False
         self.started = False
         self.doStep = False
         self.currentLine = None
         self.running = False
+        self.runResult = self.RUN_FINISHED
+        
+        self.instructionCount = 0
+        self.nextCheckpoint = 0
+        self.limitInstructions = None
+        self.limitDeadline = None
+        self.limitMemory = None
         
-        self.stdout = standardOutput or sys.stdout
+        self.stdoutStream = standardOutput or sys.stdout
         self.stdin = standardInput or sys.stdin
+        
+        if isAsyncStream(self.stdoutStream, 'drain'):
+            self.stdoutStream = AsyncStreamWriter(self.stdoutStream)
+            
+        if isAsyncStream(self.stdin, 'readline'):
+            self.stdin = AsyncStreamReader(self.stdin)
+            
+        self.stdout = BufferedConsoleWriter(self.stdoutStream,
+            outputBufferSize, outputLineBuffered)
 
         self.loadedFiles = []
+        self.screenDevice = None
+        self.keyboardDevice = None
         
     def __syscallVirtualization(self):
+        """
+        Service the syscall natively. Returns False if the syscall could 
+        not be completed yet (i.e. it's waiting for input), in which case
+        execution is paused and the syscall is restarted on resume(), or
+        if it faulted on a guest address.
+        """
+        try:
+            self.__runSyscall()
+        except InputPending:
+            self.running = False
+            self.breakpointed = True
+            self.runResult = self.RUN_INPUT_WAIT
+            return False
+        except MIPS_Exception as syscall_exception:
+            # bad pointers or lengths fault like a load/store would, with
+            # the syscall instruction as the faulting one
+            self.processException(syscall_exception)
+            return False
+        except self.MemoryLimitReached:
+            # the syscall is restarted on resume(), like one waiting for 
+            # input
+            self.__stopOnLimit(self.RUN_MEMORY_LIMIT)
+            return False
+        except HeapAllocator.HeapException as heap_error:
+            self.running = False
+            raise self.RuntimeVMException(str(heap_error))
+            
+        return True
+        
+    def __runSyscall(self):
         # v0 should contain the code for the syscall
         syscall_code = self.regBank[2]
         
         if syscall_code == 1:
-            self.stdout.write(str(self.regBank[4]))
+            self.stdout.write(str(s32(self.regBank[4])))
             
         elif syscall_code == 4:
-            memory_ptr = self.regBank[4]
-            
-            while True:
-                out_char = self.memory[memory_ptr, 1]
-                if not out_char:
-                    break
-                    
-                self.stdout.write(chr(out_char))
-                memory_ptr += 1
+            out_string = self.memory.readString(self.regBank[4])
+            self.stdout.write(out_string.decode('latin-1'))
         
         elif syscall_code == 5:
+            self.stdout.flush()
             number = self.stdin.readline(16)
             
             try:
@@ -154,30 +320,340 @@ class VirtualMachine(object):
             self.regBank[2] = number
         
         elif syscall_code == 8:
+            self.stdout.flush()
             in_str = self.stdin.readline(self.regBank[5])
             if in_str.endswith('\n'):
                 in_str = in_str[0:-1]
                 
-            mem_ptr = self.regBank[4]
+            self.memory.write_bytes(self.regBank[4],
+                in_str.encode('latin-1', 'replace') + b'\0')
+        
+        elif syscall_code == 9:
+            old_brk = self.heap.sbrk(s32(self.regBank[4]))
+            self.regBank[2] = 0xFFFFFFFF if old_brk is None else old_brk
+        
+        elif 13 <= syscall_code <= 16:
+            self.regBank[2] = self.__fileSyscall(syscall_code)
+        
+        elif self.SYSCALL_MEMCPY <= syscall_code <= self.SYSCALL_STRCMP:
+            self.__memorySyscall(syscall_code)
             
-            for c in in_str:
-                self.memory[mem_ptr, 1] = ord(c)
-                mem_ptr += 1
-                
-            self.memory[mem_ptr, 1] = 0
+        elif syscall_code == self.SYSCALL_MALLOC:
+            self.regBank[2] = self.heap.malloc(self.regBank[4])
+            
+        elif syscall_code == self.SYSCALL_FREE:
+            self.heap.free(self.regBank[4])
         
         else:
             raise self.RuntimeVMException(
                 "Unimplemented syscall code: %d" % syscall_code)
+                
+    def __sandboxPath(self, filename):
+        if self.fileSandbox is None:
+            return None
+            
+        sandbox = os.path.realpath(self.fileSandbox)
+        path = os.path.realpath(os.path.join(sandbox, filename))
+        
+        if os.path.commonpath([sandbox, path]) != sandbox:
+            return None
             
-        # hack: stdout gets clogged with the charspam, 
-        # flush it after each syscall
-        self.stdout.flush()
+        return path
+        
+    def __fileSyscall(self, syscall_code):
+        """
+        File syscalls (open, read, write, close). Files can only be opened
+        inside the 'fileSandbox' directory; file descriptors 0, 1 and 2
+        are the VM console.
+        
+            Returns: the value for $v0, which is -1 on error.
+        """
+        a0, a1, a2 = self.regBank[4], self.regBank[5], self.regBank[6]
+        
+        if syscall_code == 13: # open
+            filename = self.memory.readString(a0).decode('latin-1')
+            path = self.__sandboxPath(filename)
+            
+            if path is None or a1 not in self.FILE_MODES:
+                return -1
+                
+            try:
+                handle = open(path, self.FILE_MODES[a1])
+            except (IOError, OSError):
+                return -1
+                
+            fd = 3
+            while fd in self.openFiles:
+                fd += 1
+                
+            self.openFiles[fd] = handle
+            return fd
+            
+        if syscall_code == 14: # read
+            if a0 == 0:
+                self.stdout.flush()
+                data = self.stdin.readline(a2).encode('latin-1', 'replace')
+                self.memory.write_bytes(a1, data)
+                return len(data)
+                
+            if a0 not in self.openFiles:
+                return -1
+            
+            # the file is read straight into a reusable buffer, which is
+            # then stored in bulk into the guest memory
+            handle = self.openFiles[a0]
+            buff = bytearray(min(a2, self.FILE_READ_CHUNK))
+            view = memoryview(buff)
+            total = 0
+            
+            try:
+                while total < a2:
+                    count = handle.readinto(view[:min(len(buff), a2 - total)])
+                    if not count:
+                        break
+                        
+                    self.memory.write_bytes(a1 + total, view[:count])
+                    total += count
+            except (IOError, OSError, ValueError):
+                return -1
+                
+            return total
+            
+        if syscall_code == 15: # write
+            data = self.memory.read_bytes(a1, a2)
+            
+            if a0 in (1, 2):
+                self.stdout.write(data.decode('latin-1'))
+                return len(data)
+                
+            if a0 not in self.openFiles:
+                return -1
+                
+            try:
+                self.openFiles[a0].write(data)
+            except (IOError, OSError, ValueError):
+                return -1
+                
+            return len(data)
+            
+        if syscall_code == 16: # close
+            if a0 in self.openFiles:
+                self.openFiles.pop(a0).close()
+                
+            return 0
+            
+    def closeFiles(self):
+        for handle in self.openFiles.values():
+            handle.close()
+            
+        self.openFiles = {}
+            
+    def __bulkAccess(self, address, length, write = False):
+        if self.bulkCacheAccounting:
+            self.memory.accountBulkAccess(address, length, write)
+            
+    def __checkBulkMemory(self, address, length):
+        """
+        Checks that storing 'length' bytes from 'address' won't take the 
+        main memory over the 'max_memory_bytes' limit, before doing it.
+        """
+        # invalid ranges fault in the syscall itself
+        if self.limitMemory is None or address + length > 0x100000000:
+            return
+            
+        main_memory = self.memory.main_memory
+        if (main_memory.getAllocatedBytes() + 
+            main_memory.getUnallocatedBytes(address, length) > 
+                self.limitMemory):
+            raise self.MemoryLimitReached()
+            
+    def __memorySyscall(self, syscall_code):
+        """
+        Native versions of the C memory and string functions, operating in
+        bulk on the VM memory.
+        """
+        a0, a1, a2 = self.regBank[4], self.regBank[5], self.regBank[6]
+        
+        if syscall_code in (self.SYSCALL_MEMCPY, self.SYSCALL_MEMMOVE):
+            # overlapping areas are always handled like memmove()
+            self.__checkBulkMemory(a0, a2)
+            self.memory.copy_bytes(a0, a1, a2)
+            self.__bulkAccess(a1, a2)
+            self.__bulkAccess(a0, a2, True)
+            self.regBank[2] = a0
+            
+        elif syscall_code == self.SYSCALL_MEMSET:
+            self.__checkBulkMemory(a0, a2)
+            self.memory.fill_bytes(a0, a1, a2)
+            self.__bulkAccess(a0, a2, True)
+            self.regBank[2] = a0
+            
+        elif syscall_code == self.SYSCALL_STRLEN:
+            length = len(self.memory.readString(a0))
+            self.__bulkAccess(a0, length + 1)
+            self.regBank[2] = length
+            
+        elif syscall_code == self.SYSCALL_STRCMP:
+            str1 = self.memory.readString(a0)
+            str2 = self.memory.readString(a1)
+            
+            common = 0
+            while (common < len(str1) and common < len(str2) and 
+                str1[common] == str2[common]):
+                common += 1
+                
+            self.__bulkAccess(a0, min(common + 1, len(str1) + 1))
+            self.__bulkAccess(a1, min(common + 1, len(str2) + 1))
+            
+            char1 = str1[common] if common < len(str1) else 0
+            char2 = str2[common] if common < len(str2) else 0
+            self.regBank[2] = char1 - char2
                 
     def __runDevices(self):
         for device in self.devices_list:
             device.tick()
             
+    def __analyzePollingLoop(self, start, end):
+        """
+        Checks if the loop from 'start' to the backward branch at 'end'
+        just polls memory: it must not store anything, and every register
+        it reads has to be either loop invariant or computed earlier in
+        the same iteration, so all iterations behave the same as long as
+        the values loaded don't change.
+        
+            Returns: (instructions per iteration, list of (base register,
+                offset) pairs loaded), or None if it's not a polling loop.
+        """
+        if end - start >= self.POLLING_LOOP_SIZE * 4:
+            return None
+            
+        body = []
+        for address in range(start, end + 4, 4):
+            instruction = self.memory.main_memory.read32(address)
+            if not getattr(instruction, '_vm_asm', None):
+                return None
+            
+            name = instruction.name
+            fields = {
+                's' : (instruction >> 21) & 0x1F,
+                't' : (instruction >> 16) & 0x1F,
+                'd' : (instruction >> 11) & 0x1F,
+            }
+            
+            if address == end:
+                if (name not in self.POLLING_LOOP_BRANCHES or 
+                    instruction._vm_asm.label_address != start):
+                    return None
+                reads, write = self.POLLING_LOOP_BRANCHES[name], None
+                
+            elif name in self.POLLING_LOOP_INSTRUCTIONS:
+                reads, write = self.POLLING_LOOP_INSTRUCTIONS[name]
+                
+            else:
+                return None
+                
+            reads = [fields[f] for f in reads if fields[f]]
+            write = fields[write] if write else 0
+            
+            offset = s16(instruction & 0xFFFF) \
+                if name in self.POLLING_LOOP_LOADS else None
+            body.append((reads, write, offset))
+            
+        written = set(write for (reads, write, offset) in body if write)
+        loads = []
+        computed = set()
+        
+        for (reads, write, offset) in body:
+            if any(r in written and r not in computed for r in reads):
+                return None
+            
+            if offset is not None:
+                if reads[0:1] and reads[0] in written:
+                    return None
+                loads.append(((reads or [0])[0], offset))
+            
+            computed.add(write)
+            
+        return (len(body), loads)
+        
+    def __skipPollingLoop(self, branch_address):
+        """
+        Called after a backward jump. If the loop is polling memory mapped
+        devices, skip as many iterations as can pass before the next 
+        device event (or the next limit check), accounting for the 
+        skipped instructions and device ticks.
+        """
+        loop_start = self.regBank.PC
+        
+        if branch_address not in self.pollingLoops:
+            self.pollingLoops[branch_address] = \
+                self.__analyzePollingLoop(loop_start, branch_address)
+                
+        loop = self.pollingLoops[branch_address]
+        
+        if (loop is None or self.doStep or self.verboseSteps or 
+            self.regBank.CP0.Cause & self.regBank.CP0.interruptMask):
+            return
+            
+        steps, loads = loop
+        registers = self.regBank.std_registers
+        
+        # only polling of the devices is skipped; memory might be 
+        # changed by an interrupt handler at any time
+        if not loads or any(
+            ((registers[base] + offset) & 0xFFFFFFFC) not in 
+                self.memory.devices_memory_map for (base, offset) in loads):
+            return
+            
+        if any(loop_start <= point <= branch_address 
+            for point in self.debugPoints):
+            return
+            
+        event_ticks = None
+        
+        for device in self.devices_list:
+            next_event = device.nextEvent() \
+                if hasattr(device, 'nextEvent') else 0
+            if next_event is not None and (
+                event_ticks is None or next_event < event_ticks):
+                event_ticks = next_event
+        
+        # the loads of the last iteration are only valid if no device 
+        # changed while it ran, i.e. the previous pass through this same
+        # branch happened right before it and far enough from any event
+        last_branch, last_count, last_event_ticks = self.lastPollingBranch
+        self.lastPollingBranch = \
+            (branch_address, self.instructionCount, event_ticks)
+        
+        if (last_branch != branch_address or 
+            last_count != self.instructionCount - steps or 
+            (last_event_ticks is not None and last_event_ticks < steps)):
+            return
+            
+        ticks = self.nextCheckpoint - self.instructionCount
+        if event_ticks is not None:
+            ticks = min(ticks, event_ticks)
+                
+        ticks -= ticks % steps
+        if ticks <= 0:
+            return
+        
+        for device in self.devices_list:
+            device.advance(ticks)
+            
+        if self.profiler is not None:
+            self.profiler.recordLoop(loop_start, branch_address, 
+                ticks // steps)
+            
+        self.instructionCount += ticks
+        self.lastPollingBranch = (branch_address, self.instructionCount,
+            None if event_ticks is None else event_ticks - ticks)
+        
+    def __flushDevices(self):
+        for device in self.devices_list:
+            if hasattr(device, 'flush'):
+                device.flush()
+                
     def __runInstruction(self, instruction):
         if not hasattr(instruction, '_vm_asm'):
             raise self.RuntimeVMException(
@@ -186,14 +662,121 @@ class VirtualMachine(object):
             
         instruction._vm_asm(self.regBank)
                 
+    def __enterDebugger(self, instruction):
+        """
+        Called when execution reaches a debug point (or on every step, when
+        stepping). If no debug handler has been set, execution is paused 
+        before the instruction runs and resume() continues from it.
+        
+            Returns: True if the VM has been paused.
+        """
+        if self.debugResumeAddress == self.regBank.PC:
+            self.debugResumeAddress = None
+            return False
+        
+        self.currentLine = buildLineOfCode(self.regBank.PC, instruction)
+        
+        if self.debugHandler is not None:
+            self.debugHandler(self)
+            return False
+            
+        self.debugResumeAddress = self.regBank.PC
+        self.instructionCount -= 1
+        
+        self.running = False
+        self.breakpointed = True
+        self.runResult = self.RUN_BREAKPOINT
+        return True
+                
+    def __setLimits(self, max_instructions, max_seconds, max_memory_bytes):
+        self.limitInstructions = None
+        self.limitDeadline = None
+        self.limitMemory = max_memory_bytes
+        
+        if max_instructions is not None:
+            self.limitInstructions = self.instructionCount + max_instructions
+            
+        if max_seconds is not None:
+            self.limitDeadline = time.time() + max_seconds
+            
+    def __stopOnLimit(self, result):
+        self.running = False
+        self.breakpointed = True
+        self.runResult = result
+        
+    def __scheduleCheckpoint(self, checkpoint):
+        self.nextCheckpoint = min(self.nextCheckpoint, checkpoint)
+        
+    def __checkLimits(self):
+        """
+        Called from the main loop every time the instruction counter reaches
+        'nextCheckpoint'. Stops the VM if any of the configured limits has
+        been hit, and schedules the next checkpoint otherwise. Count/Compare
+        matches are scheduled as checkpoints too.
+        """
+        cp0 = self.regBank.CP0
+        if self.instructionCount >= cp0.compareDeadline:
+            cp0.timerTick()
+            
+        if (self.limitInstructions is not None and
+            self.instructionCount >= self.limitInstructions):
+            self.__stopOnLimit(self.RUN_INSTRUCTION_LIMIT)
+            
+        elif (self.limitDeadline is not None and
+            time.time() >= self.limitDeadline):
+            self.__stopOnLimit(self.RUN_TIME_LIMIT)
+            
+        elif (self.limitMemory is not None and
+            self.memory.main_memory.getAllocatedBytes() > self.limitMemory):
+            self.__stopOnLimit(self.RUN_MEMORY_LIMIT)
+        
+        checkpoint = self.instructionCount + self.LIMIT_CHECK_INTERVAL
+        
+        if self.limitInstructions is not None:
+            checkpoint = min(checkpoint, self.limitInstructions)
+            
+        checkpoint = min(checkpoint, cp0.compareDeadline)
+        self.nextCheckpoint = checkpoint
+                
     def __vm_loop(self):
+        self.runResult = self.RUN_FINISHED
+        self.__checkLimits()
+        
+        try:
+            self.__vm_steps()
+        finally:
+            if not self.running and not self.breakpointed:
+                self.__flushDevices()
+                self.closeFiles()
+            self.stdout.flush()
+            
+    def __vm_steps(self):
+        cp0 = self.regBank.CP0
+        profiler = self.profiler
+        
         while self.running:
+            if self.instructionCount >= self.nextCheckpoint:
+                self.__checkLimits()
+                if not self.running:
+                    break
+                    
+            self.instructionCount += 1
+            
             try:
                 self.__runDevices()
+                
+                # pending interrupts which are enabled get delivered
+                # before fetching the next instruction
+                if cp0.Cause & cp0.interruptMask:
+                    self.__enterException(self.EXCEPTIONS['INT'])
 
                 did_delay_slot = False
                 oldPC = self.regBank.PC
-                instruction = self.memory[self.regBank.PC, 4]
+                instruction = self.memory.read32(self.regBank.PC)
+                
+                if ((self.doStep or self.regBank.PC in self.debugPoints) and
+                    self.__enterDebugger(instruction)):
+                    break
                 
                 # if the instruction does have a delay, and delay slots
                 # are enabled, we need to handle it...
@@ -205,7 +788,7 @@ class VirtualMachine(object):
                     # current one (the one which should go into the delay 
                     # slot) and execute it first...
                     did_delay_slot = True
-                    delay_slot = self.memory[self.regBank.PC + 0x4, 4]
+                    delay_slot = self.memory.read32(self.regBank.PC + 0x4)
                     
                     if self.verboseSteps:
                         _debug('[DELAYED BR]\n' +
@@ -219,6 +802,9 @@ class VirtualMachine(object):
                     # should set the PC to execute 
                     # the delay slot again hence we increase the PC to skip 
                     # the slot, and continue the execution.
+                    if profiler is not None:
+                        profiler.record(self.regBank.PC + 0x4)
+                        
                     try: self.__runInstruction(delay_slot)
                     except MIPS_Exception as cur_exception:
                         self.processException(cur_exception)
@@ -228,32 +814,57 @@ class VirtualMachine(object):
                 if self.verboseSteps:
                     _debug(buildLineOfCode(self.regBank.PC, instruction))
                     
-                if self.regBank.PC in self.debugPoints or self.doStep:
-                    self.currentLine = buildLineOfCode(
-                        self.regBank.PC, instruction)
-                        
-                    pdb.set_trace()
+                if profiler is not None:
+                    profiler.record(self.regBank.PC)
                     
                 self.__runInstruction(instruction)
                 
                 if oldPC == self.regBank.PC:
                     self.regBank.PC += 0x8 if did_delay_slot else 0x4
+                    
+                elif self.regBank.PC < oldPC and self.fastForwardPolling:
+                    self.__skipPollingLoop(oldPC)
             
             except MIPS_Exception as cur_exception:
                 self.processException(cur_exception)
         
-    def resume(self):
+    def resume(self,
+                max_instructions = None,
+                max_seconds = None,
+                max_memory_bytes = None):
+        """
+        Continue a paused execution. The limits work like the ones in run(),
+        and are counted from the point where execution is resumed, so a long
+        run may be sliced in quanta by calling resume() repeatedly.
+        """
         if not self.started or not self.breakpointed:
             raise self.RuntimeVMException(
                 "Cannot resume execution -- execution not paused.")
             
+        self.__setLimits(max_instructions, max_seconds, max_memory_bytes)
+        
         self.breakpointed = False
         self.running = True
         self.__vm_loop()
         
-        return 1 if self.breakpointed else 0
+        return self.runResult
             
-    def run(self, start_address = None):
+    def run(self,
+            start_address = None,
+            max_instructions = None,
+            max_seconds = None,
+            max_memory_bytes = None):
+        """
+        Load all the files and start execution.
+        
+            max_instructions: Pause after executing this many instructions.
+            max_seconds: Pause after this many seconds of wall-clock time.
+            max_memory_bytes: Pause once the main memory has allocated more
+                than this many bytes.
+                
+            Returns one of the RUN_* result codes; on any of the limit codes
+            execution is paused and may be continued with resume().
+        """
         if self.started or self.breakpointed:
             self.reset()
             
@@ -275,10 +886,37 @@ class VirtualMachine(object):
         self.started = True
         self.running = True
         self.breakpointed = False
+        self.instructionCount = 0
         
+        self.__setLimits(max_instructions, max_seconds, max_memory_bytes)
         self.__vm_loop()
         
-        return 1 if self.breakpointed else 0    
+        return self.runResult
+                
+    async def run_async(self, slice = 1000, start_address = None):
+        """
+        Coroutine version of run(). Executes 'slice' instructions at a time,
+        yielding to the event loop between slices, and awaits the console
+        streams when they are asyncio streams: output is drained after 
+        every slice, and syscalls waiting for input pause the VM until a 
+        new line is available.
+        
+            Returns one of the RUN_* result codes, like run().
+        """
+        result = self.run(start_address, max_instructions = slice)
+        
+        while True:
+            if hasattr(self.stdoutStream, 'drain'):
+                await self.stdoutStream.drain()
+            
+            if result == self.RUN_INPUT_WAIT and hasattr(self.stdin, 'fill'):
+                await self.stdin.fill()
+            elif result == self.RUN_INSTRUCTION_LIMIT:
+                await asyncio.sleep(0)
+            else:
+                return result
+                
+            result = self.resume(max_instructions = slice)
                 
     def processException(self, exception):
         if exception.code not in self.EXCEPTIONS:
@@ -297,14 +935,10 @@ class VirtualMachine(object):
                 raise self.RuntimeVMException(
                     "Invalid interrupt source %d." % int_id)
             
-            # if the global interrupt enable is on, and the source is 
-            # not masked, flag a cause bit
-            if (self.regBank.CP0.Status & 0x1) and (
-                self.regBank.CP0.Status & (1 << (int_id + 8))):
-                self.regBank.CP0.Cause |= (1 << (10 + int_id))
-            
-            else:
-                return
+            # flag the interrupt as pending; it's delivered by the main 
+            # loop as soon as it's enabled
+            self.regBank.CP0.Cause |= (1 << (10 + int_id))
+            return
             
         elif code == 4 or code == 5: # memory access error
             self.regBank.CP0.BadVAddr = exception.badaddr
@@ -316,21 +950,24 @@ class VirtualMachine(object):
                 self.running = False
                 
                 if self.regBank[4]:
-                    pdb.set_trace()
                     raise self.RuntimeVMException(
                         "Program terminated with error code %d" %
                             self.regBank[4])
                 
             elif self.virtualSyscalls:
-                self.__syscallVirtualization()
-                self.regBank.PC += 0x4 # skip syscall instruction...
+                if self.__syscallVirtualization():
+                    self.regBank.PC += 0x4 # skip syscall instruction...
                 return
             
         elif code == 9: # breakpoint hook, don't handle by OS
             self.running = False
             self.breakpointed = True
+            self.runResult = self.RUN_BREAKPOINT
             return
-                
+            
+        self.__enterException(code)
+        
+    def __enterException(self, code):
         self.regBank.CP0.Cause &= ~0x3C
         
         # set exception code in the cause register
@@ -348,39 +985,151 @@ class VirtualMachine(object):
         self.regBank.PC = EXCEPTION_HANDLER_ADDR
         
     def getAccessMode(self):
-        return 'user' if self.regBank.CP0.getUserBit() else 'kernel'
+        return 'user' if self.regBank.CP0.userMode else 'kernel'
+
+    def __checkMemoryAvailable(self):
+        if not self.started:
+            raise self.RuntimeVMException(
+                "Guest memory is only available once the VM has been "
+                "started (e.g. run(max_instructions = 0)).")
+
+    def read_memory(self, address, length):
+        """
+        Host-side bulk read of 'length' bytes of guest memory, bypassing
+        the cache simulation (dirty lines are written back first) and the
+        user mode protection checks. Returns a 'bytes' object.
+        """
+        self.__checkMemoryAvailable()
+        return self.memory.read_bytes(address, length, privileged = True)
+
+    def write_memory(self, address, data):
+        """
+        Host-side bulk write of any bytes-like object (including NumPy
+        arrays) into guest memory. Cached copies of the affected lines are
+        written back and reloaded.
+        """
+        self.__checkMemoryAvailable()
+        data = memoryview(data)
+
+        if not data.c_contiguous:
+            data = memoryview(data.tobytes())
+
+        self.memory.write_bytes(address, data.cast('B'), privileged = True)
+
+    def read_screen(self, clear = False):
+        """
+        Returns the bytes printed so far on a headless screen device (see
+        TerminalScreen), and optionally empties its buffer. Only output 
+        going through the memory mapped screen is captured; syscalls 
+        serviced natively write to 'standardOutput'.
+        """
+        if not getattr(self.screenDevice, 'headless', False):
+            raise self.RuntimeVMException(
+                "The VM has no headless screen device (or it hasn't been "
+                "started yet).")
+                
+        output = bytes(self.screenDevice.captured)
+        
+        if clear:
+            del self.screenDevice.captured[:]
+            
+        return output
+        
+    def feed_keyboard(self, data):
+        """
+        Queue input (a string or bytes) on the memory mapped keyboard;
+        see TerminalKeyboard.feed().
+        """
+        if not hasattr(self.keyboardDevice, 'feed'):
+            raise self.RuntimeVMException(
+                "The VM has no keyboard device with an input queue (or it "
+                "hasn't been started yet).")
+                
+        self.keyboardDevice.feed(data)
         
+    def memory_view(self, address, count, dtype = 'u4'):
+        """
+        Returns a NumPy array of 'count' elements of 'dtype' read from
+        guest memory at 'address', always as little-endian data.
+
+        The array aliases guest memory when the range is backed by a
+        device buffer (e.g. a framebuffer), so writes to it reach the
+        guest directly. Otherwise it's a read-only copy: main memory is
+        not stored as a flat buffer, so changes must be pushed back with
+        write_memory().
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise self.RuntimeVMException("memory_view() requires NumPy.")
+
+        self.__checkMemoryAvailable()
+
+        dtype = numpy.dtype(dtype)
+        if dtype.byteorder != '|':
+            dtype = dtype.newbyteorder('<')
+
+        length = count * dtype.itemsize
+        buffer = self.memory.getBuffer(address, length)
+
+        if buffer is not None:
+            return numpy.frombuffer(buffer, dtype, count)
+
+        return numpy.frombuffer(self.read_memory(address, length), dtype)
+
     def __initialize(self):
         # core elements
         from spym.vm.memory import MemoryManager
         self.memory = MemoryManager(self,
                         self.memoryBlockSize,
                         self.enableCache,
-                        self.cacheInformation)
+                        self.cacheInformation,
+                        self.random)
         
         from spym.vm.assembler import AssemblyParser
         self.parser = AssemblyParser(self.memory, self.enablePseudoInsts)
 
         from spym.vm.regbank import RegisterBank
         self.regBank = RegisterBank(self.memory)
+        self.memory.cp0 = self.regBank.CP0
+        
+        # Count is driven by the number of instructions executed
+        self.instructionCount = 0
+        self.regBank.CP0.attachClock(
+            lambda: self.instructionCount, self.__scheduleCheckpoint)
         
         # device initialization
         self.devices_list = []
+        self.pollingLoops = {}
+        self.lastPollingBranch = (None, 0, None)
         interrupt_handlers = []
         device_kb = None
         device_scr = None
         
-        for (device_name, device) in self.deviceInformation.items():
+        if self.enableDevices:
+            devices_config = self.deviceInformation.items()
+        else:
+            devices_config = ()
+        
+        for (device_name, device) in devices_config:
             device_params = {}
             
             if isinstance(device, tuple):
                 device, device_params = device
+                
+            # console devices write to this VM's own streams by default
+            device_params = dict(device_params)
+            
+            if device_name == self.SCREEN:
+                device_params.setdefault('stdout', self.stdout)
+            elif device_name == self.KEYBOARD:
+                device_params.setdefault('stdin', self.stdin)
     
             device_instance = device(len(self.devices_list), **device_params)
             
             if (not hasattr(device_instance, 'tick') or 
-                not hasattr(device_instance, '__getitem__') or 
-                not hasattr(device_instance, '__setitem__')):
+                not hasattr(device_instance, 'read') or 
+                not hasattr(device_instance, 'write')):
                 raise self.ConfigVMException(
                     "Device '%s' doesn't implement the standard Device Interface." 
                         % device_name)
@@ -392,6 +1141,15 @@ class VirtualMachine(object):
             for memory_address in device_instance._memory_map:
                 self.memory.devices_memory_map[memory_address] = device_instance
                 
+            if hasattr(device_instance, 'attachCPU'):
+                device_instance.attachCPU(self.regBank.CP0)
+                
+            if hasattr(device_instance, 'attachMemory'):
+                device_instance.attachMemory(self.memory)
+                
+            if hasattr(device_instance, 'attachConsole'):
+                device_instance.attachConsole(self.stdout)
+                
             if (hasattr(device_instance, '_interrupt_handler') and 
                 hasattr(device_instance, '_interrupt_handler_label')):
                 interrupt_handlers.append(
@@ -408,10 +1166,16 @@ class VirtualMachine(object):
             elif device_name == self.SCREEN:
                 device_scr = device_instance
         
+        self.screenDevice = device_scr
+        self.keyboardDevice = device_kb
+        
         if not self.virtualSyscalls and (not device_kb and not device_scr):
             self.virtualSyscalls = True
 
-        if self.virtualSyscalls and (device_kb or device_scr):
+        # in hybrid mode syscalls are still serviced natively, even though
+        # the console devices are mapped for programs which poll them
+        if (self.virtualSyscalls and (device_kb or device_scr) and 
+            not self.hybridSyscalls):
             self.virtualSyscalls = False
         
         # assembly loading / parsing
@@ -423,13 +1187,29 @@ class VirtualMachine(object):
                 ktext = getKernelText(True, True,
                     interrupt_handlers,
                     screen_address,
-                    keyboard_address)
+                    keyboard_address,
+                    getattr(device_scr, '_burst_output', False))
             else:
                 ktext = getKernelText(True, False,
                     interrupt_handlers)
                 
             self.parser.parseBuffer(ktext)
    
+        if self.loadRuntimeLibrary:
+            if not self.virtualSyscalls:
+                raise self.ConfigVMException(
+                    "The runtime library requires native syscalls.")
+                    
+            self.parser.parseBuffer(getRuntimeLibraryText({
+                'memcpy' : self.SYSCALL_MEMCPY,
+                'memmove' : self.SYSCALL_MEMMOVE,
+                'memset' : self.SYSCALL_MEMSET,
+                'strlen' : self.SYSCALL_STRLEN,
+                'strcmp' : self.SYSCALL_STRCMP,
+                'malloc' : self.SYSCALL_MALLOC,
+                'free' : self.SYSCALL_FREE,
+            }))
+   
         for (asm_file, load_as_buffer) in self.loadedFiles:
             if load_as_buffer:
                 self.parser.parseBuffer(asm_file)
@@ -437,6 +1217,14 @@ class VirtualMachine(object):
                 self.parser.parseFile(asm_file)
         
         self.parser.resolveGlobalDependencies()
+        
+        # the heap starts right after the static data
+        self.heap = HeapAllocator(self.memory.main_memory.getSegmentEnd(
+            'user_data', HeapAllocator.HEAP_LIMIT))
+            
+        self.profiler = None
+        if self.profile:
+            self.profiler = ExecutionProfiler(self.memory.main_memory)
 
 
     def load(self, asm_file, load_as_buffer = False):
@@ -447,9 +1235,13 @@ class VirtualMachine(object):
         del(self.memory)
         del(self.regBank)
         del(self.devices_list)
+        del(self.heap)
+        
+        self.closeFiles()
         
         self.started = False
         self.breakpointed = False
+        self.debugResumeAddress = None
         
     def debugPrintAll(self, labels = True, memory = True, regbank = True):
         if memory:
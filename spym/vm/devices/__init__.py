@@ -1,2 +1,7 @@
-from spym.vm.devices.terminal import TerminalScreen, TerminalKeyboard
-from spym.vm.devices.clock import CPUClock_TIMER, CPUClock_TICKS
\ No newline at end of file
+from spym.vm.devices.base import MemoryMappedDevice
+from spym.vm.devices.terminal import TerminalScreen, TerminalKeyboard, \
+    FIFOScreen
+from spym.vm.devices.clock import CPUClock_TIMER, CPUClock_TICKS
+from spym.vm.devices.dma import DMAController
+from spym.vm.devices.disk import DiskDevice
+from spym.vm.devices.framebuffer import Framebuffer
@@ -0,0 +1,107 @@
+# Copyright (c) 2009 Vicent Marti
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from spym.common.utils import breakAddress
+
+class MemoryMappedDevice(object):
+    """
+    Base class for the memory mapped devices. Devices implement 'read' 
+    and 'write' for a full address and an access size (1, 2 or 4 bytes);
+    the typed accessors used by the memory manager and the old subscript
+    form (device[address, size]) are both built on top of them.
+    """
+    _memory_map = ()
+    cp0 = None
+    memory = None
+    
+    def attachCPU(self, cp0):
+        """
+        Called by the VM with the coprocessor 0 of the CPU the device is
+        connected to, which receives its interrupts.
+        """
+        self.cp0 = cp0
+        
+    def attachMemory(self, memory):
+        """
+        Called by the VM with its memory manager, for devices which access
+        guest memory by themselves.
+        """
+        self.memory = memory
+        
+    def raiseInterrupt(self, int_id):
+        """
+        Flag hardware interrupt 'int_id' as pending in the Cause register.
+        The CPU delivers it at the next instruction boundary where it's
+        enabled; until then it just stays pending.
+        """
+        if self.cp0 is not None:
+            self.cp0.Cause |= 1 << (10 + int_id)
+            
+    def nextEvent(self):
+        """
+        Number of upcoming ticks which are guaranteed not to change the
+        state of the device, or None if ticking never changes it. The VM
+        uses it to fast-forward loops which just poll the device; the
+        default (0) means the device can't be skipped over.
+        """
+        return 0
+        
+    def advance(self, ticks):
+        """
+        Run 'ticks' ticks at once. The VM never advances a device past
+        the value returned by nextEvent().
+        """
+        for _ in range(ticks):
+            self.tick()
+    
+    def read(self, address, size):
+        return 0x0
+        
+    def write(self, address, size, value):
+        pass
+        
+    def read8(self, address):
+        return self.read(address, 1)
+        
+    def read16(self, address):
+        return self.read(address, 2)
+        
+    def read32(self, address):
+        return self.read(address, 4)
+        
+    def write8(self, address, value):
+        self.write(address, 1, value)
+        
+    def write16(self, address, value):
+        self.write(address, 2, value)
+        
+    def write32(self, address, value):
+        self.write(address, 4, value)
+        
+    def __getitem__(self, addr):
+        address, offset, size = breakAddress(addr)
+        return self.read(address | offset, size)
+        
+    def __setitem__(self, addr, value):
+        address, offset, size = breakAddress(addr)
+        self.write(address | offset, size, value)
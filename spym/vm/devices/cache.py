@@ -55,7 +55,7 @@ class CacheLine(object):
         self.label = self.cache.getLabel(start_addr)
         
         for i in range(len(self.contents)): self.contents[i] = \
-            self.cache.memory[start_addr + i * 0x4, 4]
+            self.cache.memory.read32(start_addr + i * 0x4)
             
         if self.policy == 'FIFO':
             self.setCounters()
@@ -71,7 +71,7 @@ class CacheLine(object):
         
     def writeBack(self):
         for (offset, word) in enumerate(self.contents):
-            self.cache.memory[self.start_addr + offset * 0x4, 4] = word
+            self.cache.memory.write32(self.start_addr + offset * 0x4, word)
         
     def writeContents(self, word_in_block, word_desp, size, data):
         word = self.contents[word_in_block]
@@ -90,7 +90,7 @@ class BaseCache(object):
     
     def __init__(self, cache_name, memory_ptr, blockSize,
                 waySize, numberOfLines, writePolicy_hit,
-                writePolicy_miss, replacementPolicy):
+                writePolicy_miss, replacementPolicy, rng = None):
         """
 Base cache constructor.
 
@@ -137,6 +137,11 @@ Base cache constructor.
         - 'FIFO': Remove the line which came first (the oldest) from memory.
         - 'random': Randomly choose a line to remove
         
+    rng:
+        random.Random instance used by the 'random' replacement policy. 
+        Each cache gets its own generator when none is given, so caches 
+        never share the global random state.
+        
 NOTE ON CACHE MODES:
     This is a generic cache which simulates all three addressing modes.
     
@@ -163,6 +168,11 @@ NOTE ON CACHE MODES:
         self.writePolicy_hit = writePolicy_hit
         self.writePolicy_miss = writePolicy_miss
         self.replacementPolicy = replacementPolicy
+        self.random = rng or random.Random()
+        
+        self.hits = 0
+        self.misses = 0
+        self.bulk_accesses = 0
         
         self.cache = [CacheLine(self, self.replacementPolicy)
                       for i in range(numberOfLines)]
@@ -276,7 +286,7 @@ NOTE ON CACHE MODES:
                 return line
 
         if self.replacementPolicy == 'random':
-            return random.choice(fullset)
+            return self.random.choice(fullset)
             
         return highest_id
         
@@ -300,6 +310,86 @@ NOTE ON CACHE MODES:
 
         return None
 
+    def accountBulkAccess(self, start, end, write = False):
+        """
+        Replay on the cache an access to every byte between 'start' and 
+        'end', done in bulk on the backing memory, so it ends up like a 
+        byte-by-byte loop would have left it. Called after the memory has 
+        been accessed.
+        
+        The first access to each block hits if the block is cached, and
+        misses and brings it in otherwise; the rest of its bytes hit. 
+        Blocks written get dirty, unless the write policy skips the cache 
+        on a miss, in which case every byte misses.
+        """
+        address = start
+        
+        while address < end:
+            block_end = (address // self.blocksize + 1) * self.blocksize
+            count = min(block_end, end) - address
+            line_id = self.findLineForAddress(address)
+            
+            if line_id is None and write and \
+                self.writePolicy_miss == 'write-noallocate':
+                self.misses += count
+                
+            else:
+                if line_id is None:
+                    self.misses += 1
+                    self.hits += count - 1
+                    self.bringFromMemory(address)
+                    line_id = self.findLineForAddress(address)
+                else:
+                    self.hits += count
+                    self.cache[line_id].getContents()
+                    
+                if write:
+                    self.cache[line_id].dirty = 1
+                
+            self.bulk_accesses += count
+            address += count
+            
+    def __linesInRange(self, start, end):
+        first_block = start // self.blocksize
+        last_block = (end - 1) // self.blocksize
+        
+        if last_block - first_block >= self.linecount:
+            return [line for line in self.cache if line.valid and 
+                first_block <= line.start_addr // self.blocksize <= last_block]
+                
+        lines = []
+        for block in range(first_block, last_block + 1):
+            line_id = self.findLineForAddress(block * self.blocksize)
+            if line_id is not None:
+                lines.append(self.cache[line_id])
+                
+        return lines
+        
+    def refreshRange(self, start, end, main_memory):
+        """
+        Reload from 'main_memory' the lines holding any address between 
+        'start' and 'end', after it has been written directly. The lines
+        must have been written back first (see syncRange).
+        """
+        for line in self.__linesInRange(start, end):
+            for i in range(len(line.contents)):
+                line.contents[i] = main_memory.read32(
+                    line.start_addr + i * 0x4)
+            
+    def syncRange(self, start, end, invalidate = False):
+        """
+        Write back the dirty lines holding any address between 'start' 
+        and 'end', so the backing memory can be accessed directly. If 
+        'invalidate' is set, the lines are dropped as well.
+        """
+        for line in self.__linesInRange(start, end):
+            if line.dirty:
+                line.writeBack()
+                line.dirty = 0
+                
+            if invalidate:
+                line.valid = 0
+        
     def getData(self, address, size):
         """
         Read 'size' bytes of data of 'address' from the cache. Handle hits 
@@ -307,8 +397,10 @@ NOTE ON CACHE MODES:
         """
         dest_line = self.findLineForAddress(address)
         if dest_line is None:
+            self.misses += 1
             data = self.bringFromMemory(address)
         else:
+            self.hits += 1
             data = self.cache[dest_line].getContents()
 
         return self.buildDataReturn(data, address, size)
@@ -321,6 +413,8 @@ NOTE ON CACHE MODES:
         word_in_block = (address % self.blocksize) // 4
         
         if dest_line is None:
+            self.misses += 1
+            
             # resolve writing miss with or without allocation
             if self.writePolicy_miss == 'write-allocate':
                 self.bringFromMemory(address)
@@ -332,9 +426,11 @@ NOTE ON CACHE MODES:
                     size, data)
 
             elif self.writePolicy_miss == 'write-noallocate':
-                self.memory[address, size] = data
+                self.memory.setData(address, size, data)
                 
         else:
+            self.hits += 1
+            
             # always write on cache
             self.cache[dest_line].writeContents(
                 word_in_block,
@@ -345,7 +441,25 @@ NOTE ON CACHE MODES:
             # otherwise wait until 
             # removal for writing
             if self.writePolicy_hit == 'write-through':
-                self.memory[address, size] = data
+                self.memory.setData(address, size, data)
+        
+    def read8(self, address):
+        return self.getData(address, 1)
+        
+    def read16(self, address):
+        return self.getData(address, 2)
+        
+    def read32(self, address):
+        return self.getData(address, 4)
+        
+    def write8(self, address, data):
+        self.setData(address, 1, data)
+        
+    def write16(self, address, data):
+        self.setData(address, 2, data)
+        
+    def write32(self, address, data):
+        self.setData(address, 4, data)
         
     def __getitem__(self, address_tuple):
         address, size = address_tuple
@@ -364,15 +478,16 @@ class MIPSCache_TEMPLATE(BaseCache):
                  sizeOfWay = None,
                  writePolicy_hit = 'write-back',
                  writePolicy_miss = 'write-allocate',
-                 replacementPolicy = 'FIFO'):
+                 replacementPolicy = 'FIFO',
+                 rng = None):
                 
-        if cacheMapping is 'direct':
+        if cacheMapping == 'direct':
             sizeOfWay = 1
-        elif cacheMapping is 'associative':
+        elif cacheMapping == 'associative':
             sizeOfWay = numberOfLines
             
         BaseCache.__init__(self,
             cacheName, None, block_size,
             sizeOfWay, numberOfLines,
             writePolicy_hit, writePolicy_miss,
-            replacementPolicy)
+            replacementPolicy, rng)
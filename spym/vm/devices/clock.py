@@ -25,6 +25,7 @@ import time
 from spym.vm.exceptions import MIPS_Exception
 from spym.common.utils import *
 from spym.common.utils import _debug
+from spym.vm.devices.base import MemoryMappedDevice
 
 GENERIC_INT_HANDLER = \
 r"""
@@ -58,7 +59,7 @@ int_CLOCK:
 """
 
 
-class CPUClock_TIMER(object):
+class CPUClock_TIMER(MemoryMappedDevice):
     _memory_map = (0xFFFF0010, )
     
     _interrupt_handler_label = 'int_CLOCK'
@@ -77,23 +78,28 @@ class CPUClock_TIMER(object):
             self.clock_bit = 1
             
             if self.int_enable:
-                raise MIPS_Exception('INT', 
-                    int_id = self.int_level, 
-                    debug_msg = 'CPU clock tick!')
+                self.raiseInterrupt(self.int_level)
+                
+    # the timer follows the wall-clock, so skipping ticks never skips 
+    # any of its events
+    def nextEvent(self):
+        return None
+        
+    def advance(self, ticks):
+        pass
             
-    def __getitem__(self, addr):
-        address, offset, size = breakAddress(addr)
-        return 0x0 if offset else ((self.clock_bit << 1) | self.int_enable)
+    def read(self, address, size):
+        if address & 0x3: return 0x0
+        return (self.clock_bit << 1) | self.int_enable
         
-    def __setitem__(self, addr, value):
-        address, offset, size = breakAddress(addr)
-        if offset == 0:
+    def write(self, address, size, value):
+        if address & 0x3 == 0:
             self.int_enable = value & 0x1
             self.clock_bit = (value >> 1) & 0x1
             
 
 
-class CPUClock_TICKS(object):
+class CPUClock_TICKS(MemoryMappedDevice):
     _memory_map = (0xFFFF0010, )
     
     _interrupt_handler_label = 'int_CLOCK'
@@ -112,17 +118,19 @@ class CPUClock_TICKS(object):
             self.loop_ticks = self.loop_time
             self.clock_bit = 1
             if self.int_enable:
-                raise MIPS_Exception('INT', 
-                    int_id = self.int_level, 
-                    debug_msg = 'CPU clock tick!')
-
+                self.raiseInterrupt(self.int_level)
+                
+    def nextEvent(self):
+        return self.loop_ticks - 1
+        
+    def advance(self, ticks):
+        self.loop_ticks -= ticks
             
-    def __getitem__(self, addr):
-        address, offset, size = breakAddress(addr)
-        return 0x0 if offset else ((self.clock_bit << 1) | self.int_enable)
+    def read(self, address, size):
+        if address & 0x3: return 0x0
+        return (self.clock_bit << 1) | self.int_enable
         
-    def __setitem__(self, addr, value):
-        address, offset, size = breakAddress(addr)
-        if offset == 0:
+    def write(self, address, size, value):
+        if address & 0x3 == 0:
             self.int_enable = value & 0x1
             self.clock_bit = (value >> 1) & 0x1
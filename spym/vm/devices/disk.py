@@ -0,0 +1,155 @@
+# Copyright (c) 2009 Vicent Marti
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import os, mmap
+from spym.vm.exceptions import MIPS_Exception
+from spym.vm.devices.base import MemoryMappedDevice
+
+class DiskDevice(MemoryMappedDevice):
+    """
+    Block storage backed by a host image file, mapped in memory with 
+    mmap. Write SECTOR, BUFFER (a guest address) and COUNT (in sectors),
+    then a command to COMMAND: READ copies sectors from the disk to guest
+    memory, WRITE the other way around, and FLUSH syncs the image file.
+    Setting CMD_INT_ENABLE along with the command raises the interrupt 
+    once it's done. Commands complete right away; reading COMMAND gives
+    the status (READY, plus ERROR if the last command failed).
+    
+    The image is created (or extended) to 'sectors' sectors if given, so
+    its contents persist across runs.
+    """
+    MAP_SECTOR = 0xFFFF0030
+    MAP_BUFFER = 0xFFFF0034
+    MAP_COUNT = 0xFFFF0038
+    MAP_COMMAND = 0xFFFF003C
+    
+    _memory_map = (MAP_SECTOR, MAP_BUFFER, MAP_COUNT, MAP_COMMAND)
+    
+    CMD_READ = 0x1
+    CMD_WRITE = 0x2
+    CMD_FLUSH = 0x3
+    CMD_INT_ENABLE = 0x10
+    
+    STATUS_READY = 0x1
+    STATUS_ERROR = 0x2
+    
+    class DiskDeviceException(Exception): pass
+    
+    def __init__(self, int_level, image = None, sectors = None, 
+            sector_size = 512):
+        if image is None:
+            raise self.DiskDeviceException("No disk image given.")
+            
+        self.int_level = int_level
+        self.sector_size = sector_size
+        
+        self.sector = 0
+        self.buffer = 0x0
+        self.count = 0
+        self.status = self.STATUS_READY
+        
+        mode = 'r+b' if os.path.exists(image) else 'w+b'
+        self.image_file = open(image, mode)
+        
+        size = os.path.getsize(image)
+        if sectors is not None and size < sectors * sector_size:
+            self.image_file.truncate(sectors * sector_size)
+            size = sectors * sector_size
+            
+        if size == 0:
+            self.image_file.close()
+            raise self.DiskDeviceException(
+                "Disk image '%s' is empty; give its size in sectors." % image)
+            
+        self.image = mmap.mmap(self.image_file.fileno(), size)
+        self.sectors = size // sector_size
+        
+    def __run(self, command):
+        if command == self.CMD_FLUSH:
+            self.image.flush()
+            return
+            
+        if command not in (self.CMD_READ, self.CMD_WRITE) or (
+            self.sector + self.count > self.sectors):
+            raise self.DiskDeviceException()
+            
+        start = self.sector * self.sector_size
+        end = start + self.count * self.sector_size
+        
+        # sectors are moved straight between the mapped image and memory
+        if command == self.CMD_READ:
+            self.memory.write_bytes(self.buffer, 
+                memoryview(self.image)[start:end], privileged = True)
+        else:
+            self.image[start:end] = self.memory.read_bytes(
+                self.buffer, end - start, privileged = True)
+        
+    def flush(self):
+        self.image.flush()
+        
+    def close(self):
+        self.image.close()
+        self.image_file.close()
+        
+    def tick(self):
+        pass
+        
+    def nextEvent(self):
+        return None
+        
+    def advance(self, ticks):
+        pass
+        
+    def write(self, address, size, value):
+        if address & 0x3: return
+        
+        if address == self.MAP_SECTOR:
+            self.sector = value
+        elif address == self.MAP_BUFFER:
+            self.buffer = value
+        elif address == self.MAP_COUNT:
+            self.count = value
+            
+        elif address == self.MAP_COMMAND:
+            try:
+                self.__run(value & 0xF)
+                self.status = self.STATUS_READY
+            except (self.DiskDeviceException, MIPS_Exception):
+                self.status = self.STATUS_READY | self.STATUS_ERROR
+                
+            if value & self.CMD_INT_ENABLE:
+                self.raiseInterrupt(self.int_level)
+        
+    def read(self, address, size):
+        if address & 0x3: return 0x0
+        
+        if address == self.MAP_SECTOR:
+            return self.sector
+        elif address == self.MAP_BUFFER:
+            return self.buffer
+        elif address == self.MAP_COUNT:
+            return self.count
+        elif address == self.MAP_COMMAND:
+            return self.status
+            
+        return 0x0
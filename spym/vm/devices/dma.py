@@ -0,0 +1,133 @@
+# Copyright (c) 2009 Vicent Marti
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from spym.vm.exceptions import MIPS_Exception
+from spym.vm.devices.base import MemoryMappedDevice
+
+class DMAController(MemoryMappedDevice):
+    """
+    DMA engine copying LEN bytes from SRC to DST. Writing CONTROL with
+    the START bit set begins a transfer; the copy itself is done in bulk
+    once the modeled transfer time (a fixed setup time plus a number of
+    bytes per tick) has elapsed, then DONE (or ERROR, for invalid ranges)
+    is set and the interrupt raised, if enabled.
+    
+    Both ranges are checked before anything is copied, and the data is
+    moved in bounded chunks. Coherent transfers go through the memory 
+    manager, so they see (and update) the data held in the caches and can
+    reach other devices. Otherwise they access main memory directly, like
+    a DMA engine which doesn't snoop the caches: the guest must flush 
+    them itself, and ranges overlapping devices are invalid. With
+    'cache_accounting' the transfer is also counted in the data cache
+    statistics.
+    """
+    MAP_SRC = 0xFFFF0020
+    MAP_DST = 0xFFFF0024
+    MAP_LEN = 0xFFFF0028
+    MAP_CTRL = 0xFFFF002C
+    
+    _memory_map = (MAP_SRC, MAP_DST, MAP_LEN, MAP_CTRL)
+    
+    CTRL_START = 0x1
+    CTRL_INT_ENABLE = 0x2
+    CTRL_DONE = 0x4
+    CTRL_ERROR = 0x8
+    
+    def __init__(self, int_level, setup_ticks = 8, bytes_per_tick = 64,
+            coherent = True, cache_accounting = False):
+        self.int_level = int_level
+        self.setup_ticks = setup_ticks
+        self.bytes_per_tick = bytes_per_tick
+        self.coherent = coherent
+        self.cache_accounting = cache_accounting
+        
+        self.source = 0x0
+        self.destination = 0x0
+        self.length = 0
+        self.control_register = 0x0
+        self.busy_ticks = 0
+        
+    def __transfer(self):
+        try:
+            self.memory.copy_bytes(self.destination, self.source, 
+                self.length, privileged = True, direct = not self.coherent)
+                
+            if self.cache_accounting:
+                self.memory.accountBulkAccess(self.source, self.length)
+                self.memory.accountBulkAccess(self.destination, self.length,
+                    True)
+                
+        except MIPS_Exception:
+            self.control_register |= self.CTRL_ERROR
+        
+    def tick(self):
+        if self.busy_ticks:
+            self.busy_ticks -= 1
+            
+            if not self.busy_ticks:
+                self.__transfer()
+                self.control_register &= ~self.CTRL_START
+                self.control_register |= self.CTRL_DONE
+                
+                if self.control_register & self.CTRL_INT_ENABLE:
+                    self.raiseInterrupt(self.int_level)
+                    
+    def nextEvent(self):
+        return self.busy_ticks - 1 if self.busy_ticks else None
+        
+    def advance(self, ticks):
+        if self.busy_ticks:
+            self.busy_ticks -= ticks
+        
+    def write(self, address, size, value):
+        if address & 0x3 or self.busy_ticks: 
+            return
+            
+        if address == self.MAP_SRC:
+            self.source = value
+        elif address == self.MAP_DST:
+            self.destination = value
+        elif address == self.MAP_LEN:
+            self.length = value
+            
+        elif address == self.MAP_CTRL:
+            self.control_register = value & (
+                self.CTRL_START | self.CTRL_INT_ENABLE)
+            
+            if value & self.CTRL_START:
+                self.busy_ticks = self.setup_ticks + 1 + (
+                    self.length // self.bytes_per_tick)
+        
+    def read(self, address, size):
+        if address & 0x3: return 0x0
+        
+        if address == self.MAP_SRC:
+            return self.source
+        elif address == self.MAP_DST:
+            return self.destination
+        elif address == self.MAP_LEN:
+            return self.length
+        elif address == self.MAP_CTRL:
+            return self.control_register
+            
+        return 0x0
@@ -0,0 +1,163 @@
+# Copyright (c) 2009 Vicent Marti
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import mmap, struct
+from spym.vm.devices.base import MemoryMappedDevice
+
+class Framebuffer(MemoryMappedDevice):
+    """
+    Bitmap display of 'width' x 'height' pixels mapped at 'base_address',
+    one word per pixel in raw RGBA byte order (i.e. 0xAABBGGRR when 
+    stored as a word). The pixels live in an mmap'd buffer: a shared file
+    when 'image' is given, so an external viewer can poll it, or an 
+    anonymous mapping otherwise. Either way VirtualMachine.memory_view()
+    returns an array aliasing the pixels.
+    
+    The file starts with a HEADER_SIZE byte header: the 'SPFB' magic, the
+    width and height, a frame counter and the dirty rectangle (x0, y0, 
+    x1, y1; exclusive on the bottom right) of the last frame. The device
+    keeps track of the rectangle touched by the guest stores (readable
+    in DIRTY_MIN/DIRTY_MAX as x | y << 16), and publishes it to the 
+    header whenever the guest writes to PRESENT.
+    """
+    MAP_WIDTH = 0xFFFF0040
+    MAP_HEIGHT = 0xFFFF0044
+    MAP_DIRTY_MIN = 0xFFFF0048
+    MAP_DIRTY_MAX = 0xFFFF004C
+    MAP_PRESENT = 0xFFFF0050
+    
+    HEADER_FORMAT = '<4sIIIIIII'
+    HEADER_SIZE = 32
+    MAGIC = b'SPFB'
+    
+    def __init__(self, int_level, width = 320, height = 240, 
+            base_address = 0xFFE00000, image = None):
+        self.int_level = int_level
+        self.width = width
+        self.height = height
+        self.base_address = base_address
+        self.pixels_size = width * height * 4
+        self.frame = 0
+        
+        size = self.HEADER_SIZE + self.pixels_size
+        self.image_file = None
+        
+        if image is None:
+            self.image = mmap.mmap(-1, size)
+        else:
+            self.image_file = open(image, 'w+b')
+            self.image_file.truncate(size)
+            self.image = mmap.mmap(self.image_file.fileno(), size)
+            
+        self._memory_map = tuple(range(base_address, 
+            base_address + self.pixels_size, 4)) + (self.MAP_WIDTH, 
+            self.MAP_HEIGHT, self.MAP_DIRTY_MIN, self.MAP_DIRTY_MAX,
+            self.MAP_PRESENT)
+            
+        self.__resetDirty()
+        self.__writeHeader(0, 0, 0, 0)
+        
+    def __resetDirty(self):
+        self.dirty = [self.width, self.height, -1, -1]
+        
+    def __writeHeader(self, x0, y0, x1, y1):
+        struct.pack_into(self.HEADER_FORMAT, self.image, 0, self.MAGIC,
+            self.width, self.height, self.frame, x0, y0, x1, y1)
+            
+    def present(self):
+        """
+        Publish the dirty rectangle accumulated since the last frame.
+        """
+        x0, y0, x1, y1 = self.dirty
+        if x1 < 0:
+            x0 = y0 = x1 = y1 = 0
+        else:
+            x1, y1 = x1 + 1, y1 + 1
+            
+        self.frame = (self.frame + 1) & 0xFFFFFFFF
+        self.__writeHeader(x0, y0, x1, y1)
+        self.__resetDirty()
+        
+    def getBuffer(self, address, length):
+        offset = address - self.base_address
+        
+        if 0 <= offset and offset + length <= self.pixels_size:
+            start = self.HEADER_SIZE + offset
+            return memoryview(self.image)[start:start + length]
+            
+        return None
+        
+    def close(self):
+        self.image.close()
+        if self.image_file is not None:
+            self.image_file.close()
+        
+    def tick(self):
+        pass
+        
+    def nextEvent(self):
+        return None
+        
+    def advance(self, ticks):
+        pass
+        
+    def write(self, address, size, value):
+        offset = address - self.base_address
+        
+        if 0 <= offset < self.pixels_size:
+            start = self.HEADER_SIZE + offset
+            self.image[start:start + size] = value.to_bytes(size, 'little')
+            
+            y, x = divmod(offset >> 2, self.width)
+            dirty = self.dirty
+            if x < dirty[0]: dirty[0] = x
+            if y < dirty[1]: dirty[1] = y
+            if x > dirty[2]: dirty[2] = x
+            if y > dirty[3]: dirty[3] = y
+            
+        elif address == self.MAP_PRESENT:
+            self.present()
+        
+    def read(self, address, size):
+        offset = address - self.base_address
+        
+        if 0 <= offset < self.pixels_size:
+            start = self.HEADER_SIZE + offset
+            return int.from_bytes(self.image[start:start + size], 'little')
+            
+        if address & 0x3: return 0x0
+        
+        if address == self.MAP_WIDTH:
+            return self.width
+        elif address == self.MAP_HEIGHT:
+            return self.height
+        elif address == self.MAP_DIRTY_MIN:
+            return 0 if self.dirty[2] < 0 else (
+                self.dirty[0] | self.dirty[1] << 16)
+        elif address == self.MAP_DIRTY_MAX:
+            return 0 if self.dirty[2] < 0 else (
+                self.dirty[2] | self.dirty[3] << 16)
+        elif address == self.MAP_PRESENT:
+            return self.frame
+            
+        return 0x0
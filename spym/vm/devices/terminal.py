@@ -22,10 +22,12 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 
-import os, sys, tty
+import os, sys, tty, threading
+from collections import deque
 from spym.vm.exceptions import MIPS_Exception
 from spym.common.utils import _debug
 from spym.common.utils import *
+from spym.vm.devices.base import MemoryMappedDevice
 from select import select
 
 class NotTTYException(Exception): pass
@@ -53,7 +55,7 @@ class TerminalFile:
             c=''
         return c
 
-class TerminalScreen(object):
+class TerminalScreen(MemoryMappedDevice):
     MAP_CTRL = 0xFFFF0008
     MAP_DATA = 0xFFFF000C
     
@@ -61,32 +63,66 @@ class TerminalScreen(object):
     
     SCREEN_WRITE_DELAY = 5
     
-    def __init__(self, interrupt_level, stdout = None, delayed_io = True):
+    def __init__(self, interrupt_level, stdout = None, delayed_io = True,
+            headless = False, capture_limit = None):
+        """
+        A headless screen doesn't write to 'stdout': the printed bytes are
+        captured in memory instead ('captured'), up to 'capture_limit' 
+        bytes; anything printed past the limit is counted in 'dropped'.
+        """
         self.control_register = 0x00000001
         self.data_register = 0x0
         self.delayed_io = delayed_io
         self.interrupt_level = interrupt_level
         self.delay_count = 0
         
+        self.headless = headless
+        self.capture_limit = capture_limit
+        self.captured = bytearray()
+        self.dropped = 0
+        
         self.stdout = stdout or sys.stdout
         
+    def output(self, data):
+        """
+        Display the given bytes (or capture them, when headless).
+        """
+        if not self.headless:
+            self.stdout.write(data.decode('latin-1'))
+            return
+            
+        if self.capture_limit is not None:
+            room = max(0, self.capture_limit - len(self.captured))
+            self.dropped += max(0, len(data) - room)
+            data = data[:room]
+            
+        self.captured += data
+        
     def printCharacter(self):
-        self.stdout.write(chr(self.data_register))
+        self.output(bytes((self.data_register, )))
         self.control_register |= 0x1
         
         if self.control_register & 0x2:
-            raise MIPS_Exception('INT', int_id = self.interrupt_level)
+            self.raiseInterrupt(self.interrupt_level)
 
     def tick(self):
         if self.delayed_io and (self.control_register & 0x1) == 0:
             self.delay_count = self.delay_count - 1
             if self.delay_count == 0:
                 self.printCharacter()
+                
+    def nextEvent(self):
+        if self.delayed_io and (self.control_register & 0x1) == 0:
+            return self.delay_count - 1
+            
+        return None
         
-    def __setitem__(self, addr, data):
-        address, offset, size = breakAddress(addr)
+    def advance(self, ticks):
+        if self.delayed_io and (self.control_register & 0x1) == 0:
+            self.delay_count -= ticks
         
-        if offset: return
+    def write(self, address, size, data):
+        if address & 0x3: return
         
         if address == self.MAP_DATA and self.control_register & 0x1: # ready?
             self.data_register = data & 0xFF
@@ -101,55 +137,261 @@ class TerminalScreen(object):
             self.control_register &= ~0x2
             self.control_register |= data & 0x2
         
-    def __getitem__(self, addr):
-        address, offset, size = breakAddress(addr)
-        
-        if offset: return 0x0
+    def read(self, address, size):
+        if address & 0x3: return 0x0
         
         if address == self.MAP_DATA:
             return self.data_register & 0xFF
         elif address == self.MAP_CTRL:
             return self.control_register & 0xFF
         
-class TerminalKeyboard(object):
+class FIFOScreen(TerminalScreen):
+    """
+    Screen with a transmit FIFO, which can be filled a byte at a time 
+    through DATA (like TerminalScreen) or with bursts: write the address
+    of a buffer to PTR and its length to LEN, and the device copies it 
+    from memory by itself. A length of 0xFFFFFFFF sends a NULL-terminated
+    string instead. LEN reads back the bytes still to be copied.
+    
+    The FIFO is drained 'drain_rate' bytes per tick. CONTROL's ready bit
+    is set while there's room in the FIFO and no burst is in progress;
+    the interrupt (if enabled) is raised every time it becomes set.
+    """
+    MAP_PTR = 0xFFFF0014
+    MAP_LEN = 0xFFFF0018
+    
+    _memory_map = (TerminalScreen.MAP_CTRL, TerminalScreen.MAP_DATA, 
+        MAP_PTR, MAP_LEN)
+        
+    # the kernel prints strings with a single burst
+    _burst_output = True
+    
+    STRING_BURST = 0xFFFFFFFF
+    STRING_CHUNK_SIZE = 256
+    
+    def __init__(self, interrupt_level, stdout = None, fifo_size = 4096,
+            drain_rate = 256, headless = False, capture_limit = None):
+        TerminalScreen.__init__(self, interrupt_level, stdout, False, 
+            headless, capture_limit)
+            
+        self.fifo = bytearray()
+        self.fifo_size = fifo_size
+        self.drain_rate = drain_rate
+        
+        self.burst_pointer = 0x0
+        self.burst_length = 0
+        self.burst_string = False
+        
+    def __updateReady(self):
+        ready = not self.burst_length and len(self.fifo) < self.fifo_size
+        
+        if ready and not self.control_register & 0x1:
+            self.control_register |= 0x1
+            
+            if self.control_register & 0x2:
+                self.raiseInterrupt(self.interrupt_level)
+                
+        elif not ready:
+            self.control_register &= ~0x1
+        
+    def __pullBurst(self):
+        room = self.fifo_size - len(self.fifo)
+        
+        while self.burst_length and room:
+            count = min(room, self.burst_length)
+            if self.burst_string:
+                count = min(count, self.STRING_CHUNK_SIZE)
+                
+            data = self.memory.read_bytes(self.burst_pointer, count, 
+                privileged = True)
+            
+            if self.burst_string and b'\0' in data:
+                data = data[:data.index(b'\0')]
+                self.burst_length = len(data)
+                
+            self.fifo += data
+            self.burst_pointer = (self.burst_pointer + len(data)) & 0xFFFFFFFF
+            self.burst_length -= len(data)
+            room -= len(data)
+            
+    def flush(self):
+        """
+        Output whatever is left in the FIFO (called when the VM stops).
+        """
+        self.__pullBurst()
+        self.output(bytes(self.fifo))
+        del self.fifo[:]
+            
+    def tick(self):
+        if self.fifo:
+            self.output(bytes(self.fifo[:self.drain_rate]))
+            del self.fifo[:self.drain_rate]
+            
+            if self.burst_length:
+                self.__pullBurst()
+                
+            self.__updateReady()
+            
+    def nextEvent(self):
+        # draining the FIFO is only noticed by the guest when it was full
+        if self.burst_length or len(self.fifo) >= self.fifo_size:
+            return 0
+            
+        return None
+        
+    def advance(self, ticks):
+        count = ticks * self.drain_rate
+        self.output(bytes(self.fifo[:count]))
+        del self.fifo[:count]
+        
+    def write(self, address, size, data):
+        if address & 0x3: return
+        
+        if address == self.MAP_DATA and self.control_register & 0x1:
+            self.data_register = data & 0xFF
+            self.fifo.append(self.data_register)
+            
+        elif address == self.MAP_CTRL:
+            self.control_register &= ~0x2
+            self.control_register |= data & 0x2
+            
+        elif address == self.MAP_PTR and not self.burst_length:
+            self.burst_pointer = data
+            
+        elif address == self.MAP_LEN and not self.burst_length:
+            self.burst_length = data
+            self.burst_string = (data == self.STRING_BURST)
+            self.__pullBurst()
+            
+        self.__updateReady()
+        
+    def read(self, address, size):
+        if address & 0x3: return 0x0
+        
+        if address == self.MAP_PTR:
+            return self.burst_pointer
+        elif address == self.MAP_LEN:
+            return self.burst_length
+            
+        return TerminalScreen.read(self, address, size)
+        
+class TerminalKeyboard(MemoryMappedDevice):
     MAP_DATA = 0xFFFF0004
     MAP_CTRL = 0xFFFF0000
     
     _memory_map = (MAP_CTRL, MAP_DATA)
     
-    def __init__(self, interrupt_level, stdin = None):
+    def __init__(self, interrupt_level, stdin = None, input_data = None,
+            read_stdin = False):
+        """
+        Keypresses are taken from an input queue, one each time the 
+        previous one has been read. The queue may be filled with a 
+        prerecorded string ('input_data'), by calling feed() (it's safe
+        to do so from any thread), by a background thread reading a 
+        stream (startReader(), or 'read_stdin' to read 'stdin') or by an
+        asyncio stream (feedFrom()).
+        """
         self.interrupt_level = interrupt_level
         self.control_register = 0x0
         self.data_register = 0x0
         
-#       self.terminal_io = TerminalFile(sys.stdin)
+        self.stdin = stdin or sys.stdin
+        self.input_queue = deque()
+        self.reader_thread = None
+        self.console = None
+        self.console_flushed = False
+        
+        if input_data:
+            self.feed(input_data)
+            
+        if read_stdin:
+            self.startReader()
+            
+    def attachConsole(self, console):
+        """
+        Called by the VM with its console output, which is flushed when
+        the program starts waiting for a key (the first time it finds no
+        key ready after reading one), so prompts show up before it blocks.
+        """
+        self.console = console
+        
+    def feed(self, data):
+        """
+        Queue the given characters (a string or any bytes-like object).
+        """
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+            
+        self.input_queue.extend(bytes(data))
+        
+    def startReader(self, stream = None):
+        """
+        Start a daemon thread queueing everything read from 'stream' 
+        (the keyboard's 'stdin' by default) until it's exhausted.
+        """
+        self.reader_thread = threading.Thread(
+            target = self.__readStream, args = (stream or self.stdin,))
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+        
+    def __readStream(self, stream):
+        # don't wait for a whole chunk when reading from a terminal
+        read = getattr(getattr(stream, 'buffer', None), 'read1', None)
+        
+        while True:
+            data = read(4096) if read else stream.read(4096)
+            if not data:
+                break
+            self.feed(data)
+            
+    async def feedFrom(self, reader, chunk_size = 4096):
+        """
+        Coroutine queueing everything read from an asyncio stream until
+        EOF; run it as a task next to VirtualMachine.run_async().
+        """
+        while True:
+            data = await reader.read(chunk_size)
+            if not data:
+                break
+            self.feed(data)
         
     def tick(self):
+        # a new key is made available (and the interrupt raised) only 
+        # once the last one has been read
+        if self.input_queue and not self.control_register & 0x1:
+            self.data_register = self.input_queue.popleft()
+            self.control_register |= 0x1
+            self.console_flushed = False
+            
+            if self.control_register & 0x2:
+                self.raiseInterrupt(self.interrupt_level)
+        
+    def nextEvent(self):
+        if self.input_queue and not self.control_register & 0x1:
+            return 0
+            
+        # input fed from elsewhere doesn't depend on the ticks
+        return None
+        
+    def advance(self, ticks):
         pass
-        # pass
-        # char_in = self.terminal_io.getch()
-        # 
-        # if char_in:
-        #   self.data_register = ord(char_in)
-        #   self.control_register |= 0x1
-        #   
-        #   if self.control_register & 0x2:
-        #       raise MIPS_Exception('INT', int_id = self.interrupt_level)
-        
-    def __setitem__(self, addr, data):
-        address, offset, size = breakAddress(addr)
-        
-        if offset == 0 and address == self.MAP_CTRL:
+        
+    def write(self, address, size, data):
+        if address == self.MAP_CTRL:
             self.control_register &= ~0x2
             self.control_register |= data & 0x2
         
-    def __getitem__(self, addr):
-        address, offset, size = breakAddress(addr)
-        if offset: return 0x0
+    def read(self, address, size):
+        if address & 0x3: return 0x0
         
         if address == self.MAP_DATA:
             self.control_register &= ~0x1
             return self.data_register & 0xFF
         
         elif address == self.MAP_CTRL:
+            if (not self.control_register & 0x1 and 
+                not self.console_flushed and self.console is not None):
+                self.console.flush()
+                self.console_flushed = True
+                
             return self.control_register & 0xFF
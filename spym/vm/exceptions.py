@@ -36,6 +36,41 @@ EXCEPTION_HANDLER_ADDR  = 0x80000080
 SYSCALL_HANDLER_ADDR    = 0x80001000
 INTERRUPT_HANDLER_ADDR  = 0x80002000
 
+# PRINT_STRING body writing a char at a time through __sys_io_putchar
+PRINT_STRING_PUTCHAR = \
+r"""
+    move $t1, $a0                       # work with $t1, not $a0... we need $a0 for proc calls
+    
+__sys_string_mainloop:
+    lb $a0, 0($t1)                      # load the next char to print (put in $a0 so it's ready for PUTCHAR)
+    beq $a0, $zero, __sys_return        # if the char is NULL, we are done.
+    
+    jal __sys_io_putchar                # we are ready to print the char, do it...
+    addi $t1, $t1, 1                    # increment byte pointer
+    j __sys_string_mainloop             # ..and go back to the start
+"""
+
+# PRINT_STRING body handing the whole string to a FIFO screen in one burst
+PRINT_STRING_BURST = \
+r"""
+    li $t9, 0x%(memmap_io_SCREEN)08X        # load the address for the memory mapped screen
+    
+__sys_string_burst_start:
+    lw $t3, 0($t9)                      # wait until the screen is ready: no
+    andi $t3, $t3, 0x1                  # other burst going on, and room in
+    beq $t3, $zero, __sys_string_burst_start # the FIFO
+    
+    sw $a0, 12($t9)                     # string address in the PTR (+12) register
+    li $t3, -1                          # a LEN (+16) of -1 sends a NULL terminated
+    sw $t3, 16($t9)                     # string
+    
+__sys_string_burst_wait:
+    lw $t3, 0($t9)                      # wait until the whole string has been
+    andi $t3, $t3, 0x1                  # copied, so the buffer can be reused
+    beq $t3, $zero, __sys_string_burst_wait
+    j __sys_return
+"""
+
 SYSCALL_HANDLER = \
 r"""
     .kdata
@@ -102,16 +137,7 @@ __sys_int_mainloop:
 ### PRINT_STRING (syscall code 4) PROCEDURE     ###
 ###################################################
 syscall_print_string:
-    move $t1, $a0                       # work with $t1, not $a0... we need $a0 for proc calls
-    
-__sys_string_mainloop:
-    lb $a0, 0($t1)                      # load the next char to print (put in $a0 so it's ready for PUTCHAR)
-    beq $a0, $zero, __sys_return        # if the char is NULL, we are done.
-    
-    jal __sys_io_putchar                # we are ready to print the char, do it...
-    addi $t1, $t1, 1                    # increment byte pointer
-    j __sys_string_mainloop             # ..and go back to the start
-    
+%(print_string_routine)s    
 ###################################################
 ### READ_INT (syscall code 5) PROCEDURE         ###
 ###################################################
@@ -393,6 +419,59 @@ __start:
 __eoth:
 """
 
+RUNTIME_LIBRARY = \
+r"""
+    .text
+    
+# Runtime library wrapping the memory syscalls which are serviced 
+# natively by the VM. All the functions follow the C calling convention.
+
+    .globl memcpy
+memcpy:                                 # memcpy(dst, src, n) -> dst
+    li $v0, %(memcpy)d
+    syscall
+    jr $ra
+
+    .globl memmove
+memmove:                                # memmove(dst, src, n) -> dst
+    li $v0, %(memmove)d
+    syscall
+    jr $ra
+
+    .globl memset
+memset:                                 # memset(dst, c, n) -> dst
+    li $v0, %(memset)d
+    syscall
+    jr $ra
+
+    .globl strlen
+strlen:                                 # strlen(s) -> length
+    li $v0, %(strlen)d
+    syscall
+    jr $ra
+
+    .globl strcmp
+strcmp:                                 # strcmp(s1, s2) -> <0, 0, >0
+    li $v0, %(strcmp)d
+    syscall
+    jr $ra
+
+    .globl malloc
+malloc:                                 # malloc(size) -> ptr
+    li $v0, %(malloc)d
+    syscall
+    jr $ra
+
+    .globl free
+free:                                   # free(ptr)
+    li $v0, %(free)d
+    syscall
+    jr $ra
+"""
+
+def getRuntimeLibraryText(syscall_codes):
+    return RUNTIME_LIBRARY % syscall_codes
+
 def parseInterruptHandlers(handler_list):
     handler_text = \
     r"""
@@ -414,10 +493,11 @@ def getKernelText(exception_handler = True,
                 syscall_handler = True,
                 interrupt_handlers = [],
                 memmap_screen = 0x0,
-                memmap_keyboard = 0x0):
+                memmap_keyboard = 0x0,
+                screen_burst = False):
                 
     kernel_text = ""
-    int_handler_addresses = ""
+    int_handler_addresses = ".word " + ", ".join(["0x0", ] * 8)
     
     if interrupt_handlers:
         handler_text, int_handler_addresses = \
@@ -437,10 +517,15 @@ def getKernelText(exception_handler = True,
         }
 
     if syscall_handler:
+        print_string = PRINT_STRING_BURST if screen_burst else \
+            PRINT_STRING_PUTCHAR
+            
         kernel_text += SYSCALL_HANDLER % {
             'syscall_handler_address' : SYSCALL_HANDLER_ADDR,
             'memmap_io_SCREEN' : memmap_screen,
-            'memmap_io_KEYBOARD' : memmap_keyboard
+            'memmap_io_KEYBOARD' : memmap_keyboard,
+            'print_string_routine' : print_string % {
+                'memmap_io_SCREEN' : memmap_screen},
         }
         
     return kernel_text
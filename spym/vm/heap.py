@@ -0,0 +1,159 @@
+# Copyright (c) 2009 Vicent Marti
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+class HeapAllocator(object):
+    """
+    Heap of a guest program. Keeps the program break used by the 'sbrk' 
+    syscall, and implements the native malloc/free syscalls on top of it.
+    
+    Small allocations are rounded up to one of the SIZE_CLASSES and 
+    recycled through a free list for each class; larger ones are taken 
+    straight from the break, and reused only for requests of the same 
+    size. All the bookkeeping is kept on the host side, so the guest
+    memory is only touched by the program itself.
+    """
+    HEAP_START = 0x10040000
+    HEAP_LIMIT = 0x7F000000     # leave room for the stack
+    ALIGNMENT = 8
+    
+    SIZE_CLASSES = (8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+    
+    class HeapException(Exception):
+        pass
+    
+    def __init__(self, start, limit = HEAP_LIMIT):
+        start = max(start, self.HEAP_START)
+        start = (start + self.ALIGNMENT - 1) & ~(self.ALIGNMENT - 1)
+        
+        self.start = start
+        self.brk = start
+        self.limit = limit
+        
+        self.bins = dict((size, []) for size in self.SIZE_CLASSES)
+        self.large_bins = {}
+        self.allocated = {}
+        
+        self.stats = {
+            'sbrk_calls' : 0,
+            'malloc_calls' : 0,
+            'free_calls' : 0,
+            'failed_calls' : 0,
+            'reused_blocks' : 0,
+            'bytes_requested' : 0,
+            'bytes_in_use' : 0,
+            'peak_bytes_in_use' : 0,
+        }
+        
+        self.class_stats = dict((size, 0) for size in self.SIZE_CLASSES)
+        self.class_stats['large'] = 0
+        
+    def __moveBreak(self, increment):
+        old_brk = self.brk
+        
+        if not self.start <= self.brk + increment <= self.limit:
+            return None
+            
+        self.brk += increment
+        return old_brk
+        
+    def sbrk(self, increment):
+        """
+        Move the program break by 'increment' bytes (which may be negative).
+        
+            Returns: the old break, or None if it cannot be moved.
+        """
+        self.stats['sbrk_calls'] += 1
+        increment = (increment + 3) & ~0x3
+        
+        old_brk = self.__moveBreak(increment)
+        if old_brk is None:
+            self.stats['failed_calls'] += 1
+            
+        return old_brk
+        
+    def getSizeClass(self, size):
+        for size_class in self.SIZE_CLASSES:
+            if size <= size_class:
+                return size_class
+                
+        return (size + self.ALIGNMENT - 1) & ~(self.ALIGNMENT - 1)
+        
+    def malloc(self, size):
+        """
+        Allocate 'size' bytes.
+        
+            Returns: the address of the new block, or 0 if the heap is 
+            out of space.
+        """
+        self.stats['malloc_calls'] += 1
+        size_class = self.getSizeClass(max(size, 1))
+        
+        if size_class in self.bins:
+            free_list = self.bins[size_class]
+            self.class_stats[size_class] += 1
+        else:
+            free_list = self.large_bins.setdefault(size_class, [])
+            self.class_stats['large'] += 1
+        
+        if free_list:
+            address = free_list.pop()
+            self.stats['reused_blocks'] += 1
+        else:
+            address = self.__moveBreak(size_class)
+            
+            if address is None:
+                self.stats['failed_calls'] += 1
+                return 0
+            
+        self.allocated[address] = size_class
+        
+        self.stats['bytes_requested'] += size
+        self.stats['bytes_in_use'] += size_class
+        self.stats['peak_bytes_in_use'] = max(
+            self.stats['peak_bytes_in_use'], self.stats['bytes_in_use'])
+            
+        return address
+        
+    def free(self, address):
+        """
+        Release a block returned by malloc(). Freeing the NULL pointer
+        is a no-op.
+        """
+        self.stats['free_calls'] += 1
+        
+        if not address:
+            return
+            
+        if address not in self.allocated:
+            self.stats['failed_calls'] += 1
+            raise self.HeapException(
+                "Invalid pointer 0x%08X passed to free()." % address)
+            
+        size_class = self.allocated.pop(address)
+        self.stats['bytes_in_use'] -= size_class
+        
+        if size_class in self.bins:
+            self.bins[size_class].append(address)
+        else:
+            self.large_bins.setdefault(size_class, []).append(address)
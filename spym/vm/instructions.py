@@ -64,6 +64,10 @@ class InstructionAssembler(object):
         self.assembler_register_protected = True
         self.__initMetaData()
         
+        # generated handler factories, shared by all the instructions with
+        # the same operand pattern (keyed by their source code)
+        self._handler_factories = {}
+        
     def __initMetaData(self):
         self.asm_metadata = {}
         for attr in dir(self):
@@ -246,25 +250,81 @@ class InstructionAssembler(object):
                 label = label,
                 label_address = label_address)
         
+        new_instruction.orig_text = instruction.orig_text
+        
         del instruction
         return new_instruction
 
+############################################################
+###### Handler generation
+############################################################
+    # sign extension of a 32 bit register value, as an expression
+    SIGN_EXTEND_32 = '(({0} ^ 0x80000000) - 0x80000000)'
+    
+    def _readRegister(self, variable, register):
+        """
+        Source code reading a register operand: reads of $zero are
+        folded into a constant.
+        """
+        return ('r[%s]' % variable) if register else '0'
+        
+    def _writeRegister(self, variable, register, expression):
+        """
+        Source code storing 'expression' in a register; writes to $zero
+        are dropped altogether.
+        """
+        if not register:
+            return []
+            
+        return ['r[%s] = (%s) & 0xFFFFFFFF' % (variable, expression)]
+    
+    def _makeHandler(self, name, statements, **variables):
+        """
+        Builds the handler '_asm_<name>(b)' running the given lines of
+        source code. The keyword arguments are bound as closure variables,
+        so handlers with the same code (but different registers or 
+        immediates) are all created from a single compiled factory.
+        """
+        statements = list(statements) or ['pass']
+        
+        if any('r[' in line for line in statements):
+            statements.insert(0, 'r = b.std_registers')
+        
+        source = "def _factory(%s):\n" % ', '.join(sorted(variables))
+        source += "    def _asm_%s(b):\n" % name
+        source += ''.join('        %s\n' % line for line in statements)
+        source += "    return _asm_%s\n" % name
+            
+        factory = self._handler_factories.get(source)
+        
+        if factory is None:
+            namespace = {}
+            exec(compile(source, '<%s handler>' % name, 'exec'), 
+                {'MIPS_Exception' : MIPS_Exception}, namespace)
+            factory = self._handler_factories[source] = namespace['_factory']
+            
+        return factory(**variables)
+
 ############################################################
 ###### Templates
 ############################################################
-    def arith_TEMPLATE(self, func_name, args, _lambda_f, overflow = True):
+    def arith_TEMPLATE(self, func_name, args, expression, overflow = True):
         reg_d = self._parseRegister(args[0])
         reg_s = self._parseRegister(args[1])
         reg_t = self._parseRegister(args[2])
         
-        def _asm_arith(b): 
-            result = _lambda_f(b[reg_s], b[reg_t])
-            b[reg_d] = result
+        expression = expression.format(
+            a = self._readRegister('reg_s', reg_s), 
+            b = self._readRegister('reg_t', reg_t))
+        
+        _asm_arith = self._makeHandler(func_name, 
+            self._writeRegister('reg_d', reg_d, expression),
+            reg_d = reg_d, reg_s = reg_s, reg_t = reg_t)
             
         return self.encoder(_asm_arith, func_name, 
             d = reg_d, s = reg_s, t = reg_t)
         
-    def shift_TEMPLATE(self, func_name, args, shift_imm, _lambda_f):
+    def shift_TEMPLATE(self, func_name, args, shift_imm, expression):
         reg_d = self._parseRegister(args[0])
         reg_t = self._parseRegister(args[1])
         reg_s = 0
@@ -272,37 +332,54 @@ class InstructionAssembler(object):
         
         if shift_imm:
             shift = self._parseImmediate(args[2])
-            def _asm_shift(b):
-                b[reg_d] = _lambda_f(b[reg_t], shift)
-                        
+            amount = 'shift'
         else:
+            # only the 5 lowest bits of the register are used
             reg_s = self._parseRegister(args[2])
-            def _asm_shift(b):
-                b[reg_d] = _lambda_f(b[reg_t], b[reg_s])
+            amount = '(%s & 0x1F)' % self._readRegister('reg_s', reg_s)
+            
+        expression = expression.format(
+            a = self._readRegister('reg_t', reg_t), b = amount)
+            
+        _asm_shift = self._makeHandler(func_name,
+            self._writeRegister('reg_d', reg_d, expression),
+            reg_d = reg_d, reg_s = reg_s, reg_t = reg_t, shift = shift)
         
         return self.encoder(_asm_shift, func_name, 
             d = reg_d, t = reg_t, s = reg_s, shift = shift)
         
         
-    def imm_TEMPLATE(self, func_name, args, _lambda_f):         
+    def imm_TEMPLATE(self, func_name, args, expression):         
         reg_t = self._parseRegister(args[0])
         reg_s = self._parseRegister(args[1])
         immediate = self._parseImmediate(args[2])
+        
+        expression = expression.format(
+            a = self._readRegister('reg_s', reg_s), b = 'imm')
 
-        def _asm_imm(b):
-            b[reg_t] = _lambda_f(b[reg_s], immediate)
+        _asm_imm = self._makeHandler(func_name,
+            self._writeRegister('reg_t', reg_t, expression),
+            reg_s = reg_s, reg_t = reg_t, imm = immediate)
             
         return self.encoder(_asm_imm, func_name, 
             s = reg_s, t = reg_t, imm = immediate)
         
-    def branch_TEMPLATE(self, func_name, label, s, t, _lambda_f, link = False):
+    def branch_TEMPLATE(self, func_name, label, s, t, condition, link = False):
         reg_s = self._parseRegister(s)
         reg_t = self._parseRegister(t) if isinstance(t, str) else t
+        
+        # single register branches use 't' for encoding purposes only
+        condition = condition.format(
+            a = self._readRegister('reg_s', reg_s),
+            b = self._readRegister('reg_t', reg_t))
+            
+        statements = ['if %s:' % condition]
+        if link: 
+            statements.append('    r[31] = b.PC + %d' % self.JAL_OFFSET)
+        statements.append('    b.PC = _asm_%s.label_address' % func_name)
 
-        def _asm_branch(b):
-            if _lambda_f(s32(b[reg_s]), s32(b[reg_t])):
-                if link: b[31] = b.PC + self.JAL_OFFSET
-                b.PC = _asm_branch.label_address
+        _asm_branch = self._makeHandler(func_name, statements,
+            reg_s = reg_s, reg_t = reg_t)
     
         return self.encoder.tmpEncoding(_asm_branch, 
             ('branch', func_name, label, reg_s, reg_t))
@@ -311,17 +388,26 @@ class InstructionAssembler(object):
         imm, reg_s = self._parseAddress(args[1])
         reg_t = self._parseRegister(args[0])
         
-        _sign_f = (lambda i, size: i) if unsigned else extsgn
+        address = 'imm + %s' % self._readRegister('reg_s', reg_s)
         
         # load instruction
         if func_name[0] == 'l':
-            def _asm_storeload(b):
-                b[reg_t] = _sign_f(b.memory[(imm + u32(b[reg_s])), size], size)
+            value = 'value'
+            if not unsigned and size < 4:
+                sign_bit = 1 << (size * 8 - 1)
+                value = '(value ^ %d) - %d' % (sign_bit, sign_bit)
+            
+            # the memory is accessed even when loading into $zero
+            statements = ['value = b.memory.read%d(%s)' % (size * 8, address)]
+            statements += self._writeRegister('reg_t', reg_t, value)
                 
         # store instruction
         elif func_name[0] == 's': 
-            def _asm_storeload(b):
-                b.memory[(imm + u32(b[reg_s])), size] = b[reg_t]
+            statements = ['b.memory.write%d(%s, %s)' % (size * 8, address,
+                self._readRegister('reg_t', reg_t))]
+                
+        _asm_storeload = self._makeHandler(func_name, statements,
+            reg_s = reg_s, reg_t = reg_t, imm = imm)
                 
         return self.encoder(_asm_storeload, func_name, 
             t = reg_t, s = reg_s, imm = imm)
@@ -337,12 +423,8 @@ class InstructionAssembler(object):
         """
         add_name = 'addu' if unsigned else 'add'
         
-        if unsigned:
-            add_func = lambda a, b: a + b
-        else:
-            add_func = lambda a, b: s32(a) + s32(b)
-        
-        return self.arith_TEMPLATE(add_name, args, add_func)
+        # signed and unsigned sums are the same modulo 2^32
+        return self.arith_TEMPLATE(add_name, args, '{a} + {b}')
         
     def ins_addu(self, args):
         """
@@ -357,14 +439,14 @@ class InstructionAssembler(object):
             Opcode: 001000
             Syntax: ArithLogI
         """
-        return self.imm_TEMPLATE('addi', args, lambda a, b: s32(a) + b)
+        return self.imm_TEMPLATE('addi', args, '{a} + {b}')
 
     def ins_addiu(self, args):
         """
             Opcode: 001001
             Syntax: ArithLogI
         """
-        return self.imm_TEMPLATE('addiu', args, lambda a, b: u32(a) + b)
+        return self.imm_TEMPLATE('addiu', args, '{a} + {b}')
         
     def ins_div(self, args, unsigned = False):
         """
@@ -379,8 +461,9 @@ class InstructionAssembler(object):
         reg_t = self._parseRegister(args[1])
 
         def _asm_div(b):
+            r = b.std_registers
             try:
-                b.LO, b.HI = divmod(sign(b[reg_s]), sign(b[reg_t]))
+                b.LO, b.HI = divmod(sign(r[reg_s]), sign(r[reg_t]))
             except ZeroDivisionError:
                 raise MIPS_Exception('OVF')
 
@@ -407,7 +490,8 @@ class InstructionAssembler(object):
         reg_t = self._parseRegister(args[1])
     
         def _asm_mult(b):
-            result = sign(b[reg_s]) * sign(b[reg_t])
+            r = b.std_registers
+            result = sign(r[reg_s]) * sign(r[reg_t])
             b.HI = (result >> 32) & 0xFFFFFFFF
             b.LO = result & 0xFFFFFFFF
                 
@@ -428,12 +512,7 @@ class InstructionAssembler(object):
             Syntax: ArithLog
         """
         sub_name = 'subu' if unsigned else 'sub'
-        if unsigned:
-            sub_func = lambda a, b: a - b
-        else:
-            sub_func = lambda a, b: s32(a) - s32(b)
-        
-        return self.arith_TEMPLATE(sub_name, args, sub_func)
+        return self.arith_TEMPLATE(sub_name, args, '{a} - {b}')
 
     def ins_subu(self, args):
         """
@@ -452,14 +531,14 @@ class InstructionAssembler(object):
             Fcode: 100100
             Syntax: ArithLog
         """
-        return self.arith_TEMPLATE('and', args, lambda a, b: a & b)
+        return self.arith_TEMPLATE('and', args, '{a} & {b}')
         
     def ins_andi(self, args):
         """
             Opcode: 001100
             Syntax: ArithLogI
         """
-        return self.imm_TEMPLATE('andi', args, lambda a, b: a & b)
+        return self.imm_TEMPLATE('andi', args, '{a} & {b}')
         
     def ins_nor(self, args):
         """
@@ -467,7 +546,7 @@ class InstructionAssembler(object):
             Fcode: 100111
             Syntax: ArithLog
         """
-        return self.arith_TEMPLATE('nor', args, lambda a, b: ~(a | b))
+        return self.arith_TEMPLATE('nor', args, '~({a} | {b})')
     
     def ins_or(self, args):
         """
@@ -475,14 +554,14 @@ class InstructionAssembler(object):
             Fcode: 100101
             Syntax: ArithLog
         """
-        return self.arith_TEMPLATE('or', args, lambda a, b: a | b)
+        return self.arith_TEMPLATE('or', args, '{a} | {b}')
 
     def ins_ori(self, args):
         """
             Opcode: 001101
             Syntax: ArithLogI
         """
-        return self.imm_TEMPLATE('ori', args, lambda a, b: a | b)
+        return self.imm_TEMPLATE('ori', args, '{a} | {b}')
         
     def ins_xor(self, args):
         """
@@ -490,14 +569,14 @@ class InstructionAssembler(object):
             Fcode: 100110
             Syntax: ArithLog
         """
-        return self.arith_TEMPLATE('xor', args, lambda a, b: a ^ b)
+        return self.arith_TEMPLATE('xor', args, '{a} ^ {b}')
     
     def ins_xori(self, args):
         """
             Opcode: 001110
             Syntax: ArithLogI
         """
-        return self.imm_TEMPLATE('xori', args, lambda a, b: a ^ b)
+        return self.imm_TEMPLATE('xori', args, '{a} ^ {b}')
     
 ############################################################
 ###### Bitwise shifts
@@ -509,7 +588,7 @@ class InstructionAssembler(object):
             Fcode: 000000
             Syntax: Shift
         """
-        return self.shift_TEMPLATE('sll', args, True, lambda a, b: a << b)
+        return self.shift_TEMPLATE('sll', args, True, '{a} << {b}')
     
     def ins_srl(self, args):
         """
@@ -517,7 +596,7 @@ class InstructionAssembler(object):
             Fcode: 000010
             Syntax: Shift
         """
-        return self.shift_TEMPLATE('srl', args, True, lambda a, b: a >> b)
+        return self.shift_TEMPLATE('srl', args, True, '{a} >> {b}')
         
     def ins_sra(self, args):
         """
@@ -525,7 +604,8 @@ class InstructionAssembler(object):
             Fcode: 000011
             Syntax: Shift
         """
-        return self.shift_TEMPLATE('sra', args, True, lambda a, b: s32(a) >> b)
+        return self.shift_TEMPLATE('sra', args, True, 
+            self.SIGN_EXTEND_32.format('{a}') + ' >> {b}')
 
 # shifts with register
     def ins_sllv(self, args):
@@ -534,7 +614,7 @@ class InstructionAssembler(object):
             Fcode: 000100
             Syntax: ShiftV
         """
-        return self.shift_TEMPLATE('sllv', args, False, lambda a, b: a << b)
+        return self.shift_TEMPLATE('sllv', args, False, '{a} << {b}')
 
     def ins_srlv(self, args):
         """
@@ -542,7 +622,7 @@ class InstructionAssembler(object):
             Fcode: 000110
             Syntax: ShiftV
         """
-        return self.shift_TEMPLATE('srlv', args, False, lambda a, b: a >> b)
+        return self.shift_TEMPLATE('srlv', args, False, '{a} >> {b}')
 
     def ins_srav(self, args):
         """
@@ -550,7 +630,8 @@ class InstructionAssembler(object):
             Fcode: 000111
             Syntax: ShiftV
         """
-        return self.shift_TEMPLATE('srav', args, False, lambda a, b: s32(a) >> b)
+        return self.shift_TEMPLATE('srav', args, False, 
+            self.SIGN_EXTEND_32.format('{a}') + ' >> {b}')
         
 
 ############################################################
@@ -562,8 +643,9 @@ class InstructionAssembler(object):
             Fcode: 101010
             Syntax: ArithLog
         """
+        # flipping the sign bit keeps the signed order among unsigned values
         return self.arith_TEMPLATE('slt', args, 
-            lambda a, b: 1 if s32(a) < s32(b) else 0)
+            '({a} ^ 0x80000000) < ({b} ^ 0x80000000)')
         
     def ins_sltu(self, args):
         """
@@ -571,16 +653,14 @@ class InstructionAssembler(object):
             Fcode: 101001
             Syntax: ArithLog
         """
-        return self.arith_TEMPLATE('sltu', args, 
-            lambda a, b: 1 if u32(a) < u32(b) else 0)
+        return self.arith_TEMPLATE('sltu', args, '{a} < {b}')
         
     def ins_sltiu(self, args):
         """
             Opcode: 001001
             Syntax: ArithLogI
         """
-        return self.imm_TEMPLATE('sltiu', args, 
-            lambda a, b: 1 if u32(a) < b else 0)
+        return self.imm_TEMPLATE('sltiu', args, '{a} < {b}')
         
     def ins_slti(self, args):
         """
@@ -589,7 +669,7 @@ class InstructionAssembler(object):
             Syntax: ArithLog
         """
         return self.imm_TEMPLATE('slti', args, 
-            lambda a, b: 1 if s32(a) < b else 0)
+            self.SIGN_EXTEND_32.format('{a}') + ' < {b}')
 
 
 ############################################################
@@ -601,7 +681,7 @@ class InstructionAssembler(object):
             Syntax: Branch
         """
         return self.branch_TEMPLATE('beq', 
-            args[2], args[0], args[1], lambda a, b: a == b)
+            args[2], args[0], args[1], '{a} == {b}')
         
     def ins_bne(self, args):
         """
@@ -609,7 +689,7 @@ class InstructionAssembler(object):
             Syntax: Branch
         """
         return self.branch_TEMPLATE('bne', 
-            args[2], args[0], args[1], lambda a, b: a != b)
+            args[2], args[0], args[1], '{a} != {b}')
         
     def ins_bgez(self, args):
         """
@@ -617,7 +697,7 @@ class InstructionAssembler(object):
             Syntax: BranchZ
         """
         return self.branch_TEMPLATE('bgez', 
-            args[1], args[0], 0x1, lambda a, b: a >= 0)
+            args[1], args[0], 0x1, '{a} < 0x80000000')
         
     def ins_bgezal(self, args):
         """
@@ -625,7 +705,7 @@ class InstructionAssembler(object):
             Syntax: BranchZ
         """
         return self.branch_TEMPLATE('bgezal', 
-            args[1], args[0], 0x11, lambda a, b: a >= 0, True)
+            args[1], args[0], 0x11, '{a} < 0x80000000', True)
         
     def ins_bgtz(self, args):
         """
@@ -633,7 +713,7 @@ class InstructionAssembler(object):
             Syntax: BranchZ
         """
         return self.branch_TEMPLATE('bgtz', 
-            args[1], args[0], 0, lambda a, b: a > 0)
+            args[1], args[0], 0, '0 < {a} < 0x80000000')
         
     def ins_blez(self, args):
         """
@@ -641,7 +721,7 @@ class InstructionAssembler(object):
             Syntax: BranchZ
         """
         return self.branch_TEMPLATE('blez', 
-            args[1], args[0], 0, lambda a, b: a <= 0)
+            args[1], args[0], 0, 'not 0 < {a} < 0x80000000')
 
     def ins_bltz(self, args):
         """
@@ -649,7 +729,7 @@ class InstructionAssembler(object):
             Syntax: BranchZ
         """
         return self.branch_TEMPLATE('bltz', 
-            args[1], args[0], 0, lambda a, b: a < 0)
+            args[1], args[0], 0, '{a} >= 0x80000000')
 
     def ins_bltzal(self, args):
         """
@@ -657,7 +737,7 @@ class InstructionAssembler(object):
             Syntax: BranchZ
         """
         return self.branch_TEMPLATE('bltzal', 
-            args[1], args[0], 0x10, lambda a, b: a < 0, True)
+            args[1], args[0], 0x10, '{a} >= 0x80000000', True)
 
 
 ############################################################
@@ -672,7 +752,7 @@ class InstructionAssembler(object):
         immediate = self._parseImmediate(args[1]) & 0xFFFF
         
         def _asm_lui(b):
-            b[reg_t] = (immediate << 16)
+            if reg_t: b.std_registers[reg_t] = (immediate << 16)
             
         return self.encoder(_asm_lui, 'lui', t = reg_t, imm = immediate)
         
@@ -746,7 +826,7 @@ class InstructionAssembler(object):
         jmp_name = 'jal' if link else 'j'
         
         def _asm_j(b):
-            if link: b[31] = b.PC + self.JAL_OFFSET
+            if link: b.std_registers[31] = b.PC + self.JAL_OFFSET
             b.PC = _asm_j.label_address
 
         return self.encoder.tmpEncoding(_asm_j, ('jump', jmp_name, label))
@@ -762,8 +842,10 @@ class InstructionAssembler(object):
         jr_name = 'jalr' if link else 'jr'
         
         def _asm_jr(b):
-            if link: b[31] = b.PC + self.JAL_OFFSET
-            b.PC = b[reg_s]
+            r = b.std_registers
+            target = r[reg_s]
+            if link: r[31] = b.PC + self.JAL_OFFSET
+            b.PC = target
         
         return self.encoder(_asm_jr, jr_name, s = reg_s)
         
@@ -794,7 +876,7 @@ class InstructionAssembler(object):
         reg_d = self._parseRegister(args[0])
         
         def _asm_mflo(b):
-            b[reg_d] = b.LO
+            if reg_d: b.std_registers[reg_d] = b.LO & 0xFFFFFFFF
         
         return  self.encoder(_asm_mflo, 'mflo', d = reg_d)
         
@@ -807,7 +889,7 @@ class InstructionAssembler(object):
         reg_d = self._parseRegister(args[0])
 
         def _asm_mfhi(b):
-            b[reg_d] = b.HI
+            if reg_d: b.std_registers[reg_d] = b.HI & 0xFFFFFFFF
 
         return self.encoder(_asm_mfhi, 'mfhi', d = reg_d)
         
@@ -820,7 +902,7 @@ class InstructionAssembler(object):
         reg_s = self._parseRegister(args[0])
 
         def _asm_mtlo(b):
-            b.LO = b[reg_s]
+            b.LO = b.std_registers[reg_s]
 
         return self.encoder(_asm_mtlo, 'mtlo', s = reg_s)
         
@@ -833,7 +915,7 @@ class InstructionAssembler(object):
         reg_s = self._parseRegister(args[0])
 
         def _asm_mthi(b):
-            b.HI = b[reg_s]
+            b.HI = b.std_registers[reg_s]
 
         return self.encoder(_asm_mthi, 'mthi', s = reg_s)
         
@@ -862,9 +944,10 @@ class InstructionAssembler(object):
         reg_d = self._parseRegister(args[1])
         
         def _asm_mfc0(b):
-            if b.CP0.getUserBit():
+            if b.CP0.userMode:
                 raise MIPS_Exception('RI')
-            b[reg_t] = b.CP0[reg_d]
+            value = b.CP0[reg_d]
+            if reg_t: b.std_registers[reg_t] = value & 0xFFFFFFFF
         
         return self.encoder(_asm_mfc0, 'mfc0', t = reg_t, d = reg_d)
     
@@ -879,9 +962,9 @@ class InstructionAssembler(object):
         reg_d = self._parseRegister(args[1])
 
         def _asm_mtc0(b):
-            if b.CP0.getUserBit():
+            if b.CP0.userMode:
                 raise MIPS_Exception('RI')
-            b.CP0[reg_d] = b[reg_t]
+            b.CP0[reg_d] = b.std_registers[reg_t]
         
         return self.encoder(_asm_mtc0, 'mtc0', s = 4, d = reg_d, t = reg_t)
         
@@ -893,7 +976,7 @@ class InstructionAssembler(object):
         """
         
         def _asm_rfe(b):
-            if b.CP0.getUserBit():
+            if b.CP0.userMode:
                 raise MIPS_Exception('RI')
             
             lowbits = b.CP0.Status & 0x3F # get the lowest 6 bits
@@ -21,7 +21,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
-import collections
+import collections, struct, bisect
 
 from spym.common.utils import buildLineOfCode
 from spym.vm.core import VirtualMachine
@@ -43,14 +43,23 @@ class MemoryManager(object):
         'L2_code' : ['memory'],
     }
 
+    USER_TEXT   = (0x00400000, 0x10000000 - 1)
+    KERNEL_TEXT = (0x80000000, 0x90000000 - 1)
+
     CODE_FALLBACKS = ['L1_code', 'L1', 'memory']
     DATA_FALLBACKS = ['L1_data', 'L2', 'memory']
     
-    def __init__(self, vm_ptr, block_size, enable_cache, cache_CFG):
+    def __init__(self, vm_ptr, block_size, enable_cache = False,
+                cache_CFG = None, rng = None):
         self.vm = vm_ptr
         self.main_memory = MainMemory(vm_ptr, block_size)
+        
+        # coprocessor 0 of the CPU using this memory; its cached 'userMode'
+        # flag decides whether accesses get the user mode protection checks
+        self.cp0 = None
 
         self.devices_memory_map = {}
+        self.__device_addresses = []
         self.memory_modules = {'memory' : self.main_memory}
        
         if enable_cache:
@@ -60,7 +69,8 @@ class MemoryManager(object):
                         "Invalid Cache identifier name.")
 
                 self.memory_modules[cache_name] = \
-                    MIPSCache_TEMPLATE(cache_name, block_size, **cache_data)
+                    MIPSCache_TEMPLATE(cache_name, block_size,
+                        rng = rng, **cache_data)
 
 
         for (cache_name, cache_instance) in self.memory_modules.items():
@@ -82,69 +92,330 @@ class MemoryManager(object):
                 self.data_access = self.memory_modules[fb]
                 break
     
-    def __getitem__(self, address):
-        if isinstance(address, tuple):
-            address, size = address
-        elif address % 4 == 0:  size = 4
-        elif address % 2 == 0:  size = 2
-        else:                   size = 1
+    STRING_CHUNK_SIZE = 256
+    FILL_CHUNK_SIZE = 4096
+    COPY_CHUNK_SIZE = 4096
+    
+    def __checkRange(self, address, length, user_space):
+        end = address + length - 1
         
-        if  (address % size) or (
-            not self.MIN_ADDRESS <= address <= self.MAX_ADDRESS):
+        if not self.MIN_ADDRESS <= address <= end <= self.MAX_ADDRESS:
             raise MIPS_Exception('ADDRS',
                 badaddr = address,
-                debug_msg = 'Invalid address %08X (%d)' % (address, size))
-        
-        if  self.vm and self.vm.getAccessMode() == 'user' and not (
-            self.USER_READ_SPACE[0] <= address <= self.USER_READ_SPACE[1]):
+                debug_msg = 'Invalid address range %08X (%d)' % 
+                    (address, length))
+                    
+        if  user_space and self.cp0 is not None and self.cp0.userMode and \
+            not (user_space[0] <= address and end <= user_space[1]):
             raise MIPS_Exception('RI', badaddr = address)
             
-        if address & ~0x3 in self.devices_memory_map:
-            device = self.devices_memory_map[address]
-            return device[address, size]
+    def __touchesDevices(self, start, end):
+        if not self.devices_memory_map:
+            return False
+            
+        if len(self.devices_memory_map) != len(self.__device_addresses):
+            self.__device_addresses = sorted(self.devices_memory_map)
+            
+        i = bisect.bisect_left(self.__device_addresses, start & ~0x3)
+        return (i < len(self.__device_addresses) and 
+            self.__device_addresses[i] < end)
             
-        segment = self.main_memory.getSegment(address)
-        if 'text' in segment:
-            return self.code_access[address, size]
+    def syncCaches(self, start, end, invalidate = False):
+        """
+        Write back to main memory all the dirty cache lines holding data 
+        between 'start' and 'end', so it can be accessed directly. If
+        'invalidate' is set, the lines are also dropped from the caches.
+        """
+        for cache_name in sorted(self.memory_modules):
+            if cache_name != 'memory':
+                self.memory_modules[cache_name].syncRange(
+                    start, end, invalidate)
+                    
+    def refreshCaches(self, start, end):
+        """
+        Reload the cache lines holding data between 'start' and 'end' 
+        after main memory has been written directly, so they can be kept
+        instead of dropped.
+        """
+        for cache_name in sorted(self.memory_modules):
+            if cache_name != 'memory':
+                self.memory_modules[cache_name].refreshRange(
+                    start, end, self.main_memory)
+                    
+    def accountBulkAccess(self, address, length, write = False):
+        """
+        Replay a bulk access, once it has been done, on the first level 
+        data cache, leaving its contents and statistics as if it had been
+        done one byte at a time.
+        """
+        if (self.data_access is not self.main_memory and length > 0 and 
+            not self.__touchesDevices(address, address + length)):
+            self.__checkRange(address, length, None)
+            self.data_access.accountBulkAccess(
+                address, address + length, write)
+            
+    def getBuffer(self, address, length):
+        """
+        Returns a writable buffer aliasing 'length' bytes of memory from
+        'address', if a memory mapped device backs that whole range with
+        its own storage (through a 'getBuffer' method), or None otherwise.
+        """
+        for device in set(self.devices_memory_map.values()):
+            if hasattr(device, 'getBuffer'):
+                buffer = device.getBuffer(address, length)
+                if buffer is not None:
+                    return buffer
+                    
+        return None
+        
+    def __deviceRead8(self, address, privileged):
+        device = self.devices_memory_map.get(address & ~0x3)
         
-        if 'data' in segment:
-            return self.data_access[address, size]
+        if device is not None:
+            return device.read(address, 1)
+        elif privileged:
+            return self.__module(address).getData(address, 1)
             
-        return 0x0
+        return self.read8(address)
         
-    def __setitem__(self, address, value):
-        if isinstance(address, tuple):
-            address, size = address
-        elif address % 4 == 0:  size = 4
-        elif address % 2 == 0:  size = 2
-        else:                   size = 1
+    def __deviceWrite8(self, address, value, privileged):
+        device = self.devices_memory_map.get(address & ~0x3)
+        
+        if device is not None:
+            device.write(address, 1, value)
+        elif privileged:
+            self.__module(address).setData(address, 1, value)
+        else:
+            self.write8(address, value)
+            
+    def read_bytes(self, address, length, privileged = False):
+        """
+        Bulk read of 'length' bytes starting at 'address'. Returns a 
+        'bytes' object. Privileged accesses (from the host) skip the 
+        user mode protection checks.
+        """
+        if length <= 0:
+            return b''
+            
+        end = address + length
         
-        if  (address % size) or (
+        if self.__touchesDevices(address, end):
+            return bytes(self.__deviceRead8(a, privileged) & 0xFF 
+                for a in range(address, end))
+            
+        self.__checkRange(address, length, 
+            None if privileged else self.USER_READ_SPACE)
+        self.syncCaches(address, end)
+        return self.main_memory.read_bytes(address, length)
+        
+    def write_bytes(self, address, data, privileged = False):
+        """
+        Bulk store of the bytes in 'data' starting at 'address'.
+        """
+        if not data:
+            return
+            
+        end = address + len(data)
+        
+        if self.__touchesDevices(address, end):
+            for (offset, byte) in enumerate(bytearray(data)):
+                self.__deviceWrite8(address + offset, byte, privileged)
+            return
+            
+        self.__checkRange(address, len(data), 
+            None if privileged else self.USER_WRITE_SPACE)
+        self.syncCaches(address, end)
+        self.main_memory.write_bytes(address, data)
+        self.refreshCaches(address, end)
+        
+    def fill_bytes(self, address, value, length, privileged = False):
+        """
+        Bulk store of 'length' copies of the byte 'value' starting at 
+        'address'. The range is checked before anything is written.
+        """
+        if length <= 0:
+            return
+            
+        end = address + length
+        self.__checkRange(address, length, None)
+        
+        if self.__touchesDevices(address, end):
+            for fill_address in range(address, end):
+                self.__deviceWrite8(fill_address, value & 0xFF, privileged)
+            return
+            
+        self.__checkRange(address, length, 
+            None if privileged else self.USER_WRITE_SPACE)
+        self.syncCaches(address, end)
+        
+        chunk = bytes((value & 0xFF, )) * min(length, self.FILL_CHUNK_SIZE)
+        start = address
+        
+        while address < end:
+            count = min(len(chunk), end - address)
+            self.main_memory.write_bytes(address, chunk[:count])
+            address += count
+            
+        self.refreshCaches(start, end)
+        
+    def copy_bytes(self, destination, source, length, privileged = False,
+            direct = False):
+        """
+        Bulk copy of 'length' bytes from 'source' to 'destination', moved
+        in chunks of at most COPY_CHUNK_SIZE bytes. Overlapping areas are
+        handled like memmove(). Both ranges are checked before anything 
+        is written.
+        
+        'direct' copies access main memory only, skipping the caches; 
+        they cannot reach memory mapped devices.
+        """
+        if length <= 0:
+            return
+            
+        for (address, user_space) in (
+                (source, self.USER_READ_SPACE), 
+                (destination, self.USER_WRITE_SPACE)):
+            touches_devices = self.__touchesDevices(address, address + length)
+            
+            if direct and touches_devices:
+                raise MIPS_Exception('DBUS', 
+                    badaddr = address,
+                    debug_msg = 'Direct access to devices %08X (%d)' % 
+                        (address, length))
+                        
+            if privileged or touches_devices:
+                user_space = None
+            self.__checkRange(address, length, user_space)
+            
+        if direct:
+            read = self.main_memory.read_bytes
+            write = self.main_memory.write_bytes
+        else:
+            read = lambda address, count: \
+                self.read_bytes(address, count, privileged)
+            write = lambda address, data: \
+                self.write_bytes(address, data, privileged)
+            
+        offsets = range(0, length, self.COPY_CHUNK_SIZE)
+        
+        # copy backwards when the destination overlaps the end of the 
+        # source, so no chunk is overwritten before it's read
+        if source < destination < source + length:
+            offsets = reversed(offsets)
+            
+        for offset in offsets:
+            count = min(self.COPY_CHUNK_SIZE, length - offset)
+            write(destination + offset, read(source + offset, count))
+        
+    def readString(self, address, limit = None):
+        """
+        Bulk read of a NULL-terminated string starting at 'address'. The
+        terminating NULL is not included in the result. At most 'limit'
+        bytes are returned, if given.
+        """
+        output = bytearray()
+        
+        while limit is None or len(output) < limit:
+            chunk = self.STRING_CHUNK_SIZE - (address % self.STRING_CHUNK_SIZE)
+            
+            if limit is not None:
+                chunk = min(chunk, limit - len(output))
+                
+            chunk = min(chunk, self.MAX_ADDRESS - address + 1)
+            data = self.read_bytes(address, chunk)
+            
+            nullchar = data.find(b'\0')
+            if nullchar != -1:
+                output += data[:nullchar]
+                break
+                
+            output += data
+            address += chunk
+            
+            if address > self.MAX_ADDRESS:
+                break
+            
+        return bytes(output)
+    
+    def __module(self, address):
+        if  (self.USER_TEXT[0] <= address <= self.USER_TEXT[1] or 
+            self.KERNEL_TEXT[0] <= address <= self.KERNEL_TEXT[1]):
+            return self.code_access
+            
+        return self.data_access
+        
+    def __read(self, address, size):
+        if  (address & (size - 1)) or (
             not self.MIN_ADDRESS <= address <= self.MAX_ADDRESS):
+            raise MIPS_Exception('ADDRS',
+                badaddr = address,
+                debug_msg = 'Invalid address %08X (%d)' % (address, size))
+        
+        # memory mapped devices are accessible from user mode
+        if self.devices_memory_map and (
+            address & ~0x3) in self.devices_memory_map:
+            return self.devices_memory_map[address & ~0x3].read(address, size)
+            
+        if  self.cp0 is not None and self.cp0.userMode and not (
+            self.USER_READ_SPACE[0] <= address <= self.USER_READ_SPACE[1]):
+            raise MIPS_Exception('RI', badaddr = address)
             
+        return self.__module(address).getData(address, size)
+        
+    def __write(self, address, size, value):
+        if  (address & (size - 1)) or (
+            not self.MIN_ADDRESS <= address <= self.MAX_ADDRESS):
             raise MIPS_Exception('ADDRS',
                 badaddr = address,
                 debug_msg = 'Invalid address %08X (%d)' % (address, size))
         
-        if  self.vm and self.vm.getAccessMode() == 'user' and not (
+        if self.devices_memory_map and (
+            address & ~0x3) in self.devices_memory_map:
+            self.devices_memory_map[address & ~0x3].write(address, size, value)
+            return
+            
+        if  self.cp0 is not None and self.cp0.userMode and not (
             self.USER_WRITE_SPACE[0] <= address <= self.USER_WRITE_SPACE[1]):
             
             raise MIPS_Exception('RI',
                 badaddr = address,
                 debug_msg = 'Attempted to write in protected space.')
-        
-        if address & ~0x3 in self.devices_memory_map:
-            device = self.devices_memory_map[address]
-            device[address, size] = value
-            return
-
-        segment = self.main_memory.getSegment(address)
-        if 'text' in segment:
-            self.code_access[address, size] = value
 
-        if 'data' in segment:
-            self.data_access[address, size] = value
+        self.__module(address).setData(address, size, value)
+        
+    def read8(self, address):
+        return self.__read(address, 1)
+        
+    def read16(self, address):
+        return self.__read(address, 2)
+        
+    def read32(self, address):
+        return self.__read(address, 4)
+        
+    def write8(self, address, value):
+        self.__write(address, 1, value)
+        
+    def write16(self, address, value):
+        self.__write(address, 2, value)
+        
+    def write32(self, address, value):
+        self.__write(address, 4, value)
+        
+    def __accessSize(self, address):
+        if isinstance(address, tuple):
+            return address
             
+        if address % 4 == 0:    return (address, 4)
+        if address % 2 == 0:    return (address, 2)
+        return (address, 1)
+    
+    def __getitem__(self, address):
+        address, size = self.__accessSize(address)
+        return self.__read(address, size)
+        
+    def __setitem__(self, address, value):
+        address, size = self.__accessSize(address)
+        self.__write(address, size, value)
 
 class MainMemory(object):
     SEGMENT_DATA = {
@@ -187,11 +458,33 @@ class MainMemory(object):
                     
                 self.contents[word_offset] |=  \
                     ((value & self.SIZE_MASKS[size]) << (offset * 8))
+                    
+        def getBytes(self, start = 0, end = None):
+            words = [word & 0xFFFFFFFF for word in self.contents]
+            raw = struct.pack('<%dI' % len(words), *words)
+            return raw[start:end]
+            
+        def setBytes(self, offset, data):
+            first_word = offset // 4
+            last_word = (offset + len(data) + 3) // 4
+            count = last_word - first_word
+            
+            words = [word & 0xFFFFFFFF for word in 
+                self.contents[first_word:last_word]]
+            
+            raw = bytearray(struct.pack('<%dI' % count, *words))
+            start = offset - first_word * 4
+            raw[start:start + len(data)] = data
+            
+            self.contents[first_word:last_word] = \
+                struct.unpack('<%dI' % count, raw)
     
     def __init__(self, vm, blockSize):
         self.BLOCK_SIZE = blockSize
         self.vm = vm
         self.memory = {}
+        self.reserved = []
+        self.segmentCursors = {}
         
     def __allocate(self, address):
         self.memory[address // self.BLOCK_SIZE] = \
@@ -200,44 +493,139 @@ class MainMemory(object):
     def __contains__(self, address):
         return (address // self.BLOCK_SIZE) in self.memory
         
-    def __getData(self, address, size):
-        if not self.__contains__(address):
+    def getData(self, address, size):
+        block = self.memory.get(address // self.BLOCK_SIZE)
+        
+        if block is None:
             return 0x0
             
-        block = self.memory[address // self.BLOCK_SIZE]
         return block.getData(size, address % self.BLOCK_SIZE)
         
+    def setData(self, address, size, data):
+        block = self.memory.get(address // self.BLOCK_SIZE)
         
-    def __setData(self, address, size, data):
-        if not self.__contains__(address):
+        if block is None:
             self.__allocate(address)
+            block = self.memory[address // self.BLOCK_SIZE]
             
-        destinationBlock = self.memory[address // self.BLOCK_SIZE]
+        block.setData(size, address % self.BLOCK_SIZE, data)
         
-        if hasattr(data, '_vm_asm') and 'text' not in self.getSegment(address):
-            raise AssemblyParser.ParserException(
-                "Cannot assemble instructions in data-only segments.")
+    def read8(self, address):
+        return self.getData(address, 1)
         
-        block = self.memory[address // self.BLOCK_SIZE]
-        block.setData(size, address % self.BLOCK_SIZE, data)
+    def read16(self, address):
+        return self.getData(address, 2)
+        
+    def read32(self, address):
+        return self.getData(address, 4)
+        
+    def write8(self, address, data):
+        self.setData(address, 1, data)
+        
+    def write16(self, address, data):
+        self.setData(address, 2, data)
+        
+    def write32(self, address, data):
+        self.setData(address, 4, data)
         
     def getWord(self, address):
-        return self.__getData(address, 4)
+        return self.getData(address, 4)
     
     def getHalf(self, address):
-        return self.__getData(address, 2)
+        return self.getData(address, 2)
         
     def getByte(self, address):
-        return self.__getData(address, 1)
+        return self.getData(address, 1)
         
     def setWord(self, address, data):
-        return self.__setData(address, 4, data)
+        return self.setData(address, 4, data)
     
     def setHalf(self, address, data):
-        return self.__setData(address, 2, data)
+        return self.setData(address, 2, data)
             
     def setByte(self, address, data):
-        return self.__setData(address, 1, data)
+        return self.setData(address, 1, data)
+        
+    def read_bytes(self, address, length):
+        output = bytearray()
+        end = address + length
+        
+        while address < end:
+            block_id, offset = divmod(address, self.BLOCK_SIZE)
+            count = min(self.BLOCK_SIZE - offset, end - address)
+            
+            if block_id in self.memory:
+                output += self.memory[block_id].getBytes(
+                    offset, offset + count)
+            else:
+                output += bytes(count)
+                
+            address += count
+            
+        return bytes(output)
+        
+    def write_bytes(self, address, data):
+        data = memoryview(data).cast('B')
+        end = address + len(data)
+        position = 0
+        
+        while address < end:
+            offset = address % self.BLOCK_SIZE
+            count = min(self.BLOCK_SIZE - offset, end - address)
+            
+            if not self.__contains__(address):
+                self.__allocate(address)
+                
+            block = self.memory[address // self.BLOCK_SIZE]
+            block.setBytes(offset, data[position:position + count])
+            
+            address += count
+            position += count
+        
+    def getSegmentEnd(self, segment, limit = None):
+        """
+        Returns the address right after the highest allocated block in 
+        the given segment, or the start of the segment if it's empty. 
+        Blocks above 'limit' are ignored.
+        """
+        seg_start, seg_end = self.SEGMENT_DATA[segment]
+        if limit is not None:
+            seg_end = min(seg_end, limit - 1)
+            
+        end = seg_start
+        for block_id in self.memory:
+            address = block_id * self.BLOCK_SIZE
+            if seg_start <= address <= seg_end:
+                end = max(end, address + self.BLOCK_SIZE)
+                
+        for (start, reserved_end) in self.reserved:
+            if seg_start <= start <= seg_end:
+                end = max(end, reserved_end)
+                
+        return end
+        
+    def getAllocatedBytes(self):
+        return len(self.memory) * self.BLOCK_SIZE
+        
+    def getUnallocatedBytes(self, address, length):
+        """
+        Returns the size of the blocks that storing 'length' bytes from 
+        'address' would allocate.
+        """
+        if length <= 0:
+            return 0
+            
+        first = address // self.BLOCK_SIZE
+        last = (address + length - 1) // self.BLOCK_SIZE
+        
+        if last - first + 1 <= len(self.memory):
+            allocated = sum(1 for block_id in range(first, last + 1) 
+                if block_id in self.memory)
+        else:
+            allocated = sum(1 for block_id in self.memory 
+                if first <= block_id <= last)
+                
+        return (last - first + 1 - allocated) * self.BLOCK_SIZE
         
     def getSegment(self, address):
         for (seg_name, seg_bounds) in self.SEGMENT_DATA.items():
@@ -246,15 +634,39 @@ class MainMemory(object):
 
         return None
         
-    def getNextFreeBlock(self, address):
-        while address in self:
-            block = self.memory[address // self.BLOCK_SIZE]
-            if not any(block.contents):
-                return address
-            
-            address += self.BLOCK_SIZE
+    def reserve(self, address, length):
+        """
+        Reserve a zero-filled area of 'length' bytes. Nothing is allocated
+        right away: unallocated memory already reads as zeros, and blocks
+        are materialized on their first write. The range is remembered so
+        it's never handed out again as free space.
+        """
+        if length > 0:
+            bisect.insort(self.reserved, (address, address + length))
             
-        return address
+    def getReservedEnd(self, address):
+        """
+        Returns the end of the reserved area containing 'address', or None
+        if the address is not reserved.
+        """
+        i = bisect.bisect_right(self.reserved, (address, float('inf')))
+        
+        for (start, end) in reversed(self.reserved[:i]):
+            if start <= address < end:
+                return end
+                
+        return None
+        
+    def getSegmentCursor(self, segment):
+        """
+        Returns the first address after everything assembled so far
+        in the given segment (its high-water mark).
+        """
+        return self.segmentCursors.get(segment, self.SEGMENT_DATA[segment][0])
+        
+    def setSegmentCursor(self, segment, address):
+        if address > self.getSegmentCursor(segment):
+            self.segmentCursors[segment] = address
         
     def getInstructionData(self):
         for (address, block) in self.memory.items():
@@ -266,14 +678,21 @@ class MainMemory(object):
     def clear(self):
         del(self.memory)
         self.memory = {}
+        self.reserved = []
+        self.segmentCursors = {}
     
     def __getitem__(self, address_tuple):
         address, size = address_tuple
-        return self.__getData(address, size)
+        return self.getData(address, size)
         
     def __setitem__(self, address_tuple, data):
         address, size = address_tuple
-        self.__setData(address, size, data)
+        
+        if hasattr(data, '_vm_asm') and 'text' not in self.getSegment(address):
+            raise AssemblyParser.ParserException(
+                "Cannot assemble instructions in data-only segments.")
+                
+        self.setData(address, size, data)
         
     def __str_Segments(self, segments):
         segments.sort()
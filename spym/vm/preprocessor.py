@@ -21,6 +21,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import os.path, mmap
 from spym.common.utils import _debug
 
 class AssemblyPreprocessor(object):
@@ -33,7 +34,7 @@ class AssemblyPreprocessor(object):
         self.memory = memory
         
         self.align = None
-        self.lastSegmentAddr = {}
+        self.segment = None
         
     def __call__(self, identifier, args, cur_address):
         func = 'dir_' + identifier[1:]
@@ -54,17 +55,13 @@ class AssemblyPreprocessor(object):
             raise self.PreprocessorException(
                 "Wrong parameter count in preprocessor directive.")
         
-    def __segmentChange(self, args, segment):
+    def __segmentChange(self, args, segment, cur_address):
         self.__checkArgs(args, _max = 1)
         self.align = None
+        self.closeSegment(cur_address)
         
         if not args:
-            if segment in self.lastSegmentAddr:
-                block_start = self.lastSegmentAddr[segment]
-            else:
-                block_start = self.memory.SEGMENT_DATA[segment][0]
-                
-            address = self.memory.getNextFreeBlock(block_start)
+            address = self.memory.getSegmentCursor(segment)
         else:   
             try:
                 address = int(args[0], 16)
@@ -77,9 +74,18 @@ class AssemblyPreprocessor(object):
                     "Address %X doesn't belong to the %s segment." % 
                         (address, segment))
         
-        self.lastSegmentAddr[segment] = address
+        self.segment = segment
         return (address, address)
         
+    def closeSegment(self, cur_address):
+        """
+        Records how far the current segment has been filled, so the
+        next switch into it continues from there.
+        """
+        if self.segment is not None:
+            self.memory.setSegmentCursor(self.segment, cur_address)
+            self.segment = None
+        
     def __assembleString(self, string, address, nullterm):
         if not string[0] == '"' or not string[-1] == '"':
             raise self.PreprocessorException("Malformed string constant.")
@@ -100,33 +106,55 @@ class AssemblyPreprocessor(object):
             
         return (original_address, address)
         
-    def __assembleData(self, data, size, address):
-        if self.align is None:
-            mod = address % size
-        else:
-            mod = address % (2 ** self.align)
+    def __parseDataValue(self, d):
+        if len(d) == 3 and d[0] == "'" and d[2] == "'":
+            return ord(d[1])
+            
+        if d in self.parser.local_labels:
+            return self.parser.local_labels[d]
             
-        address += (4 - mod) if mod else 0
-        original_address = address
-
         try:
-            for d in data:
-                if not d: continue
-                if len(d) == 3 and d[0] == "'" and d[2] == "'":
-                    d = ord(d[1])
-                elif d in self.parser.local_labels:
-                    d = self.parser.local_labels[d]
-                else:
-                    d = int(d, 0)
-                    
-                self.memory[address, size] = d
-                address += size
-        
+            return int(d, 0)
         except ValueError:
             raise self.PreprocessorException(
                 "Invalid integer constants for data assembly: '%s'" % d)
+                
+    def __assembleData(self, data, size, address):
+        """
+        Assembles a whole list of data constants at once; the values
+        are packed into a single little-endian buffer which is written
+        to memory in one go. A constant may be followed by ':count' to
+        repeat it several times (e.g. '.word 0:256').
+        """
+        alignment = size if self.align is None else 2 ** self.align
+        mod = address % alignment
             
-        return (original_address, address)
+        address += (alignment - mod) if mod else 0
+        mask = (1 << (size * 8)) - 1
+        chunks = []
+
+        for d in data:
+            if not d: continue
+            count = 1
+            
+            if ':' in d and not (len(d) == 3 and d[0] == "'"):
+                d, count = d.rsplit(':', 1)
+                
+                try:
+                    count = int(count, 0)
+                except ValueError:
+                    count = -1
+                    
+                if count < 0:
+                    raise self.PreprocessorException(
+                        "Invalid repetition count for data assembly.")
+                        
+            value = self.__parseDataValue(d) & mask
+            chunks.append(value.to_bytes(size, 'little') * count)
+            
+        raw = b''.join(chunks)
+        self.memory.write_bytes(address, raw)
+        return (address, address + len(raw))
         
     def dir_set(self, args, cur_address):
         self.__checkArgs(args, _count = 1)
@@ -137,16 +165,16 @@ class AssemblyPreprocessor(object):
             self.parser.instruction_assembler.assembly_regiser_protected = True
         
     def dir_data(self, args, cur_address):
-        return self.__segmentChange(args, 'user_data')
+        return self.__segmentChange(args, 'user_data', cur_address)
     
     def dir_text(self, args, cur_address):
-        return self.__segmentChange(args, 'user_text')
+        return self.__segmentChange(args, 'user_text', cur_address)
         
     def dir_kdata(self, args, cur_address):
-        return self.__segmentChange(args, 'kernel_data')
+        return self.__segmentChange(args, 'kernel_data', cur_address)
             
     def dir_ktext(self, args, cur_address):
-        return self.__segmentChange(args, 'kernel_text')
+        return self.__segmentChange(args, 'kernel_text', cur_address)
         
     def dir_globl(self, args, cur_address):
         self.__checkArgs(args, _count = 1)
@@ -192,5 +220,63 @@ class AssemblyPreprocessor(object):
             space_count = int(args[0], 0)
         except ValueError:
             raise self.PreprocessorException("Invalid space value.")
+            
+        if space_count < 0:
+            raise self.PreprocessorException("Invalid space value.")
 
-        return self.__assembleData(['0',] * space_count, 1, cur_address)
+        # zero-filled areas are only reserved; memory gets allocated 
+        # when they are first written
+        self.memory.reserve(cur_address, space_count)
+        return (cur_address, cur_address + space_count)
+        
+    def dir_incbin(self, args, cur_address):
+        """
+        .incbin "file"[, offset[, length]]
+        
+        Copies the raw contents of a host file into memory. Relative
+        paths are resolved from the directory of the source file.
+        """
+        self.__checkArgs(args, _min = 1, _max = 3)
+        filename = args[0]
+        
+        if len(filename) < 2 or filename[0] != '"' or filename[-1] != '"':
+            raise self.PreprocessorException("Malformed file name.")
+            
+        filename = os.path.join(self.parser.sourceDirectory, filename[1:-1])
+        
+        offset, length = 0, None
+        
+        try:
+            if len(args) > 1:
+                offset = int(args[1], 0)
+                
+            if len(args) > 2:
+                length = int(args[2], 0)
+        except ValueError:
+            raise self.PreprocessorException(
+                "Invalid offset or length for binary include.")
+                
+        try:
+            with open(filename, 'rb') as bin_file:
+                file_size = os.fstat(bin_file.fileno()).st_size
+                
+                if length is None:
+                    length = file_size - offset
+                    
+                if offset < 0 or length < 0 or offset + length > file_size:
+                    raise self.PreprocessorException(
+                        "Binary include out of the bounds of '%s'." % 
+                            filename)
+                            
+                if length:
+                    with mmap.mmap(bin_file.fileno(), 0, 
+                        access = mmap.ACCESS_READ) as contents:
+                        with memoryview(contents) as view:
+                            self.memory.write_bytes(cur_address, 
+                                view[offset:offset + length])
+                        
+        except (IOError, OSError) as e:
+            raise self.PreprocessorException(
+                "Cannot include binary file '%s': %s" % (filename, e))
+            
+        return (cur_address, cur_address + length)
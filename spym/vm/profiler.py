@@ -0,0 +1,173 @@
+# Copyright (c) 2009 Vicent Marti
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+from array import array
+
+class ExecutionProfiler(object):
+    """
+    Execution counters for a loaded program: one slot per word of the 
+    user and kernel text segments, incremented every time the instruction
+    at that address runs. Reports are built from the counters afterwards:
+    the hottest source lines, loops (ranges closed by a backward branch 
+    or jump) and opcodes.
+    """
+    SEGMENTS = ('user_text', 'kernel_text')
+    
+    # back-edges closing a loop; linking branches and jumps are calls
+    LOOP_INSTRUCTIONS = ('beq', 'bne', 'bgez', 'bgtz', 'blez', 'bltz', 'j')
+    
+    def __init__(self, main_memory):
+        self.main_memory = main_memory
+        self.regions = []
+        
+        for segment in self.SEGMENTS:
+            start = main_memory.SEGMENT_DATA[segment][0]
+            end = main_memory.getSegmentEnd(segment)
+            self.regions.append(
+                (start, end, array('Q', [0, ]) * ((end - start) // 4)))
+                
+    def record(self, address):
+        for (start, end, counters) in self.regions:
+            if start <= address < end:
+                counters[(address - start) >> 2] += 1
+                return
+                
+    def recordLoop(self, start, end, iterations):
+        """
+        Account 'iterations' runs of every instruction from 'start' to
+        'end' (both included) at once.
+        """
+        for address in range(start, end + 4, 4):
+            for (region_start, region_end, counters) in self.regions:
+                if region_start <= address < region_end:
+                    counters[(address - region_start) >> 2] += iterations
+                    
+    def counts(self):
+        """
+        Yields (address, count) for all the instructions which have run.
+        """
+        for (start, end, counters) in self.regions:
+            for (index, count) in enumerate(counters):
+                if count:
+                    yield (start + index * 4, count)
+                    
+    def getCount(self, address):
+        for (start, end, counters) in self.regions:
+            if start <= address < end:
+                return counters[(address - start) >> 2]
+        return 0
+        
+    def getTotal(self):
+        return sum(sum(counters) for (start, end, counters) in self.regions)
+        
+    def __instruction(self, address):
+        instruction = self.main_memory.getData(address, 4)
+        return instruction if hasattr(instruction, '_vm_asm') else None
+        
+    def hotLines(self, top = 10):
+        """
+        Returns the 'top' source lines with more instructions executed, as
+        (address, instructions, text) tuples. The instructions a 
+        pseudoinstruction expands to are counted in the line it comes from.
+        """
+        lines = {}
+        
+        for (start, end, counters) in self.regions:
+            line = None
+            for address in range(start, end, 4):
+                instruction = self.__instruction(address)
+                if instruction is None:
+                    line = None
+                    continue
+                    
+                if instruction.orig_text or line is None:
+                    line = (address, 
+                        instruction.orig_text or instruction.text)
+                        
+                count = counters[(address - start) >> 2]
+                if count:
+                    lines[line] = lines.get(line, 0) + count
+                
+        hottest = sorted(lines.items(), key = lambda l: (-l[1], l[0][0]))
+        return [(address, count, text) 
+            for ((address, text), count) in hottest[:top]]
+            
+    def hotLoops(self, top = 10):
+        """
+        Returns the 'top' loops with more instructions executed inside
+        them, as (start address, end address, instructions) tuples.
+        """
+        loops = []
+        
+        for (address, count) in self.counts():
+            instruction = self.__instruction(address)
+            
+            if (instruction is None or 
+                instruction.name not in self.LOOP_INSTRUCTIONS):
+                continue
+                
+            target = instruction._vm_asm.label_address
+            if 0 < target <= address:
+                executed = sum(self.getCount(a) 
+                    for a in range(target, address + 4, 4))
+                loops.append((target, address, executed))
+                
+        loops.sort(key = lambda l: (-l[2], l[0]))
+        return loops[:top]
+        
+    def opcodeMix(self):
+        """
+        Returns a dictionary with the number of executions of each opcode,
+        by mnemonic.
+        """
+        mix = {}
+        
+        for (address, count) in self.counts():
+            instruction = self.__instruction(address)
+            if instruction is not None:
+                name = instruction.name
+                mix[name] = mix.get(name, 0) + count
+                
+        return mix
+        
+    def report(self, top = 10):
+        total = self.getTotal() or 1
+        output = "Profile: %d instructions executed\n" % self.getTotal()
+        
+        output += "\nHottest lines:\n"
+        for (address, count, text) in self.hotLines(top):
+            output += "  [0x%08X] %10d %6.2f%%  %s\n" % (address, count,
+                100.0 * count / total, text.strip())
+                
+        output += "\nHottest loops:\n"
+        for (start, end, count) in self.hotLoops(top):
+            output += "  [0x%08X - 0x%08X] %10d %6.2f%%\n" % (start, end,
+                count, 100.0 * count / total)
+                
+        output += "\nOpcodes:\n"
+        mix = sorted(self.opcodeMix().items(), key = lambda o: (-o[1], o[0]))
+        for (name, count) in mix[:top]:
+            output += "  %-10s %10d %6.2f%%\n" % (name, count,
+                100.0 * count / total)
+                
+        return output
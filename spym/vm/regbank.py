@@ -43,6 +43,9 @@ class RegisterBank(object):
         
     class CoprocessorZero(object):
         STATUS_USER_MASK = 0x0002
+        STATUS_INT_ENABLE = 0x0001
+        STATUS_INT_MASK = 0xFC00
+        TIMER_INTERRUPT = 5
         REGISTER_NAMES = {
             8   : 'BadVAddr',
             9   : 'Count',
@@ -54,16 +57,94 @@ class RegisterBank(object):
         }
         
         def __init__(self):
+            self.clock = lambda: 0
+            self.scheduleTimer = None
+            self._count_base = 0
+            self._compare = 0x0
+            
             self.BadVAddr   = 0x0
-            self.Count      = 0x0
-            self.Compare    = 0x0
             self.Status     = 0x0
             self.Cause      = 0x0
             self.EPC        = 0x0
             self.Config     = 0x0
+            self.Count      = 0x0
+            self.Compare    = 0x0
+            
+        @property
+        def Status(self):
+            return self._status
+            
+        @Status.setter
+        def Status(self, value):
+            """
+            The current mode is cached as a boolean every time Status is
+            written (mtc0, rfe and exception entry all go through here),
+            so the memory accesses can check it for free. So is the mask
+            of deliverable interrupts: the enabled hardware interrupt 
+            bits, or none when interrupts are globally disabled.
+            """
+            self._status = value
+            self.userMode = bool(value & self.STATUS_USER_MASK)
+            self.interruptMask = (value & self.STATUS_INT_MASK 
+                if value & self.STATUS_INT_ENABLE else 0)
                     
+        @property
+        def Count(self):
+            return (self.clock() - self._count_base) & 0xFFFFFFFF
+            
+        @Count.setter
+        def Count(self, value):
+            """
+            Count isn't incremented on every step: it's derived from the 
+            clock (the number of instructions retired by the VM) and the 
+            clock value at which it was last written.
+            """
+            self._count_base = self.clock() - value
+            self.__scheduleCompare()
+            
+        @property
+        def Compare(self):
+            return self._compare
+            
+        @Compare.setter
+        def Compare(self, value):
+            """
+            Writing Compare acknowledges the timer interrupt, and schedules
+            the next one for the moment Count reaches the new value.
+            """
+            self._compare = value
+            self.Cause &= ~(1 << (10 + self.TIMER_INTERRUPT))
+            self.__scheduleCompare()
+            
+        def __scheduleCompare(self):
+            remaining = ((self._compare - self.Count - 1) & 0xFFFFFFFF) + 1
+            self.compareDeadline = self.clock() + remaining
+            
+            if self.scheduleTimer is not None:
+                self.scheduleTimer(self.compareDeadline)
+                
+        def attachClock(self, clock, scheduleTimer):
+            """
+            Drive Count with 'clock', a function returning the global
+            instruction counter. 'scheduleTimer' is called with the clock
+            value of every new Count/Compare match.
+            """
+            count = self.Count
+            self.clock = clock
+            self.scheduleTimer = scheduleTimer
+            self.Count = count
+            
+        def timerTick(self):
+            """
+            Called once the clock reaches 'compareDeadline': flags the
+            timer interrupt, and schedules the next match (a full turn of
+            Count later, unless Compare gets written).
+            """
+            self.Cause |= 1 << (10 + self.TIMER_INTERRUPT)
+            self.compareDeadline += 1 << 32
+            
         def getUserBit(self):
-            return self.Status & self.STATUS_USER_MASK
+            return self.userMode
             
         def __getitem__(self, item):
             assert(self.getUserBit() == 0)
@@ -71,7 +152,7 @@ class RegisterBank(object):
             if item in self.REGISTER_NAMES:
                 return getattr(self, self.REGISTER_NAMES[item])
             
-            elif isinstance(attr, str) and hasattr(self, item):
+            elif isinstance(item, str) and hasattr(self, item):
                 return getattr(self, item)
                 
             return 0x0
@@ -87,6 +168,9 @@ class RegisterBank(object):
                 setattr(self, item, data)
     
     def __init__(self, vm_memory):
+        # flat register file, used directly by the instruction handlers.
+        # $zero is enforced at the write sites, so std_registers[0] 
+        # always holds 0 and reads need no special case.
         self.std_registers = 32 * [0, ]
         self.HI = 0x0
         self.LO = 0x0
@@ -96,7 +180,7 @@ class RegisterBank(object):
         self.memory = vm_memory
         
     def __getitem__(self, item):
-        return self.std_registers[item] if item else 0
+        return self.std_registers[item]
             
     def __setitem__(self, item, value):
         if item: self.std_registers[item] = value & 0xFFFFFFFF
@@ -23,7 +23,7 @@ FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """""
 
-import unittest
+import unittest, tempfile
 import testcommon
 
 from spym.vm import MemoryManager, AssemblyParser
@@ -87,5 +87,108 @@ class TestParser(unittest.TestCase):
     .asciiz "SIMPLE, TEST"
 """)
 
+class DataDirectiveTests(unittest.TestCase):
+    def _run(self, program, **vm_args):
+        vm, result, output = testcommon.runProgram(program, **vm_args)
+        return vm, output.getvalue()
+        
+    def testLargeSpace(self):
+        vm, output = self._run(r"""
+    .data
+buffer: .space 0x4000000
+after:  .word 42
+    .text
+    .globl main
+main:
+    la $t0, buffer
+    lw $a0, 0x3FFFFFC($t0)
+    li $v0, 1
+    syscall
+    li $t1, 7
+    sw $t1, 0x3FFFFFC($t0)
+    lw $a0, 0x3FFFFFC($t0)
+    li $v0, 1
+    syscall
+    lw $a0, after
+    li $v0, 1
+    syscall
+    jr $ra
+""")
+        
+        self.assertEqual(output, '0742')
+        self.assertTrue(vm.memory.main_memory.getAllocatedBytes() < 4096)
+        self.assertTrue(vm.heap.start >= 0x10000000 + 0x4000000 + 4)
+        
+    def testDataLists(self):
+        vm, output = self._run(r"""
+    .data
+bytes:  .byte 1, 2, 'a'
+halves: .half 0x1234, -1:3
+words:  .word 0:1000, 5, bytes
+    .text
+    .globl main
+main:
+    la $t0, halves
+    lhu $a0, 6($t0)
+    li $v0, 1
+    syscall
+    la $t0, words
+    lw $a0, 4000($t0)
+    li $v0, 1
+    syscall
+    lw $a0, 3996($t0)
+    li $v0, 1
+    syscall
+    jr $ra
+""")
+        
+        self.assertEqual(output, '6553550')
+        self.assertEqual(vm.memory.main_memory.read_bytes(0x10000000, 10),
+            b'\x01\x02a\x004\x12\xff\xff\xff\xff')
+            
+    def testSegmentSwitches(self):
+        vm, output = self._run(r"""
+    .data
+first:  .word 1
+    .text
+    .globl main
+main:
+    la $t0, first
+    .data
+second: .word 2
+    .text
+    la $t1, second
+    sub $a0, $t1, $t0
+    li $v0, 1
+    syscall
+    jr $ra
+""")
+        
+        self.assertEqual(output, '4')
+        
+    def testIncludeBinary(self):
+        with tempfile.NamedTemporaryFile(suffix = '.bin') as bin_file:
+            bin_file.write(bytes(range(256)))
+            bin_file.flush()
+            
+            vm, output = self._run(r"""
+    .data
+blob:   .incbin "%s", 16, 8
+after:  .asciiz "!"
+    .text
+    .globl main
+main:
+    la $t0, blob
+    lw $a0, 4($t0)
+    li $v0, 1
+    syscall
+    la $a0, after
+    li $v0, 4
+    syscall
+    jr $ra
+""" % bin_file.name)
+        
+        self.assertEqual(output, '%d!' % 0x17161514)
+
 if __name__ == '__main__':
     unittest.main()
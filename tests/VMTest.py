@@ -23,10 +23,19 @@ FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 OTHER DEALINGS IN THE SOFTWARE.
 """""
 
-import unittest
+import unittest, asyncio, io, os, struct, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from spym.vm.core import VirtualMachine
-from spym.vm.devices import TerminalKeyboard, TerminalScreen
+from testcommon import runProgram
+from spym.vm.regbank import RegisterBank
+from spym.vm.devices import TerminalKeyboard, TerminalScreen, FIFOScreen, \
+    CPUClock_TICKS, DMAController, DiskDevice, Framebuffer
 
 class GlobalASMTests(unittest.TestCase):
     def _runTest(self, asm, lab = True):
@@ -72,5 +81,1451 @@ tlabel:
     jr $ra
 """)
 
+class RunLimitsTests(unittest.TestCase):
+    LOOP_PROGRAM = r"""
+    .text
+    .globl main
+main:
+    li $t0, 0x10010000
+loop:
+    sw $t0, 0($t0)
+    addi $t0, $t0, 32
+    j loop
+"""
+
+    def setUp(self):
+        self.vm = VirtualMachine(memoryMappedDevices = {})
+        self.vm.load(self.LOOP_PROGRAM, True)
+        
+    def testInstructionLimit(self):
+        result = self.vm.run(max_instructions = 500)
+        self.assertEqual(result, VirtualMachine.RUN_INSTRUCTION_LIMIT)
+        self.assertEqual(self.vm.instructionCount, 500)
+        
+    def testResumeQuanta(self):
+        self.vm.run(max_instructions = 100)
+        
+        for i in range(5):
+            result = self.vm.resume(max_instructions = 100)
+            self.assertEqual(result, VirtualMachine.RUN_INSTRUCTION_LIMIT)
+            
+        self.assertEqual(self.vm.instructionCount, 600)
+        
+    def testTimeLimit(self):
+        result = self.vm.run(max_seconds = 0.1)
+        self.assertEqual(result, VirtualMachine.RUN_TIME_LIMIT)
+        
+    def testMemoryLimit(self):
+        result = self.vm.run(max_memory_bytes = 64 * 1024)
+        self.assertEqual(result, VirtualMachine.RUN_MEMORY_LIMIT)
+        self.assertTrue(self.vm.memory.main_memory.getAllocatedBytes() > 
+            64 * 1024)
+            
+    def testFinishedProgram(self):
+        vm = VirtualMachine(memoryMappedDevices = {})
+        vm.load(".text\n.globl main\nmain:\n    jr $ra\n", True)
+        self.assertEqual(vm.run(max_instructions = 1000),
+            VirtualMachine.RUN_FINISHED)
+
+class AsyncExecutionTests(unittest.TestCase):
+    ECHO_PROGRAM = r"""
+    .text
+    .globl main
+main:
+    li $v0, 5
+    syscall
+    move $a0, $v0
+    addi $a0, $a0, 1
+    li $v0, 1
+    syscall
+    jr $ra
+"""
+
+    class _Writer(object):
+        def __init__(self):
+            self.data = b''
+            self.drained = 0
+            
+        def write(self, data):
+            self.data += data
+            
+        async def drain(self):
+            self.drained += 1
+            
+    def testAwaitedInput(self):
+        async def session():
+            reader = asyncio.StreamReader()
+            writer = self._Writer()
+            
+            vm = VirtualMachine(memoryMappedDevices = {},
+                standardInput = reader, standardOutput = writer)
+            vm.load(self.ECHO_PROGRAM, True)
+            
+            task = asyncio.ensure_future(vm.run_async(slice = 10))
+            await asyncio.sleep(0.01)
+            self.assertFalse(task.done())
+            
+            reader.feed_data(b'41\n')
+            result = await task
+            return result, writer
+            
+        result, writer = asyncio.run(session())
+        self.assertEqual(result, VirtualMachine.RUN_FINISHED)
+        self.assertEqual(writer.data, b'42')
+        self.assertTrue(writer.drained > 0)
+        
+    def testPromptBeforeInputWait(self):
+        async def session():
+            reader = asyncio.StreamReader()
+            writer = self._Writer()
+            
+            vm = VirtualMachine(memoryMappedDevices = {},
+                standardInput = reader, standardOutput = writer)
+            vm.load(r"""
+    .data
+prompt: .asciiz "n? "
+    .text
+    .globl main
+main:
+    la $a0, prompt
+    li $v0, 4
+    syscall
+""" + self.ECHO_PROGRAM.split('main:', 1)[1], True)
+            
+            task = asyncio.ensure_future(vm.run_async(slice = 10))
+            await asyncio.sleep(0.01)
+            self.assertEqual(vm.runResult, VirtualMachine.RUN_INPUT_WAIT)
+            self.assertEqual(writer.data, b'n? ')
+            
+            reader.feed_data(b'1\n')
+            return await task, writer
+            
+        result, writer = asyncio.run(session())
+        self.assertEqual(result, VirtualMachine.RUN_FINISHED)
+        self.assertEqual(writer.data, b'n? 2')
+
+class IsolationTests(unittest.TestCase):
+    COUNT_PROGRAM = r"""
+    .text
+    .globl main
+main:
+    li $t0, %d
+    li $t1, 0
+count:
+    addi $t1, $t1, 1
+    bne $t1, $t0, count
+    move $a0, $t1
+    li $v0, 1
+    syscall
+    jr $ra
+"""
+
+    def _runProgram(self, count):
+        output = io.StringIO()
+        vm = VirtualMachine(standardOutput = output, 
+            standardInput = io.StringIO())
+        vm.load(self.COUNT_PROGRAM % count, True)
+        vm.run()
+        return output.getvalue()
+        
+    def testConfigurationCopies(self):
+        vm = VirtualMachine()
+        vm.cacheInformation['L1_data']['numberOfLines'] = 4
+        
+        self.assertEqual(
+            VirtualMachine.DEFAULT_CACHE_CFG['L1_data']['numberOfLines'], 1024)
+        self.assertEqual(
+            VirtualMachine().cacheInformation['L1_data']['numberOfLines'], 1024)
+        
+    def testHandlerCaches(self):
+        vms = []
+        for count in (3, 4):
+            vm = VirtualMachine(memoryMappedDevices = {},
+                standardOutput = io.StringIO())
+            vm.load(self.COUNT_PROGRAM % count, True)
+            vm.run()
+            vms.append(vm.parser.instruction_assembler._handler_factories)
+            
+        self.assertTrue(vms[0])
+        self.assertIsNot(vms[0], vms[1])
+        
+    def testDeviceStreamParameters(self):
+        devices = {'screen' : (TerminalScreen, {'stdout' : sys.stdout})}
+        vm = VirtualMachine(memoryMappedDevices = devices)
+        vm.deviceInformation['screen'][1]['delay'] = 10
+        
+        self.assertIs(vm.deviceInformation['screen'][1]['stdout'], sys.stdout)
+        self.assertEqual(devices['screen'][1], {'stdout' : sys.stdout})
+            
+    def testDebugPointsPause(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = output)
+        vm.load(self.COUNT_PROGRAM % 3, True)
+        
+        result = vm.run(max_instructions = 1)
+        self.assertEqual(result, VirtualMachine.RUN_INSTRUCTION_LIMIT)
+        
+        count_address = [address for (address, inst) in 
+            vm.memory.main_memory.getInstructionData()
+            if address < 0x10000000 and 
+                'addi $t1, $t1, 1' in getattr(inst, 'orig_text', '')][0]
+        vm.debugPoints = [count_address]
+        
+        hits = 0
+        result = vm.resume()
+        while result == VirtualMachine.RUN_BREAKPOINT:
+            self.assertEqual(vm.regBank.PC, count_address)
+            hits += 1
+            result = vm.resume()
+        
+        self.assertEqual(result, VirtualMachine.RUN_FINISHED)
+        self.assertEqual(hits, 3)
+        self.assertEqual(output.getvalue(), '3')
+            
+    def testConcurrentMachines(self):
+        counts = [10, 20, 30, 40]
+        
+        with ThreadPoolExecutor(max_workers = 4) as executor:
+            results = list(executor.map(self._runProgram, counts))
+            
+        self.assertEqual(results, [str(c) for c in counts])
+
+class ConsoleSyscallTests(unittest.TestCase):
+    def _run(self, program, stdin = ''):
+        vm, result, output = runProgram(program, 
+            standardInput = io.StringIO(stdin))
+        return output.getvalue()
+        
+    def testPrintCachedString(self):
+        # the string is built with byte stores, so it only lives in
+        # the (write-back) data cache when it gets printed
+        self.assertEqual(self._run(r"""
+    .data
+buffer: .space 8
+    .text
+    .globl main
+main:
+    la $t0, buffer
+    li $t1, 'o'
+    sb $t1, 1($t0)
+    li $t1, 'k'
+    sb $t1, 2($t0)
+    li $t1, 'K'
+    sb $t1, 0($t0)
+    move $a0, $t0
+    li $v0, 4
+    syscall
+    jr $ra
+"""), 'Kok')
+
+    def testReadString(self):
+        self.assertEqual(self._run(r"""
+    .data
+buffer: .space 64
+    .text
+    .globl main
+main:
+    la $a0, buffer
+    li $a1, 64
+    li $v0, 8
+    syscall
+    la $t0, buffer
+    lb $a0, 4($t0)
+    li $v0, 1
+    syscall
+    la $a0, buffer
+    li $v0, 4
+    syscall
+    jr $ra
+""", "hello world\nignored\n"), '111hello world')
+        
+    def testHeadlessScreen(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {
+                'screen' : (TerminalScreen, {'headless' : True, 
+                    'delayed_io' : False, 'capture_limit' : 8}),
+                'keyboard' : TerminalKeyboard,
+            },
+            standardOutput = output, 
+            virtualSyscalls = False)
+        
+        self.assertRaises(VirtualMachine.RuntimeVMException, vm.read_screen)
+        
+        vm.load(r"""
+    .data
+msg: .asciiz "hello world\n"
+    .text
+    .globl main
+main:
+    la $a0, msg
+    li $v0, 4
+    syscall
+    jr $ra
+""", True)
+        vm.run()
+        
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(vm.read_screen(clear = True), b'hello wo')
+        self.assertEqual(vm.screenDevice.dropped, 4)
+        self.assertEqual(vm.read_screen(), b'')
+
+    def testOutputFlushedOnError(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = output)
+        vm.load(r"""
+    .text
+    .globl main
+main:
+    li $a0, 7
+    li $v0, 1
+    syscall
+    li $a0, 1
+    li $v0, 17
+    syscall
+""", True)
+        
+        with self.assertRaises(VirtualMachine.RuntimeVMException):
+            vm.run()
+            
+        self.assertEqual(output.getvalue(), "7")
+        
+    def testFIFOScreen(self):
+        program = r"""
+    .data
+msg: .asciiz "%s"
+    .text
+    .globl main
+main:
+    la $a0, msg
+    li $v0, 4
+    syscall
+    li $a0, -1234
+    li $v0, 1
+    syscall
+    jr $ra
+""" % ("0123456789" * 10)
+
+        def run(screen):
+            vm = VirtualMachine(memoryMappedDevices = {
+                    'screen' : screen, 'keyboard' : TerminalKeyboard},
+                standardOutput = io.StringIO(),
+                virtualSyscalls = False)
+            vm.load(program, True)
+            self.assertEqual(vm.run(), VirtualMachine.RUN_FINISHED)
+            return vm
+            
+        byte_vm = run((TerminalScreen, 
+            {'headless' : True, 'delayed_io' : False}))
+        fifo_vm = run((FIFOScreen, 
+            {'headless' : True, 'fifo_size' : 16, 'drain_rate' : 4}))
+        
+        self.assertEqual(fifo_vm.read_screen(), 
+            b"0123456789" * 10 + b"-1234")
+        self.assertEqual(fifo_vm.read_screen(), byte_vm.read_screen())
+        self.assertLess(fifo_vm.instructionCount, 
+            byte_vm.instructionCount // 2)
+
+class KeyboardTests(unittest.TestCase):
+    PROGRAM = r"""
+    .data
+buffer: .space 32
+    .text
+    .globl main
+main:
+    la $a0, buffer
+    li $a1, 32
+    li $v0, 8
+    syscall
+    la $a0, buffer
+    li $v0, 4
+    syscall
+    jr $ra
+"""
+
+    PROMPT_PROGRAM = r"""
+    .data
+prompt: .asciiz "Name? "
+buffer: .space 32
+    .text
+    .globl main
+main:
+    la $a0, prompt
+    li $v0, 4
+    syscall
+""" + PROGRAM.split('main:', 1)[1]
+
+    def _machine(self, **keyboard_params):
+        vm = VirtualMachine(memoryMappedDevices = {
+                'screen' : (TerminalScreen, {'headless' : True}),
+                'keyboard' : (TerminalKeyboard, keyboard_params),
+            },
+            standardOutput = io.StringIO(), 
+            virtualSyscalls = False)
+        vm.load(self.PROGRAM, True)
+        return vm
+        
+    def testPrerecordedInput(self):
+        vm = self._machine(input_data = b"burst of keys\nignored")
+        self.assertEqual(vm.run(), VirtualMachine.RUN_FINISHED)
+        self.assertEqual(vm.read_screen(), b"burst of keys")
+        
+        # the next key is already waiting in the DATA register
+        self.assertEqual(vm.keyboardDevice.data_register, ord('i'))
+        self.assertEqual(bytes(vm.keyboardDevice.input_queue), b"gnored")
+        
+    def testFedInput(self):
+        vm = self._machine()
+        vm.run(max_instructions = 5000)
+        self.assertFalse(vm.keyboardDevice.control_register & 0x1)
+        
+        vm.feed_keyboard("late\n")
+        self.assertEqual(vm.resume(), VirtualMachine.RUN_FINISHED)
+        self.assertEqual(vm.read_screen(), b"late")
+        
+    def testPromptFlushedWhileWaiting(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {
+                'screen' : (TerminalScreen, {'delayed_io' : False}),
+                'keyboard' : TerminalKeyboard,
+            },
+            standardOutput = output,
+            virtualSyscalls = False)
+        vm.load(self.PROMPT_PROGRAM, True)
+        
+        # the name is only typed once the prompt shows up, while the VM 
+        # is still running
+        class Typist(object):
+            def read(self, size):
+                deadline = time.time() + 5
+                while "Name? " not in output.getvalue():
+                    if time.time() > deadline:
+                        return b""
+                    time.sleep(0.01)
+                    
+                self.read = lambda size: b""
+                return b"Bob\n"
+        
+        vm.run(max_instructions = 0)
+        vm.keyboardDevice.startReader(Typist())
+        
+        self.assertEqual(vm.resume(max_seconds = 5), 
+            VirtualMachine.RUN_FINISHED)
+        self.assertEqual(output.getvalue(), "Name? Bob")
+        
+    def testFlushesWhileWaiting(self):
+        class CountingStream(io.StringIO):
+            flushes = 0
+            def flush(self):
+                self.flushes += 1
+                
+        output = CountingStream()
+        vm = VirtualMachine(memoryMappedDevices = {
+                'screen' : (TerminalScreen, {'delayed_io' : False}),
+                'keyboard' : TerminalKeyboard,
+            },
+            standardOutput = output,
+            virtualSyscalls = False,
+            fastForwardPolling = False)
+        vm.load(self.PROMPT_PROGRAM, True)
+        
+        # only the prompt is flushed, not every poll of the keyboard
+        vm.run(max_instructions = 100000)
+        self.assertEqual(output.getvalue(), "Name? ")
+        self.assertEqual(output.flushes, 1)
+        
+    def testReaderThread(self):
+        vm = self._machine()
+        vm.run(max_instructions = 0)
+        
+        vm.keyboardDevice.startReader(io.BytesIO(b"threaded\n"))
+        vm.keyboardDevice.reader_thread.join()
+        
+        self.assertEqual(vm.resume(), VirtualMachine.RUN_FINISHED)
+        self.assertEqual(vm.read_screen(), b"threaded")
+        
+    def testAsyncStream(self):
+        vm = self._machine()
+        vm.run(max_instructions = 0)
+        
+        async def feed():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"async ")
+            reader.feed_data(b"input\n")
+            reader.feed_eof()
+            await vm.keyboardDevice.feedFrom(reader)
+            
+        asyncio.run(feed())
+        self.assertEqual(vm.resume(), VirtualMachine.RUN_FINISHED)
+        self.assertEqual(vm.read_screen(), b"async input")
+
+class HybridSyscallTests(unittest.TestCase):
+    def testNativeSyscallsWithDevices(self):
+        output = io.StringIO()
+        vm = VirtualMachine(hybridSyscalls = True, standardOutput = output)
+        vm.load(r"""
+    .data
+msg: .asciiz "ready: "
+    .text
+    .globl main
+main:
+    la $a0, msg
+    li $v0, 4
+    syscall
+    li $t0, 0xFFFF0008      # screen control register
+    lw $a0, 0($t0)
+    li $v0, 1
+    syscall
+    jr $ra
+""", True)
+        vm.run()
+        
+        self.assertTrue(vm.virtualSyscalls)
+        self.assertEqual(output.getvalue(), 'ready: 1')
+
+class RuntimeLibraryTests(unittest.TestCase):
+    PROGRAM = r"""
+    .data
+source: .asciiz "abcdefgh"
+other:  .asciiz "abcdxyz"
+dest:   .space 16
+    .text
+    .globl main
+main:
+    addi $sp, $sp, -4
+    sw $ra, 0($sp)
+    
+    la $a0, dest
+    li $a1, '-'
+    li $a2, 12
+    jal memset
+    
+    la $a0, dest
+    la $a1, source
+    li $a2, 4
+    jal memcpy
+    
+    la $a0, source          # overlapping move
+    addi $a1, $a0, 2
+    li $a2, 6
+    jal memmove
+    
+    la $a0, dest
+    jal strlen
+    move $a0, $v0
+    li $v0, 1
+    syscall
+    
+    la $a0, source
+    la $a1, other
+    jal strcmp
+    move $a0, $v0
+    li $v0, 1
+    syscall
+    
+    la $a0, dest
+    li $v0, 4
+    syscall
+    la $a0, source
+    li $v0, 4
+    syscall
+    
+    lw $ra, 0($sp)
+    addi $sp, $sp, 4
+    jr $ra
+"""
+
+    def testMemoryFunctions(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = output,
+            loadRuntimeLibrary = True,
+            bulkCacheAccounting = True)
+        vm.load(self.PROGRAM, True)
+        vm.run()
+        
+        self.assertEqual(output.getvalue(), '122abcd--------cdefghgh')
+        self.assertTrue(vm.memory.data_access.bulk_accesses > 0)
+        
+    def _cacheCounters(self, store, cache_lines):
+        vm, result, output = runProgram(r"""
+    .text
+    .globl main
+main:
+    move $s0, $ra
+    li $s1, 0x10010006
+    li $s2, 200
+""" + ''.join(store.replace('@', str(i)) for i in (1, 2)) + r"""
+    li $t0, 0
+load:
+    add $t1, $s1, $t0
+    lbu $t2, 0($t1)
+    addi $t0, $t0, 1
+    bne $t0, $s2, load
+    jr $s0
+""",
+            loadRuntimeLibrary = True,
+            bulkCacheAccounting = True,
+            cacheConfiguration = {
+                'L1_data' : {
+                    'cacheMapping' : 'direct', 
+                    'numberOfLines' : cache_lines,
+                },
+            })
+        
+        cache = vm.memory.data_access
+        self.assertEqual(vm.memory.read_bytes(0x10010006, 200), b'-' * 200)
+        return cache.hits, cache.misses
+        
+    def testBulkCacheAccounting(self):
+        memset = r"""
+    move $a0, $s1
+    li $a1, '-'
+    move $a2, $s2
+    jal memset
+"""
+        byte_loop = r"""
+    li $t0, 0
+    li $t2, '-'
+store@:
+    add $t1, $s1, $t0
+    sb $t2, 0($t1)
+    addi $t0, $t0, 1
+    bne $t0, $s2, store@
+"""
+        for cache_lines in (1024, 4):
+            self.assertEqual(
+                self._cacheCounters(memset, cache_lines),
+                self._cacheCounters(byte_loop, cache_lines))
+        
+    def testBulkMemoryLimit(self):
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = io.StringIO(),
+            loadRuntimeLibrary = True)
+        vm.load(r"""
+    .text
+    .globl main
+main:
+    move $s0, $ra
+    li $a0, 0x10100000
+    li $a1, 1
+    li $a2, 0x400000
+    jal memset
+    jr $s0
+""", True)
+        
+        result = vm.run(max_memory_bytes = 1 << 20)
+        self.assertEqual(result, VirtualMachine.RUN_MEMORY_LIMIT)
+        self.assertLess(vm.memory.main_memory.getAllocatedBytes(), 1 << 20)
+        self.assertEqual(vm.memory[vm.regBank.PC, 4].text, 'syscall')
+        
+        # the syscall is run again once the limit is lifted
+        self.assertEqual(vm.resume(), VirtualMachine.RUN_FINISHED)
+        self.assertEqual(vm.read_memory(0x10100000 + 0x3FFFFF, 1), b'\x01')
+        
+    def testChunkedMove(self):
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = io.StringIO())
+        vm.load(r"""
+    .text
+    .globl main
+main:
+    jr $ra
+""", True)
+        vm.run(max_instructions = 0)
+        
+        data = bytes(i * 7 & 0xFF for i in range(10000))
+        for (source, destination) in ((0x10010000, 0x10010003), 
+                (0x10010003, 0x10010000)):
+            vm.write_memory(source, data)
+            vm.memory.copy_bytes(destination, source, len(data))
+            self.assertEqual(vm.read_memory(destination, len(data)), data)
+        
+    def _runFault(self, call):
+        vm, result, output = runProgram(r"""
+    .text
+    .globl main
+main:
+    li $a0, 0x10010000
+%s
+""" % call, run = False,
+            loadRuntimeLibrary = True,
+            bulkCacheAccounting = True)
+        
+        with self.assertRaises(VirtualMachine.RuntimeVMException) as error:
+            vm.run()
+        
+        self.assertFalse(vm.running)
+        self.assertEqual(vm.memory[vm.regBank.CP0.EPC, 4].text, 'syscall')
+        return vm, str(error.exception)
+        
+    def testBadLength(self):
+        vm, error = self._runFault("""
+    li $a1, 0
+    li $a2, -1
+    jal memset""")
+        
+        self.assertEqual(error, "Program terminated with error code 5")
+        self.assertEqual(vm.regBank.CP0.BadVAddr, 0x10010000)
+        
+    def testBadPointer(self):
+        vm, error = self._runFault("""
+    li $a1, 0x10
+    li $a2, 4
+    jal memcpy""")
+        
+        self.assertEqual(error, "Program terminated with error code 10")
+
+class HeapTests(unittest.TestCase):
+    PROGRAM = r"""
+    .data
+static: .word 1, 2, 3, 4
+    .text
+    .globl main
+main:
+    addi $sp, $sp, -4
+    sw $ra, 0($sp)
+    
+    li $a0, 100
+    li $v0, 9           # sbrk
+    syscall
+    move $s0, $v0
+    li $t0, 77
+    sw $t0, 96($s0)
+    
+    li $a0, 12
+    jal malloc
+    move $s1, $v0
+    move $a0, $s1
+    jal free
+    li $a0, 16
+    jal malloc          # same size class, reuses the freed block
+    sub $a0, $v0, $s1
+    li $v0, 1
+    syscall
+    
+    lw $a0, 96($s0)
+    li $v0, 1
+    syscall
+    
+    lw $ra, 0($sp)
+    addi $sp, $sp, 4
+    jr $ra
+"""
+
+    def testHeap(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = output,
+            loadRuntimeLibrary = True)
+        vm.load(self.PROGRAM, True)
+        vm.run()
+        
+        self.assertEqual(output.getvalue(), '077')
+        self.assertEqual(vm.heap.start, 0x10040000)
+        self.assertEqual(vm.heap.brk, 0x10040000 + 100 + 16)
+        self.assertEqual(vm.heap.stats['malloc_calls'], 2)
+        self.assertEqual(vm.heap.stats['reused_blocks'], 1)
+        self.assertEqual(vm.heap.stats['bytes_in_use'], 16)
+        
+    def _runHeap(self, calls):
+        vm, result, output = runProgram(r"""
+    .text
+    .globl main
+main:
+    move $s0, $ra
+%s
+    jr $s0
+""" % calls, run = False, loadRuntimeLibrary = True)
+        return vm, output
+        
+    def testBadFree(self):
+        for calls in ("""
+    li $a0, 0x10010004
+    jal free""", """
+    li $a0, 8
+    jal malloc
+    move $s1, $v0
+    move $a0, $s1
+    jal free
+    move $a0, $s1
+    jal free"""):
+            vm, output = self._runHeap(calls)
+            
+            with self.assertRaises(VirtualMachine.RuntimeVMException) as error:
+                vm.run()
+                
+            self.assertIn("passed to free()", str(error.exception))
+            self.assertFalse(vm.running)
+            
+    def testBadSize(self):
+        vm, output = self._runHeap("""
+    li $a0, -1
+    jal malloc
+    move $a0, $v0
+    li $v0, 1
+    syscall""")
+        vm.run()
+        
+        self.assertEqual(output.getvalue(), '0')
+        self.assertEqual(vm.heap.stats['failed_calls'], 1)
+
+class FileSyscallTests(unittest.TestCase):
+    PROGRAM = r"""
+    .data
+input:  .asciiz "input.txt"
+output: .asciiz "output.txt"
+escape: .asciiz "../input.txt"
+buffer: .space 64
+    .text
+    .globl main
+main:
+    la $a0, escape
+    li $a1, 0
+    li $v0, 13
+    syscall
+    move $a0, $v0       # -1, outside of the sandbox
+    li $v0, 1
+    syscall
+
+    la $a0, input
+    li $a1, 0
+    li $v0, 13
+    syscall
+    move $s0, $v0
+    
+    move $a0, $s0
+    la $a1, buffer
+    li $a2, 63
+    li $v0, 14
+    syscall
+    move $s1, $v0       # bytes read
+    
+    move $a0, $s0
+    li $v0, 16
+    syscall
+    
+    la $a0, output
+    li $a1, 1
+    li $v0, 13
+    syscall
+    move $s0, $v0
+    
+    move $a0, $s0
+    la $a1, buffer
+    move $a2, $s1
+    li $v0, 15
+    syscall
+    
+    move $a0, $s0
+    li $v0, 16
+    syscall
+    
+    la $a0, buffer
+    li $v0, 4
+    syscall
+    jr $ra
+"""
+
+    def _sandbox(self):
+        sandbox = tempfile.TemporaryDirectory()
+        self.addCleanup(sandbox.cleanup)
+        return sandbox.name
+        
+    def testSandboxedFiles(self):
+        sandbox = self._sandbox()
+        with open(os.path.join(sandbox, 'input.txt'), 'w') as input_file:
+            input_file.write('file contents')
+            
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = output, fileSandbox = sandbox)
+        vm.load(self.PROGRAM, True)
+        vm.run()
+        
+        self.assertEqual(output.getvalue(), '-1file contents')
+        
+        with open(os.path.join(sandbox, 'output.txt')) as output_file:
+            self.assertEqual(output_file.read(), 'file contents')
+            
+    def testBadBuffers(self):
+        sandbox = self._sandbox()
+        with open(os.path.join(sandbox, 'input.txt'), 'w') as input_file:
+            input_file.write('file contents')
+            
+        for (syscall, buffer, length, error_code) in (
+                (14, 0x00000010, 4, 10),    # read into kernel space
+                (15, 0x10010000, -1, 5)):   # write past the address space
+            vm = VirtualMachine(memoryMappedDevices = {},
+                standardOutput = io.StringIO(), fileSandbox = sandbox)
+            vm.load(r"""
+    .data
+input:  .asciiz "input.txt"
+    .text
+    .globl main
+main:
+    la $a0, input
+    li $a1, 0
+    li $v0, 13
+    syscall
+    
+    move $a0, $v0
+    li $a1, %d
+    li $a2, %d
+    li $v0, %d
+    syscall
+    jr $ra
+""" % (buffer, length, syscall), True)
+            
+            with self.assertRaises(VirtualMachine.RuntimeVMException) as error:
+                vm.run()
+                
+            self.assertEqual(str(error.exception), 
+                "Program terminated with error code %d" % error_code)
+            self.assertEqual(vm.openFiles, {})
+
+class RegisterBankTests(unittest.TestCase):
+    def testZeroRegister(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {}, 
+            standardOutput = output)
+        vm.load(r"""
+    .text
+    .globl main
+main:
+    addi $zero, $zero, 5
+    lui $zero, 0x1234
+    lw $zero, 0($sp)
+    move $a0, $zero
+    li $v0, 1
+    syscall
+    jr $ra
+""", True)
+        vm.run()
+        
+        self.assertEqual(output.getvalue(), '0')
+        self.assertEqual(vm.regBank.std_registers[0], 0)
+        
+    def testCachedUserMode(self):
+        cp0 = RegisterBank.CoprocessorZero()
+        self.assertFalse(cp0.userMode)
+        
+        cp0[12] = 0xFF03
+        self.assertTrue(cp0.userMode)
+        
+        cp0.Status &= ~0x3F
+        self.assertFalse(cp0.userMode)
+        self.assertEqual(cp0.Status, 0xFF00)
+
+class InterruptTests(unittest.TestCase):
+    def testClockInterrupts(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = 
+            {'clock' : (CPUClock_TICKS, {'frequency_ticks' : 3000})},
+            standardOutput = output)
+        vm.load(r"""
+    .text
+    .globl main
+main:
+    li $t0, 0
+    li $t1, 3000
+loop:
+    addi $t0, $t0, 1
+    bne $t0, $t1, loop
+    nop
+    move $a0, $t0
+    li $v0, 1
+    syscall
+    jr $ra
+""", True)
+        
+        self.assertEqual(vm.run(), VirtualMachine.RUN_FINISHED)
+        self.assertEqual(output.getvalue(), 'TICK 1!\nTICK 2!\n3000')
+        
+    def testCountCompareTimer(self):
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = io.StringIO())
+        vm.load(r"""
+    .text
+    .globl main
+main:
+    li $t0, 0
+loop:
+    addi $t0, $t0, 1
+    bne $t0, 1000, loop
+    jr $ra
+""", True)
+        
+        vm.run(max_instructions = 50)
+        cp0 = vm.regBank.CP0
+        self.assertEqual(cp0.Count, 50)
+        
+        # mask the interrupts so the timer stays pending
+        cp0.Status &= ~0x1
+        cp0.Count = 0
+        cp0.Compare = 100
+        
+        vm.resume(max_instructions = 99)
+        self.assertEqual(cp0.Count, 99)
+        self.assertFalse(cp0.Cause & (1 << 15))
+        
+        vm.resume(max_instructions = 1)
+        self.assertTrue(cp0.Cause & (1 << 15))
+        
+        cp0.Compare = 200
+        self.assertFalse(cp0.Cause & (1 << 15))
+        
+    def testMaskedInterruptStaysPending(self):
+        cp0 = RegisterBank.CoprocessorZero()
+        clock = CPUClock_TICKS(0, frequency_ticks = 1)
+        clock.attachCPU(cp0)
+        
+        cp0.Status = 0xFF00
+        clock.tick()
+        self.assertEqual(cp0.Cause, 1 << 10)
+        self.assertFalse(cp0.Cause & cp0.interruptMask)
+        
+        cp0.Status |= 0x1
+        self.assertTrue(cp0.Cause & cp0.interruptMask)
+
+class PollingLoopTests(unittest.TestCase):
+    class SlowScreen(TerminalScreen):
+        SCREEN_WRITE_DELAY = 200
+        
+    PROGRAM = r"""
+    .data
+msg: .asciiz "polling\n"
+    .text
+    .globl main
+main:
+    la $a0, msg
+    li $v0, 4
+    syscall
+    la $a0, msg
+    li $v0, 4
+    syscall
+    jr $ra
+"""
+
+    def _run(self, fast_forward):
+        vm, result, output = runProgram(self.PROGRAM, {
+                'screen' : self.SlowScreen,
+                'keyboard' : TerminalKeyboard,
+                'clock' : (CPUClock_TICKS, {'frequency_ticks' : 1000}),
+            },
+            virtualSyscalls = False,
+            fastForwardPolling = fast_forward)
+            
+        self.assertEqual(result, VirtualMachine.RUN_FINISHED)
+        return vm, output.getvalue()
+        
+    def testFastForward(self):
+        slow_vm, slow_output = self._run(False)
+        fast_vm, fast_output = self._run(True)
+        
+        self.assertEqual(fast_output, slow_output)
+        self.assertEqual(fast_vm.instructionCount, slow_vm.instructionCount)
+        self.assertTrue(any(fast_vm.pollingLoops.values()))
+
+class DMATests(unittest.TestCase):
+    PROGRAM = r"""
+    .data
+source: .asciiz "copied by the DMA engine"
+    .align 2
+target: .space 32
+    .text
+    .globl main
+main:
+    li $t0, 0xFFFF0020      # DMA registers
+    la $t1, source
+    sw $t1, 0($t0)          # SRC
+    la $t1, target
+    sw $t1, 4($t0)          # DST
+    li $t1, 25
+    sw $t1, 8($t0)          # LEN
+    li $t1, 1
+    sw $t1, 12($t0)         # CONTROL: start
+wait:
+    lw $t1, 12($t0)
+    andi $t1, $t1, 0x4      # DONE?
+    beq $t1, $zero, wait
+    la $a0, target
+    li $v0, 4
+    syscall
+    jr $ra
+"""
+
+    def _run(self, program = PROGRAM, **params):
+        vm, result, output = runProgram(program, 
+            {'dma' : (DMAController, params)})
+        self.assertEqual(result, VirtualMachine.RUN_FINISHED)
+        return vm, output.getvalue()
+        
+    def testTransfer(self):
+        vm, output = self._run()
+        self.assertEqual(output, "copied by the DMA engine")
+        self.assertFalse(vm.devices_list[0].control_register & 
+            DMAController.CTRL_ERROR)
+        
+    def testTransferTime(self):
+        fast_vm, output = self._run(setup_ticks = 0, bytes_per_tick = 64)
+        slow_vm, output = self._run(setup_ticks = 0, bytes_per_tick = 1,
+            cache_accounting = True)
+        
+        self.assertEqual(output, "copied by the DMA engine")
+        
+        # 25 more ticks, rounded up to whole iterations of the wait loop
+        self.assertEqual(
+            slow_vm.instructionCount - fast_vm.instructionCount, 27)
+        
+    def testInvalidRanges(self):
+        for (destination, length) in ((0xFFFFFFF0, 64), 
+                (0xFFFF0020, 16), (0x10010000, -1)):
+            program = self.PROGRAM.replace('la $t1, target', 
+                'li $t1, %d' % destination).replace('li $t1, 25', 
+                'li $t1, %d' % length)
+                
+            for coherent in (True, False):
+                if coherent and destination == 0xFFFF0020:
+                    continue # coherent transfers may reach devices
+                    
+                vm, output = self._run(program, coherent = coherent)
+                main_memory = vm.memory.main_memory
+                
+                self.assertTrue(vm.devices_list[0].control_register & 
+                    DMAController.CTRL_ERROR)
+                self.assertTrue(all(block_id * main_memory.BLOCK_SIZE < 
+                    0xFFFFFFFF for block_id in main_memory.memory))
+
+class DiskTests(unittest.TestCase):
+    WRITER = r"""
+    .data
+sector: .asciiz "persistent sector"
+    .text
+    .globl main
+main:
+    li $t0, 0xFFFF0030      # disk registers
+    li $t1, 3
+    sw $t1, 0($t0)          # SECTOR
+    la $t1, sector
+    sw $t1, 4($t0)          # BUFFER
+    li $t1, 1
+    sw $t1, 8($t0)          # COUNT
+    li $t1, 2
+    sw $t1, 12($t0)         # COMMAND: write
+    jr $ra
+"""
+
+    READER = r"""
+    .data
+buffer: .space 512
+    .text
+    .globl main
+main:
+    li $t0, 0xFFFF0030
+    li $t1, 3
+    sw $t1, 0($t0)
+    la $t1, buffer
+    sw $t1, 4($t0)
+    li $t1, 1
+    sw $t1, 8($t0)
+    li $t1, 1
+    sw $t1, 12($t0)         # COMMAND: read
+    lw $a0, 12($t0)         # status
+    li $v0, 1
+    syscall
+    la $a0, buffer
+    li $v0, 4
+    syscall
+    jr $ra
+"""
+
+    def _run(self, program, image):
+        vm, result, output = runProgram(program, {'disk' : (DiskDevice, 
+                {'image' : image, 'sectors' : 8})})
+        self.assertEqual(result, VirtualMachine.RUN_FINISHED)
+        vm.devices_list[0].close()
+        return output.getvalue()
+        
+    def testPersistentSectors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            image = os.path.join(directory, 'disk.img')
+            
+            self._run(self.WRITER, image)
+            self.assertEqual(os.path.getsize(image), 8 * 512)
+            
+            with open(image, 'rb') as image_file:
+                image_file.seek(3 * 512)
+                self.assertEqual(image_file.read(18), b"persistent sector\0")
+                
+            self.assertEqual(self._run(self.READER, image), 
+                "1persistent sector")
+
+class FramebufferTests(unittest.TestCase):
+    PROGRAM = r"""
+    .text
+    .globl main
+main:
+    li $t0, 0xFFE00000      # pixels
+    li $t1, 0xFF0000FF      # opaque red
+    sw $t1, 72($t0)         # (2, 1)
+    sw $t1, 156($t0)        # (7, 2)
+    li $t1, 0x80
+    sb $t1, 0($t0)          # red channel of (0, 0)
+    li $t2, 0xFFFF0040      # control registers
+    lw $a0, 8($t2)          # DIRTY_MIN
+    li $v0, 1
+    syscall
+    sw $zero, 16($t2)       # PRESENT
+    jr $ra
+"""
+
+    def testSharedFrame(self):
+        with tempfile.TemporaryDirectory() as directory:
+            image = os.path.join(directory, 'frame.rgba')
+            output = io.StringIO()
+            vm = VirtualMachine(memoryMappedDevices = {'display' : 
+                    (Framebuffer, {'width' : 16, 'height' : 4, 
+                        'image' : image})},
+                standardOutput = output)
+            vm.load(self.PROGRAM, True)
+            self.assertEqual(vm.run(), VirtualMachine.RUN_FINISHED)
+            
+            self.assertEqual(output.getvalue(), str(0 | 0 << 16))
+            
+            with open(image, 'rb') as frame:
+                data = frame.read()
+                
+            header = struct.unpack_from(Framebuffer.HEADER_FORMAT, data)
+            self.assertEqual(header, (b'SPFB', 16, 4, 1, 0, 0, 8, 3))
+            
+            pixels = data[Framebuffer.HEADER_SIZE:]
+            self.assertEqual(len(pixels), 16 * 4 * 4)
+            self.assertEqual(pixels[72:76], b'\xFF\x00\x00\xFF')
+            self.assertEqual(pixels[0:4], b'\x80\x00\x00\x00')
+            
+            if numpy is not None:
+                view = vm.memory_view(0xFFE00000, 16 * 4)
+                view[1] = 0xFF00FF00
+                self.assertEqual(vm.read_memory(0xFFE00004, 4), 
+                    b'\x00\xFF\x00\xFF')
+                del view
+                
+            vm.devices_list[0].close()
+
+class ProfilerTests(unittest.TestCase):
+    def testCounters(self):
+        vm = VirtualMachine(memoryMappedDevices = {}, 
+            standardOutput = io.StringIO(), profile = True)
+        vm.load(r"""
+    .text
+    .globl main
+main:
+    li $t0, 0
+    li $t1, 10
+loop:
+    addi $t0, $t0, 1
+    bne $t0, $t1, loop
+    jr $ra
+""", True)
+        vm.run()
+        
+        profiler = vm.profiler
+        self.assertEqual(profiler.getTotal(), vm.instructionCount)
+        
+        address, count, text = profiler.hotLines(1)[0]
+        self.assertEqual(count, 10)
+        self.assertTrue(text.endswith('addi $t0, $t0, 1'))
+        
+        self.assertEqual(profiler.hotLoops(1)[0], 
+            (address, address + 4, 20))
+        self.assertEqual(profiler.opcodeMix()['bne'], 10)
+        self.assertIn('Hottest loops', profiler.report())
+        
+    def testOpcodeNames(self):
+        vm = VirtualMachine(memoryMappedDevices = {}, 
+            standardOutput = io.StringIO(), profile = True)
+        vm.load(r"""
+    .text
+helper:
+    multu $a0, $a0
+    divu $a0, $a0
+    jr $ra
+    
+    .globl main
+main:
+    move $s0, $ra
+    li $a0, 3
+    jal helper          # backward call, not a loop
+    la $t0, helper
+    jalr $t0
+    jr $s0
+""", True)
+        vm.run()
+        
+        mix = vm.profiler.opcodeMix()
+        self.assertEqual(mix['jal'], 2)     # including the call to main
+        self.assertEqual(mix['jalr'], 1)
+        self.assertEqual(mix['multu'], 2)
+        self.assertEqual(mix['divu'], 2)
+        self.assertNotIn('mult', mix)
+        self.assertNotIn('div', mix)
+        
+        self.assertEqual(vm.profiler.hotLoops(), [])
+
+class InstructionTests(unittest.TestCase):
+    PROGRAM = r"""
+    .data
+sep:    .asciiz " "
+bytes:  .byte 0xF0, 0x7F
+    .text
+    .globl main
+print:
+    li $v0, 1
+    syscall
+    la $a0, sep
+    li $v0, 4
+    syscall
+    jr $ra
+    
+main:
+    move $s7, $ra
+    li $t0, -5
+    li $t1, 3
+    slt $a0, $t0, $t1
+    jal print
+    sltu $a0, $t0, $t1
+    jal print
+    slti $a0, $t0, -4
+    jal print
+    sltiu $a0, $t1, 4
+    jal print
+    sra $a0, $t0, 1
+    jal print
+    srl $a0, $t0, 28
+    jal print
+    sll $a0, $t1, 30
+    jal print
+    srav $a0, $t0, $t1
+    jal print
+    nor $a0, $t0, $t1
+    jal print
+    sub $a0, $t1, $t0
+    jal print
+    subu $a0, $t0, $t1
+    jal print
+    addi $a0, $t0, -7
+    jal print
+    andi $a0, $t0, 0xFF
+    jal print
+    xori $a0, $t1, 0xF
+    jal print
+    la $t2, bytes
+    lb $a0, 0($t2)
+    jal print
+    lbu $a0, 0($t2)
+    jal print
+    lb $a0, 1($t2)
+    jal print
+    li $a0, 0
+    bltz $t0, l1
+    nop
+    li $a0, 9
+l1: jal print
+    li $a0, 0
+    bgtz $t0, l2
+    nop
+    li $a0, 9
+l2: jal print
+    li $a0, 0
+    blez $zero, l3
+    nop
+    li $a0, 9
+l3: jal print
+    li $a0, 0
+    bgez $t1, l4
+    nop
+    li $a0, 9
+l4: jal print
+    li $a0, 0
+    beq $t0, $t1, l5
+    nop
+    li $a0, 9
+l5: jal print
+    li $a0, 0
+    bne $zero, $t1, l6
+    nop
+    li $a0, 9
+l6: jal print
+    mult $t0, $t1
+    mflo $a0
+    jal print
+    li $t2, 33
+    sllv $a0, $t1, $t2
+    jal print
+    move $ra, $s7
+    jr $ra
+"""
+
+    def testSemantics(self):
+        output = io.StringIO()
+        vm = VirtualMachine(memoryMappedDevices = {}, 
+            standardOutput = output)
+        vm.load(self.PROGRAM, True)
+        vm.run()
+        
+        self.assertEqual(output.getvalue().split(), [str(i) for i in (
+            1, 0, 1, 1, -3, 15, -1073741824, -1, 4, 8, -8, -12, 251, 12,
+            -16, 240, 127, 0, 9, 0, 0, 9, 0, -15, 6)])
+
+class HostMemoryTests(unittest.TestCase):
+    PROGRAM = r"""
+    .data
+values: .space 16
+    .text
+    .globl main
+main:
+    la $t0, values
+    lw $t1, 4($t0)
+    sw $t1, 12($t0)
+    move $a0, $t1
+    li $v0, 1
+    syscall
+    jr $ra
+"""
+
+    def _start(self):
+        vm = VirtualMachine(memoryMappedDevices = {},
+            standardOutput = io.StringIO())
+        vm.load(self.PROGRAM, True)
+        
+        result = vm.run(max_instructions = 0)
+        self.assertEqual(result, VirtualMachine.RUN_INSTRUCTION_LIMIT)
+        return vm
+        
+    def testNotStarted(self):
+        vm = VirtualMachine(memoryMappedDevices = {})
+        self.assertRaises(VirtualMachine.RuntimeVMException,
+            vm.read_memory, 0x10000000, 4)
+        
+    def testReadWrite(self):
+        vm = self._start()
+        vm.write_memory(0x10000000, bytes(range(16)))
+        
+        self.assertEqual(vm.resume(), VirtualMachine.RUN_FINISHED)
+        self.assertEqual(vm.stdoutStream.getvalue(), str(0x07060504))
+        self.assertEqual(vm.read_memory(0x1000000C, 4), bytes(range(4, 8)))
+        
+    @unittest.skipUnless(numpy, "NumPy is not available")
+    def testMemoryView(self):
+        vm = self._start()
+        vm.write_memory(0x10000000, numpy.arange(4, dtype = '<u4'))
+        vm.resume()
+        
+        view = vm.memory_view(0x10000000, 4)
+        self.assertEqual(list(view), [0, 1, 2, 1])
+        self.assertEqual(view.dtype, numpy.dtype('<u4'))
+
 if __name__ == '__main__':
     unittest.main()
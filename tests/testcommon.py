@@ -1,2 +1,17 @@
-import sys
+import sys, io
 sys.path.append('/Users/tanoku/src/spym')
+
+from spym.vm.core import VirtualMachine
+
+def runProgram(program, devices = None, run = True, **vm_args):
+    """
+    Loads 'program' on a new VM with the given memory mapped devices
+    and runs it unless 'run' is False. Returns the VM, the result of
+    the run and the StringIO holding the program's output.
+    """
+    output = io.StringIO()
+    vm = VirtualMachine(memoryMappedDevices = devices or {},
+        standardOutput = output, **vm_args)
+    vm.load(program, True)
+    result = vm.run() if run else None
+    return vm, result, output